@@ -0,0 +1,183 @@
+"""
+Append-only record of cache activity in:
+
+    {cache_root}/.stagecache.global/access_log
+
+One tab separated line per event with these columns:
+
+    time target bytes outcome atype lock_wait copy_time node pid
+
+Outcomes are:
+    hit      asset was already cached (bytes is the size not copied)
+    miss     asset was not cached and was copied (bytes copied)
+    refresh  asset was out of date and was copied again
+    error    the request failed
+    evict    asset deleted to make space
+    purge    asset deleted by request
+    demote   asset copied in from a faster tier as it was evicted there
+
+Times are in seconds. The first three columns are the trace format used by the
+eviction simulator, so logs can be replayed directly (see eviction.py).
+
+Each line is written with a single append, so the file can be safely rotated
+by moving it aside (eg logrotate without copytruncate). Rotated files named
+access_log.1, access_log.2.gz, etc are included in reports.
+"""
+import glob
+import gzip
+import logging
+import os
+import socket
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(name='access_log')
+
+COLUMNS = ['time', 'target', 'bytes', 'outcome', 'atype', 'lock_wait',
+           'copy_time', 'node', 'pid']
+REQUEST_OUTCOMES = ['hit', 'miss', 'refresh']
+
+class AccessEvent():
+    """ what happened to one request """
+    def __init__(self, target, atype, outcome=None, nbytes=0):
+        self.time = time.time()
+        self.target = target
+        self.atype = atype
+        self.outcome = outcome
+        self.bytes = nbytes
+        self.lock_wait = 0.0
+        self.copy_time = 0.0
+
+    def to_line(self):
+        return "\t".join((
+            "{:.3f}".format(self.time),
+            self.target,
+            str(int(self.bytes or 0)),
+            self.outcome,
+            self.atype,
+            "{:.3f}".format(self.lock_wait),
+            "{:.3f}".format(self.copy_time),
+            socket.gethostname(),
+            str(os.getpid()),
+        )) + "\n"
+
+
+class AccessLog():
+    """ writes events to the log file for one cache """
+    def __init__(self, cache):
+        self.umask = cache.config['cache_umask']
+        self.log_file = os.path.join(cache.metadata.md_dir, 'access_log')
+
+    @contextmanager
+    def event(self, target_metadata, dry_run=False):
+        """ yields an AccessEvent to be filled in and logs it afterwards
+
+        exceptions are logged as errors """
+        event = AccessEvent(target_metadata.target_path,
+                            target_metadata.atype)
+        try:
+            yield event
+        except:
+            event.outcome = 'error'
+            raise
+        finally:
+            if not dry_run and event.outcome is not None:
+                self.write(event)
+
+    def log(self, target_metadata, outcome, nbytes=0):
+        """ log a simple event (eg evict, purge) """
+        self.write(AccessEvent(target_metadata.target_path,
+                               target_metadata.atype,
+                               outcome,
+                               nbytes))
+
+    def write(self, event):
+        """ append one line """
+        new_file = not os.path.exists(self.log_file)
+        try:
+            with open(self.log_file, 'at') as log_handle:
+                log_handle.write(event.to_line())
+            if new_file:
+                os.chmod(self.log_file, self.umask)
+        except OSError as os_error:
+            # never fail a request because we can't log it
+            LOGGER.warning("Could not write to access log: %r", os_error)
+
+def get_log_files(log_file):
+    """ return the log and any rotated copies, oldest first """
+    rotated = glob.glob(log_file + '.*')
+
+    def rotation_number(path):
+        suffix = path[len(log_file) + 1:].split('.')[0]
+        return int(suffix) if suffix.isdigit() else 0
+
+    rotated = sorted((f for f in rotated if rotation_number(f) > 0),
+                     key=rotation_number, reverse=True)
+    if os.path.exists(log_file):
+        rotated.append(log_file)
+    return rotated
+
+def read_access_log(log_files):
+    """ yield dicts of event data from one or more log files """
+    if isinstance(log_files, str):
+        log_files = [log_files, ]
+    for log_file in log_files:
+        opener = gzip.open if log_file.endswith('.gz') else open
+        with opener(log_file, 'rt') as log_handle:
+            yield from parse_access_log_lines(log_handle)
+
+def parse_access_log_lines(lines):
+    """ yield dicts of event data from log lines """
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != len(COLUMNS):
+            LOGGER.debug("skipping bad log line: %r", line)
+            continue
+        event = dict(zip(COLUMNS, fields))
+        for key in ['time', 'lock_wait', 'copy_time']:
+            event[key] = float(event[key])
+        event['bytes'] = int(event['bytes'])
+        yield event
+
+def summarize_access_log(events, top=10):
+    """ tally hit ratio, bytes saved, and the most frequent misses """
+    counts = Counter()
+    byte_counts = Counter()
+    lock_wait = 0.0
+    copy_time = 0.0
+    miss_counts = Counter()
+    miss_bytes = defaultdict(int)
+    first, last = None, None
+
+    for event in events:
+        outcome = event['outcome']
+        counts[outcome] += 1
+        byte_counts[outcome] += event['bytes']
+        lock_wait += event['lock_wait']
+        copy_time += event['copy_time']
+        if first is None:
+            first = event['time']
+        last = event['time']
+        if outcome in ['miss', 'refresh']:
+            miss_counts[event['target']] += 1
+            miss_bytes[event['target']] += event['bytes']
+
+    requests = sum(counts[o] for o in REQUEST_OUTCOMES) + counts['error']
+    return {
+        'first': first,
+        'last': last,
+        'requests': requests,
+        'outcomes': dict(counts),
+        'hit_ratio': counts['hit'] / requests if requests else 0,
+        'bytes_saved': byte_counts['hit'],
+        'bytes_transferred': byte_counts['miss'] + byte_counts['refresh'],
+        'bytes_evicted': byte_counts['evict'],
+        'bytes_demoted': byte_counts['demote'],
+        'lock_wait': lock_wait,
+        'copy_time': copy_time,
+        'top_misses': [{'target': target,
+                        'misses': count,
+                        'bytes': miss_bytes[target]}
+                       for target, count in miss_counts.most_common(top)],
+    }
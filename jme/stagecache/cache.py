@@ -3,15 +3,35 @@ import time
 import os
 import re
 import shutil
-from jme.stagecache.text_metadata import TargetMetadata, CacheMetadata
+import threading
+import zlib
+from contextlib import contextmanager, ExitStack
+from jme.stagecache.text_metadata import TargetMetadata, CacheMetadata, \
+                                         get_cached_target, makedirs
 from jme.stagecache.target import collect_target_files, \
-                                  CollectTargetFilesException
+                                  CollectTargetFilesException, CachedTarget, \
+                                  is_recursive, prune_tree
 from jme.stagecache.config import get_config
-from jme.stagecache.types import asset_types
-from jme.stagecache.util import get_time_string
+from jme.stagecache.types import cleanup_asset_types
+from jme.stagecache.compression import CompressionStats
+from jme.stagecache.scheduler import TransferQueue
+from jme.stagecache.eviction import get_policy, AssetStats
+from jme.stagecache.access_log import AccessLog, AccessEvent
+from jme.stagecache.metrics import MetricsExporter
+from jme.stagecache.index import AssetIndex, IndexVersionError, hash_path
+from jme.stagecache.quota import Quotas, add_usage
+from jme.stagecache.reservation import Reservations
+from jme.stagecache.checksum import get_checksums, find_mismatches
+from jme.stagecache.local_copy import COPY_METHODS
+from jme.stagecache.timing import span, timed, record_span
+from jme.stagecache.util import get_time_string, parse_bytes
 
 LOGGER = logging.getLogger(name='cache')
 
+PLACEMENTS = ['free_space', 'hash']
+# sort name -> (IndexRecord field, biggest first)
+INSPECT_SORTS = {'size': ('size', True), 'lock': ('lock_date', False)}
+
 class InsufficientSpaceError(Exception):
     pass
 
@@ -20,13 +40,104 @@ class Cache():
         LOGGER.debug("Creating class object for " + str(cache_root))
         self.config = get_config(cache_root)
         self.cache_root = self.config['cache_root']
+        self.asset_types = self.config['asset_types']
+        cleanup_asset_types(self.asset_types)
         self.metadata = CacheMetadata(self)
+        self.index = AssetIndex(self)
+        # assets can be spread over more than one root (see get_root)
+        self.roots = [self.cache_root, ]
+        for root in self.config.get('cache_roots', []):
+            root = os.path.abspath(os.path.expanduser(root))
+            if root not in self.roots:
+                if not os.path.exists(root):
+                    makedirs(root, self.metadata.umask_dir)
+                self.roots.append(root)
+        self.placement = self.config.get('cache_placement', 'free_space')
+        if self.placement not in PLACEMENTS:
+            raise Exception("Unknown placement: {}. Use one of: {}".format(
+                self.placement, ", ".join(PLACEMENTS)))
+        self.transfers = TransferQueue(self)
+        self.access_log = AccessLog(self)
+        self.eviction_policy = get_policy(
+            self.config['cache_eviction'],
+            os.path.join(self.metadata.md_dir, 'eviction_state'),
+            self.config['cache_umask'])
+        self.quotas = Quotas(self.config.get('cache_quotas', None))
+        self.checksums = self.config.get('cache_checksums', True)
+        self.skip_unchanged = self.config.get('cache_skip_unchanged', False)
+        self.copy_method = self.config.get('cache_copy_method', 'auto')
+        if self.copy_method not in COPY_METHODS:
+            raise Exception("Unknown copy method: {}. Use one of: {}".format(
+                self.copy_method, ", ".join(COPY_METHODS)))
+        self.reservations = Reservations(
+            self, parse_slurm_time(self.config.get(
+                'cache_reservation_timeout', '1-0:00')))
+        # slower cache to fill from and demote to (see get_next_tier)
+        self.next_tier = self.config.get('cache_next_tier', None)
+        self.next_tier_cache = None
+        self.tiers_above = []
+
+    def get_root(self, target_path):
+        """ return the root that holds (or will hold) target_path
+
+        An asset stays in whichever root has its metadata. New assets go to
+        the root with the most free space or are placed by a hash of the
+        path, depending on the placement setting. """
+        if len(self.roots) == 1:
+            return self.cache_root
+        for root in self.roots:
+            cache_dir, cache_name = \
+                    os.path.split(get_cached_target(root, target_path))
+            if os.path.exists(os.path.join(cache_dir,
+                                           '.stagecache.' + cache_name)):
+                return root
+        if self.placement == 'hash':
+            index = zlib.crc32(target_path.encode()) % len(self.roots)
+            return self.roots[index]
+        return max(self.roots, key=lambda r: shutil.disk_usage(r).free)
+
+    def get_free_space(self):
+        """ return free bytes on the filesystems holding the roots """
+        devices = {}
+        for root in self.roots:
+            devices[self.get_device(root)] = shutil.disk_usage(root).free
+        return sum(devices.values())
+
+    def get_device(self, root):
+        """ return the id of the filesystem holding root """
+        return os.stat(root).st_dev
+
+    def get_device_free_space(self, root):
+        """ return free bytes on the filesystem holding root, less the space
+        reserved for copies into roots on the same filesystem """
+        device = self.get_device(root)
+        reserved = sum(r.size for r in self.reservations.get_reservations()
+                       if self.get_device(self.get_root(r.target_path)) \
+                               == device)
+        return shutil.disk_usage(root).free - reserved
+
+    def get_next_tier(self):
+        """ return the Cache object for the next tier down (or None) """
+        if self.next_tier is None:
+            return None
+        if self.next_tier_cache is None:
+            next_tier_cache = Cache(self.next_tier)
+            next_tier_cache.tiers_above = \
+                    self.tiers_above + [self.cache_root, ]
+            if next_tier_cache.cache_root in next_tier_cache.tiers_above:
+                raise Exception("Cache tiers form a loop: " + " -> ".join(
+                    next_tier_cache.tiers_above
+                    + [next_tier_cache.cache_root, ]))
+            self.next_tier_cache = next_tier_cache
+        return self.next_tier_cache
 
     def add_target(self, target,
                    cache_time=None,
                    force=False,
                    purge=False,
-                   dry_run=False):
+                   dry_run=False,
+                   priority=0,
+                   demote=False):
         """
         This is where the magic happens:
 
@@ -41,6 +152,8 @@ class Cache():
             force: ignore and delete any old locks, re-copy remote files
             purge: delete file if cache_time is negative and force is set
             dry_run: don't do anything (except delete locks)
+            priority: higher values jump the transfer queue
+            demote: target is being moved down from a faster tier
         returns: the path of the cached asset
         """
 
@@ -59,7 +172,9 @@ class Cache():
         if cache_time < 0:
             if force:
                 if purge:
-                    self.remove_cached_file(target_metadata, dry_run)
+                    size = self.remove_cached_file(target_metadata, dry_run)
+                    if not dry_run:
+                        self.access_log.log(target_metadata, 'purge', size)
                     return target_metadata.cached_target
             else:
                 LOGGER.error("Use --force to remove file from cache")
@@ -71,147 +186,776 @@ class Cache():
             raise Exception("Cannot purge without setting time to negative "
                             "values")
 
-        # acquire lock
-        with target_metadata.lock(force=force, dry_run=dry_run):
+        with self.log_operation(target_metadata, dry_run) as event:
+            # acquire lock
+            lock_start = time.time()
+            with target_metadata.lock(force=force, dry_run=dry_run):
+                event.lock_wait += record_span('target_lock_wait', lock_start)
 
-            ## compare dates (mtimes) of original and cached verions
-            try:
-                # cached mtime
-                cached_target_size, cache_mtime = \
-                    target_metadata.get_cached_target_size()
-            except FileNotFoundError:
-                cache_mtime = 0
+                ## compare dates (mtimes) of original and cached verions
+                try:
+                    # cached mtime
+                    cached_target_size, cache_mtime = \
+                        target_metadata.get_cached_target_size()
+                except FileNotFoundError:
+                    cache_mtime = 0
 
-            # target original mtime
-            target_mtime = target.get_mtime()
+                # target original mtime
+                with span('remote_stat'):
+                    target_mtime = target.get_mtime()
 
-            if force or cache_mtime is None or cache_mtime < target_mtime:
-                # cache is out of date
+                is_stale = force or cache_mtime is None \
+                        or cache_mtime < target_mtime
+                if is_stale and not force and cache_mtime is not None \
+                        and self.skip_unchanged and not demote \
+                        and self.is_unchanged(target, target_metadata,
+                                              cached_target_size):
+                    LOGGER.info("%s was touched but hasn't changed",
+                                target.path_string)
+                    is_stale = False
+                    if not dry_run:
+                        # so we don't check again next time
+                        target_metadata.set_md_value('size',
+                                                     cached_target_size,
+                                                     catalog=False)
 
-                with self.metadata.lock(force=force, dry_run=dry_run):
-                    # get updated target size
-                    target_size = target.get_size()
+                if is_stale:
+                    # cache is out of date
+                    if demote:
+                        event.outcome = 'demote'
+                    else:
+                        event.outcome = 'miss' if cache_mtime is None \
+                                        else 'refresh'
+
+                    # get it into the next tier down first, then copy from
+                    # there (this may take a while, so do it before locking
+                    # the cache)
+                    if demote or self.next_tier is None:
+                        source = target
+                    else:
+                        source = self.fill_from_next_tier(target, cache_time,
+                                                          force, dry_run,
+                                                          priority)
+
+                    # likewise, demote anything we'll evict
+                    demoted = None
+                    if self.next_tier is not None:
+                        demoted = self.demote_evictions(
+                            target.get_size(), dry_run=dry_run,
+                            root=target_metadata.cache_root)
 
-                    # check for and free up space
-                    #  raises InsufficientSpaceException if it can't
-                    self.free_up_cache_space(target_size, dry_run=dry_run)
+                    lock_start = time.time()
+                    with self.metadata.lock(force=force, dry_run=dry_run):
+                        event.lock_wait += record_span('cache_lock_wait',
+                                                       lock_start)
 
+                        # get updated target size
+                        target_size = target.get_size()
+                        event.bytes = target_size
+
+                        # check for and free up space
+                        #  raises InsufficientSpaceException if it can't
+                        self.free_up_cache_space(
+                            target_size, dry_run=dry_run, demoted=demoted,
+                            root=target_metadata.cache_root)
+
+                        # hold the space until the copy is done
+                        reservation = None
+                        if not dry_run:
+                            reservation = self.reservations.reserve(
+                                target_metadata.target_path, target_size)
+
+                    # do the copy after releasing cache lock
+                    copy_start = time.time()
+                    try:
+                        self.copy_target(source, target_metadata, target_size,
+                                         dry_run=dry_run, priority=priority)
+                    except:
+                        # nothing was listed, just give back the space
+                        self.reservations.release(reservation)
+                        raise
+                    event.copy_time = time.time() - copy_start
 
                     if not dry_run:
-                        # update metadata
+                        # transforms only know the real size once done
+                        target_size = source.get_size()
+                        event.bytes = target_size
+                        self.record_checksums(target_metadata)
+                        # turn the reservation into an asset list entry
                         lock_end_date = int(time.time()) + cache_time
-                        self.metadata.add_cached_file(target_metadata,
-                                                      target_size,
-                                                      lock_end_date)
+                        with self.metadata.lock():
+                            self.metadata.add_cached_file(target_metadata,
+                                                          target_size,
+                                                          lock_end_date,
+                                                          copied=not demote)
+                            self.reservations.release(reservation)
 
-                # do the copy after releasing cache lock and updating MD
-                try:
-                    target.copy_to(target_metadata.cached_target,
-                                   self.config['cache_umask'],
-                                   dry_run=dry_run,
-                                  )
-                except:
-                    # TODO: if it fails for any reason, remove entry
-                    raise
+                    if not dry_run and not demote:
+                        self.record_access(target_metadata)
 
-            else:
-                # file already in cache, update lock
-                # extend lock if new lock is longer
-                lock_end_date = int(time.time()) + cache_time
+                elif demote:
+                    LOGGER.debug("%s is already in %s",
+                                 target.path_string, self.cache_root)
 
-                if force or target_metadata.get_last_lock_date() < lock_end_date:
-                    LOGGER.info("File is already in cache, "
-                                "updating expiration to %s.",
-                                get_time_string(lock_end_date))
-                    if not dry_run:
-                        #target_metadata.set_cache_lock_date(lock_end_date)
-                        # there is an outstanding bug where files get dropped
-                        # from the asset list, so we'll try to add again here
-                        added = self.metadata.add_cached_file(target_metadata,
-                                                      cached_target_size,
-                                                      lock_end_date)
-                        if added:
-                            LOGGER.warning("File was missing from asset list, "
-                                           "but it has been re-added")
                 else:
-                    LOGGER.warning("File is already in cache with a later "
-                                "expiration date, "
-                                "use --force to change")
+                    # file already in cache, update lock
+                    event.outcome = 'hit'
+                    event.bytes = cached_target_size
 
-        return target_metadata.cached_target
+                    # extend lock if new lock is longer
+                    lock_end_date = int(time.time()) + cache_time
+
+                    if force or \
+                            target_metadata.get_last_lock_date() < lock_end_date:
+                        LOGGER.info("File is already in cache, "
+                                    "updating expiration to %s.",
+                                    get_time_string(lock_end_date))
+                        if not dry_run:
+                            #target_metadata.set_cache_lock_date(lock_end_date)
+                            # there is an outstanding bug where files get
+                            # dropped from the asset list, so we'll try to add
+                            # again here
+                            added = self.metadata.add_cached_file(
+                                target_metadata,
+                                cached_target_size,
+                                lock_end_date)
+                            if added:
+                                LOGGER.warning("File was missing from asset "
+                                               "list, but it has been "
+                                               "re-added")
+                    else:
+                        LOGGER.warning("File is already in cache with a later "
+                                    "expiration date, "
+                                    "use --force to change")
 
+                    if not dry_run:
+                        self.record_access(target_metadata)
 
-    def free_up_cache_space(self, size, dry_run=False):
+        return target_metadata.cached_target
+
+    def add_targets(self, targets, cache_time=None, force=False,
+                    dry_run=False, priority=0):
         """
-        delete old cached files
+        Stage a group of targets (eg all of a job's inputs) all or nothing:
+
+            * lock every target (in path order, so groups can't deadlock)
+            * find which need copying
+            * make space for all of them at once and reserve it
+            * copy them
+
+        If there isn't room for all of them, InsufficientSpaceError is
+        raised before anything is copied. If a copy fails, the targets
+        already copied are left in the cache, but expired, so they don't
+        block eviction. Locks on targets that were already cached are only
+        extended once all are there.
+
+        params: list of Target() objects
+        optional kwargs are as for add_target()
+        returns: list of cached paths (in the same order as targets)
         """
-        LOGGER.debug("We need %d bytes in cache", size)
+        if cache_time is None:
+            cache_time = self.config['cache_time']
+        cache_time = parse_slurm_time(cache_time)
+        if cache_time < 0:
+            raise Exception("Groups can't be staged with negative times")
+
+        unique_targets = {}
+        for target in targets:
+            unique_targets.setdefault(target.path_string, target)
+        metadatas = {path: TargetMetadata(self, path,
+                                          target.asset_type['name']) \
+                     for path, target in unique_targets.items()}
+        events = {path: AccessEvent(path, metadata.atype) \
+                  for path, metadata in metadatas.items()}
+
+        with ExitStack() as target_locks:
+            lock_start = time.time()
+            for path in sorted(metadatas):
+                target_locks.enter_context(
+                    metadatas[path].lock(force=force, dry_run=dry_run))
+            record_span('group_lock_wait', lock_start)
+
+            reservations = {}
+            copied = []
+            try:
+                # sort out hits and misses
+                hits, misses = {}, {}
+                for path, target in unique_targets.items():
+                    cached_size, cache_mtime = \
+                            metadatas[path].get_cached_target_size()
+                    with span('remote_stat'):
+                        target_mtime = target.get_mtime()
+                    if force or cache_mtime is None \
+                            or cache_mtime < target_mtime:
+                        misses[path] = target.get_size()
+                        events[path].outcome = 'miss' \
+                                if cache_mtime is None else 'refresh'
+                        events[path].bytes = misses[path]
+                    else:
+                        hits[path] = cached_size
+                        events[path].outcome = 'hit'
+                        events[path].bytes = cached_size
+
+                # demote before locking the cache, copies take a while
+                demoted = self.demote_evictions(sum(misses.values()),
+                                                keep=set(metadatas),
+                                                dry_run=dry_run)
+                # each root the misses go to needs room for its share
+                root_sizes = {}
+                for path, size in misses.items():
+                    root = metadatas[path].cache_root
+                    root_sizes[root] = root_sizes.get(root, 0) + size
+                with self.metadata.lock(force=force, dry_run=dry_run):
+                    self.free_up_cache_space(sum(misses.values()),
+                                             dry_run=dry_run,
+                                             keep=set(metadatas),
+                                             demoted=demoted)
+                    if len(self.roots) > 1:
+                        for root, size in root_sizes.items():
+                            self.free_up_cache_space(size, dry_run=dry_run,
+                                                     keep=set(metadatas),
+                                                     demoted=demoted,
+                                                     root=root)
+                    if not dry_run:
+                        for path, size in misses.items():
+                            reservations[path] = \
+                                    self.reservations.reserve(path, size)
+
+                for path, size in misses.items():
+                    target = unique_targets[path]
+                    if self.next_tier is not None:
+                        target = self.fill_from_next_tier(
+                            target, cache_time, force, dry_run, priority)
+                    copy_start = time.time()
+                    self.copy_target(target, metadatas[path], size,
+                                     dry_run=dry_run, priority=priority)
+                    events[path].copy_time = time.time() - copy_start
+                    if not dry_run:
+                        # transforms only know the real size once done
+                        size = target.get_size()
+                        events[path].bytes = size
+                        self.record_checksums(metadatas[path])
+                        lock_end_date = int(time.time()) + cache_time
+                        with self.metadata.lock():
+                            self.metadata.add_cached_file(metadatas[path],
+                                                          size,
+                                                          lock_end_date,
+                                                          copied=True)
+                            self.reservations.release(
+                                reservations.pop(path))
+                    copied.append(path)
+            except:
+                for reservation in reservations.values():
+                    self.reservations.release(reservation)
+                if not dry_run:
+                    # a partial group shouldn't hold on to space
+                    for path in copied:
+                        metadatas[path].set_cache_lock_date(int(time.time()))
+                    for path, event in events.items():
+                        if path not in copied:
+                            event.outcome = 'error'
+                        self.access_log.write(event)
+                    self.export_metrics()
+                raise
+
+            if not dry_run:
+                # everything is there, lock the hits too
+                lock_end_date = int(time.time()) + cache_time
+                for path, size in hits.items():
+                    if force or metadatas[path].get_last_lock_date() \
+                            < lock_end_date:
+                        self.metadata.add_cached_file(metadatas[path], size,
+                                                      lock_end_date)
+                for path, metadata in metadatas.items():
+                    self.record_access(metadata)
+                    self.access_log.write(events[path])
+                self.export_metrics()
+
+        LOGGER.info("Staged %d targets (%d copied)", len(metadatas),
+                    len(misses))
+        return [metadatas[t.path_string].cached_target for t in targets]
+
+    def fill_from_next_tier(self, target, cache_time, force=False,
+                            dry_run=False, priority=0):
+        """ stage target in the next tier down, return a Target pointing to
+        the copy there """
+        next_tier = self.get_next_tier()
+        LOGGER.info("Filling from next tier: %s", next_tier.cache_root)
+        with span('fill_from_next_tier'):
+            cached_path = next_tier.add_target(target,
+                                               cache_time=cache_time,
+                                               force=force,
+                                               dry_run=dry_run,
+                                               priority=priority)
+        if dry_run:
+            # nothing was copied to copy from
+            return target
+        return CachedTarget(target.path_string, target.asset_type,
+                            cached_path)
 
+    def demote(self, target_metadata, dry_run=False):
+        """ copy an asset that is about to be evicted to the next tier down
+
+        failures are logged, but don't stop the eviction """
+        if dry_run:
+            return
+        next_tier = self.get_next_tier()
+        LOGGER.info("Demoting %s to %s", target_metadata.target_path,
+                    next_tier.cache_root)
+        source = CachedTarget(target_metadata.target_path,
+                              self.asset_types[target_metadata.atype],
+                              target_metadata.cached_target)
+        try:
+            with span('demote'):
+                next_tier.add_target(source, cache_time='0', demote=True)
+        except Exception as exc:
+            LOGGER.warning("Could not demote %s: %r",
+                           target_metadata.target_path, exc)
+
+    @contextmanager
+    def log_operation(self, target_metadata, dry_run=False):
+        """ yields an AccessEvent to fill in, logs it when done, and
+        updates the exported metrics """
+        try:
+            with span('add_target', target=target_metadata.target_path), \
+                    self.access_log.event(target_metadata, dry_run) as event:
+                yield event
+        finally:
+            if not dry_run:
+                with span('export_metrics'):
+                    self.export_metrics()
+
+    def export_metrics(self, metrics_file=None):
+        """ write metrics for node_exporter if configured
+
+        returns the metrics text """
+        if metrics_file is None:
+            metrics_file = self.config.get('cache_metrics_file', None)
+            if metrics_file is None:
+                return None
+        try:
+            exporter = MetricsExporter(self)
+            if metrics_file == '-':
+                return exporter.get_metrics_text()
+            return exporter.write(metrics_file)
+        except Exception as exc:
+            # metrics should never break staging
+            LOGGER.warning("Could not export metrics: %r", exc)
+
+    def record_access(self, target_metadata):
+        """ update usage stats for the eviction policy """
+        target_metadata.record_access()
+        priority = self.eviction_policy.on_access(
+            AssetStats.from_metadata(target_metadata))
+        if priority is not None:
+            target_metadata.set_priority(priority)
+
+
+    @timed('copy')
+    def copy_target(self, target, target_metadata, target_size,
+                    dry_run=False, priority=0):
+        """ copy target into cache
+
+        waits for a slot in the transfer queue and picks compression in auto
+        mode """
+        umask = self.config['cache_umask']
+        queue_start = time.time()
+        with self.transfers.slot(target.host, target_size,
+                                 priority=int(priority),
+                                 dry_run=dry_run) as bwlimit:
+            record_span('transfer_queue_wait', queue_start)
+            if target.compress != 'auto':
+                target.copy_to(target_metadata.cached_target, umask,
+                               dry_run=dry_run, compress=target.compress,
+                               bwlimit=bwlimit, copy_method=self.copy_method)
+                return
+
+            stats = CompressionStats(self.metadata.md_dir, target.host)
+            compress = stats.choose()
+            LOGGER.info("Auto compression for %s: %s", target.host, compress)
+            with stats.sample(compress, target_size, umask,
+                              dry_run=dry_run) as measured:
+                target.copy_to(target_metadata.cached_target, umask,
+                               dry_run=dry_run, compress=compress,
+                               bwlimit=bwlimit, copy_method=self.copy_method)
+                measured['cpu_time'] = target.cpu_time
+
+    def pick_evictions(self, size, keep=None, root=None):
+        """ return whether size bytes will fit and the expired assets (in
+        eviction order) to delete to make room for them
+
+        keep: target paths not to delete
+        root: the root the bytes are going to. With several roots, that
+              root's filesystem has to have room too, and only assets on
+              it help with that. """
         # how much space is there
         free_space = self.check_cache_space()
         LOGGER.debug("%d bytes free in cache", free_space)
+        needed = size - free_space
+        device, device_needed = None, 0
+        if root is not None and len(self.roots) > 1:
+            device = self.get_device(root)
+            device_needed = size - self.get_device_free_space(root)
+            LOGGER.debug("%d bytes free on %s", size - device_needed, root)
 
         # is it enough
-        if size > free_space:
-            # no
-
-            # get list of stale files
-            unlocked_assets = self.metadata.iter_cached_files(locked=False)
-            unlocked_assets = sorted(unlocked_assets,
-                                     key=lambda a: a.get_last_lock_date(),
-                                     reverse=False)
-
-            # can we free up enough space?
-            total_unlocked_size = sum(a.get_cached_target_size()[0] \
-                                      for a in unlocked_assets)
-            LOGGER.debug("We have %d bytes of stale files we can drop", size)
-            if total_unlocked_size + free_space < size:
-                raise InsufficientSpaceError("Cannot cache file. "
-                                             "There is not enough space.")
-
-            # start deleting stale files ...
-            space_freed = 0
-            files_removed = 0
-            for asset in unlocked_assets:
-                # delete one at a time ...
-                asset_size = self.remove_cached_file(asset, dry_run=dry_run)
-                LOGGER.debug("adding %d to %d", asset_size, free_space)
-
-                # until we have enough space
-                files_removed += 1
-                space_freed += asset_size
-                LOGGER.debug("We now have %d bytes of free space",
-                              free_space + space_freed)
-                if free_space + space_freed > size:
-                    break
+        if needed <= 0 and device_needed <= 0:
+            return True, []
+
+        # get list of stale files in the order the policy wants them gone
+        unlocked_assets = self.get_evictable_assets()
+        if keep is not None:
+            unlocked_assets = [a for a in unlocked_assets \
+                               if a.target not in keep]
 
-            LOGGER.info("Removed %d files to free %d bytes",
-                        files_removed, space_freed)
+        picked = []
+        devices = {}
+        for asset in unlocked_assets:
+            if needed < 0 and device_needed < 0:
+                break
+            on_device = False
+            if device is not None:
+                asset_root = asset.metadata.cache_root
+                if asset_root not in devices:
+                    devices[asset_root] = self.get_device(asset_root)
+                on_device = devices[asset_root] == device
+            if needed < 0 and not on_device:
+                # only room on the destination is missing
+                continue
+            picked.append(asset)
+            needed -= asset.size
+            if on_device:
+                device_needed -= asset.size
+        return needed <= 0 and device_needed <= 0, picked
+
+    def demote_evictions(self, size, keep=None, dry_run=False, root=None):
+        """ copy the assets that free_up_cache_space() will evict down to
+        the next tier
+
+        Call it before locking the cache, so nobody waits on the copies.
+
+        returns: set of target paths demoted """
+        if self.next_tier is None or dry_run:
+            return set()
+        demoted = set()
+        for asset in self.pick_evictions(size, keep=keep, root=root)[1]:
+            if os.path.exists(asset.metadata.write_lock):
+                # someone is using it right now
+                continue
+            self.demote(asset.metadata)
+            demoted.add(asset.target)
+        return demoted
+
+    @timed('free_up_cache_space')
+    def free_up_cache_space(self, size, dry_run=False, keep=None,
+                            demoted=None, root=None):
+        """
+        delete old cached files
+
+        keep: target paths not to delete
+        demoted: target paths already copied to the next tier (see
+        demote_evictions). Others are deleted without being demoted.
+        root: the root size bytes will be copied into (see pick_evictions)
+        """
+        LOGGER.debug("We need %d bytes in cache", size)
+        fits, evictions = self.pick_evictions(size, keep=keep, root=root)
+
+        # can we free up enough space?
+        if not fits:
+            raise InsufficientSpaceError("Cannot cache file. "
+                                         "There is not enough space.")
+        if not evictions:
+            return
+
+        # start deleting stale files ...
+        space_freed = 0
+        for asset in evictions:
+            if self.next_tier is not None and not dry_run \
+                    and asset.target not in (demoted or ()):
+                LOGGER.info("%s was not demoted before the cache was "
+                            "locked, so it won't be", asset.target)
+            # delete one at a time ...
+            asset_size = self.evict_asset(asset, dry_run=dry_run)
+            space_freed += asset_size
+            LOGGER.debug("We have now freed %d bytes", space_freed)
+
+        LOGGER.info("Removed %d files to free %d bytes",
+                    len(evictions), space_freed)
+        if not dry_run:
+            self.eviction_policy.save_state()
+
+
+    def load_index(self):
+        """ return dict from path hash to IndexRecord, rebuilding the index
+        if it's missing or out of date """
+        try:
+            return self.index.read()
+        except IndexVersionError as exc:
+            LOGGER.info("Rebuilding asset index: %s", exc)
+            with self.index.lock(sleep_interval=0.01):
+                self.index.rebuild()
+            return self.index.read()
+
+    def iter_index(self):
+        """ yield path and IndexRecord for every listed asset
+
+        Assets missing from the index are read from their md files. """
+        records = self.load_index()
+        for target_path, atype in self.metadata.list_assets():
+            record = records.get(hash_path(target_path), None)
+            if record is None or record.atype != atype[:14]:
+                LOGGER.debug("%s not in index", target_path)
+                record = self.index.read_metadata(
+                    TargetMetadata(self, target_path, atype))
+            yield target_path, record._replace(atype=atype)
+
+    def iter_index_records(self):
+        """ yield path hash and IndexRecord for every record in the index,
+        rebuilding it first if it's missing or out of date """
+        try:
+            # the header is checked before anything is yielded
+            yield from self.index.iter_records()
+        except IndexVersionError as exc:
+            LOGGER.info("Rebuilding asset index: %s", exc)
+            with self.index.lock(sleep_interval=0.01):
+                self.index.rebuild()
+            yield from self.index.iter_records()
+
+    def stream_index(self, prefix=None):
+        """ yield path and IndexRecord for every listed asset, reading the
+        index once in table order (not list order)
+
+        prefix: only assets whose path starts with this
+
+        Paths are only in the asset list, so it's read to map hashes back
+        to them. Assets missing from the index are read from their md files
+        at the end. """
+        listed = {hash_path(t): (t, a) \
+                  for t, a in self.metadata.list_assets() \
+                  if prefix is None or t.startswith(prefix)}
+        for path_hash, record in self.iter_index_records():
+            asset = listed.pop(path_hash, None)
+            if asset is None:
+                continue
+            target_path, atype = asset
+            if record.atype != atype[:14]:
+                record = self.index.read_metadata(
+                    TargetMetadata(self, target_path, atype))
+            yield target_path, record._replace(atype=atype)
+        for target_path, atype in listed.values():
+            LOGGER.debug("%s not in index", target_path)
+            record = self.index.read_metadata(
+                TargetMetadata(self, target_path, atype))
+            yield target_path, record._replace(atype=atype)
+
+    def read_index(self):
+        """ return dict from path to IndexRecord for every listed asset """
+        return dict(self.iter_index())
+
+    def iter_asset_stats(self, locked=None):
+        """ yield AssetStats for listed assets (using the index)
+
+        if locked is True or False, only assets whose lock is or isn't
+        valid """
+        now = time.time()
+        for target_path, record in self.iter_index():
+            if locked is not None and (record.lock_date > now) != locked:
+                continue
+            yield AssetStats(target_path, record.size,
+                             lock_date=record.lock_date,
+                             last_access=record.last_access,
+                             access_count=record.access_count,
+                             priority=record.priority,
+                             metadata=TargetMetadata(self, target_path,
+                                                     record.atype),
+                             uid=record.uid, gid=record.gid)
+
+    def order_evictable(self, assets):
+        """ return AssetStats in eviction order: by policy, but owners over
+        quota first """
+        ordered = self.eviction_policy.order(assets)
+        if not self.quotas:
+            return ordered
+        return self.quotas.order(ordered, self.load_index().values())
+
+    def get_evictable_assets(self):
+        """ return AssetStats for expired assets in eviction order """
+        return self.order_evictable(self.iter_asset_stats(locked=False))
+
+    def evict_asset(self, asset, dry_run=False):
+        """ delete one asset, return its size
+
+        If tiered, it's not demoted here: demote_evictions() copies it down
+        before the cache lock is taken. """
+        asset_size = self.remove_cached_file(asset.metadata, dry_run=dry_run)
+        self.eviction_policy.on_evict(asset)
+        if not dry_run:
+            self.access_log.log(asset.metadata, 'evict', asset_size)
+        return asset_size
+
+    def get_watermarks(self):
+        """ return (high, low) watermarks as fractions of the cache size
+
+        either can be None if not configured """
+        marks = []
+        for name in ['cache_high_watermark', 'cache_low_watermark']:
+            mark = self.config.get(name, None)
+            if isinstance(mark, str) and mark.endswith('%'):
+                mark = float(mark[:-1]) / 100
+            marks.append(None if mark is None else float(mark))
+        high, low = marks
+        if low is None:
+            low = high
+        elif high is not None and low > high:
+            raise Exception("Low watermark ({}) is above high watermark ({})"
+                            .format(low, high))
+        return high, low
 
+    @timed('trim_to_watermark')
+    def trim_to_watermark(self, force=False, dry_run=False):
+        """ if usage is over the high watermark, evict expired assets until
+        it is under the low watermark
 
+        force: trim to the low watermark even if under the high one
+
+        The cache lock is only held while each asset is deleted, so requests
+        aren't held up for long. Returns bytes freed. """
+        high, low = self.get_watermarks()
+        if low is None:
+            raise Exception("No watermarks configured for " + self.cache_root)
+
+        cache_data = self.inspect_cache()
+        # copies in progress count as used
+        used = cache_data['used'] + cache_data['reserved']
+        capacity = used + cache_data['free']
+        LOGGER.debug("%d of %d bytes used, watermarks: %s, %s",
+                     used, capacity, high, low)
+        if not force and (high is None or used <= high * capacity):
+            return 0
+
+        to_free = used - low * capacity
+        freed = 0
+        evicted = 0
+        for asset in self.get_evictable_assets():
+            if freed >= to_free:
+                break
+            if os.path.exists(asset.metadata.write_lock):
+                # someone is using it right now
+                continue
+            # copy it down a tier before locking the cache
+            if self.next_tier is not None:
+                self.demote(asset.metadata, dry_run=dry_run)
+            with self.metadata.lock(sleep_interval=0.2, dry_run=dry_run):
+                # it may have been requested since we looked
+                if asset.metadata.is_lock_valid():
+                    continue
+                freed += self.evict_asset(asset, dry_run=dry_run)
+                evicted += 1
+
+        LOGGER.info("Trimmed %d files to free %d bytes", evicted, freed)
+        if evicted and not dry_run:
+            self.eviction_policy.save_state()
+            self.export_metrics()
+        return freed
+
+    def start_trimmer(self, interval=60):
+        """ run trim_to_watermark() every interval seconds in a daemon
+        thread
+
+        returns a threading.Event. Set it to stop the thread. """
+        stop = threading.Event()
+
+        def trim_loop():
+            while True:
+                try:
+                    self.trim_to_watermark()
+                except Exception as exc:
+                    LOGGER.warning("Background trim failed: %r", exc)
+                if stop.wait(interval):
+                    break
+
+        threading.Thread(target=trim_loop, name='stagecache_trimmer',
+                         daemon=True).start()
+        return stop
+
+    @timed('remove_cached_file')
     def remove_cached_file(self, target_metadata, dry_run=False):
         """ delete cached files from system and update metadata """
-        LOGGER.info("removing %s", target_metadata.target_path)
+        return self.remove_cached_files([target_metadata, ], dry_run=dry_run)
 
+    def remove_cached_files(self, target_metadatas, dry_run=False):
+        """ delete several cached assets and update the metadata once,
+        return the total size """
         if dry_run:
-            return target_metadata.get_cached_target_size()[0]
+            return sum(tm.get_cached_target_size()[0] \
+                       for tm in target_metadatas)
+
+        for target_metadata in target_metadatas:
+            self.delete_cached_target_files(target_metadata)
 
-        # collect file names
+        # remove records
+        return self.metadata.remove_cached_files(target_metadatas)
+
+    def get_cached_files(self, target_metadata):
+        """ return the paths of the files of one cached asset that exist """
+        asset_type = self.asset_types[target_metadata.atype]
         try:
-            target_files = collect_target_files(os,
-                                                target_metadata.cached_target,
-                                                asset_types[target_metadata.atype])
+            return list(collect_target_files(os,
+                                             target_metadata.cached_target,
+                                             asset_type))
         except CollectTargetFilesException as ctfe:
-            target_files = ctfe.files
-            LOGGER.warning("Files to be deleted are missing: " +
+            LOGGER.warning("Cached files are missing: " +
                            repr(list(ctfe.errors)))
+            return list(ctfe.files)
 
-        # remove files
-        for filename in target_files:
+    def delete_cached_target_files(self, target_metadata):
+        """ delete the files of one cached asset """
+        LOGGER.info("removing %s", target_metadata.target_path)
+        for filename in self.get_cached_files(target_metadata):
             os.remove(filename)
+        if is_recursive(self.asset_types[target_metadata.atype]):
+            prune_tree(target_metadata.cached_target)
+
+    @timed('checksum')
+    def record_checksums(self, target_metadata):
+        """ hash the cached files of an asset and save the checksums """
+        if not self.checksums:
+            return
+        target_metadata.set_checksums(get_checksums(
+            self.get_cached_files(target_metadata),
+            target_metadata.cached_target))
+
+    def verify_asset(self, target_metadata):
+        """ check the cached files of an asset against its checksums
 
-        # remove record
-        return self.metadata.remove_cached_file(target_metadata)
+        returns: 'ok', 'corrupt', or 'unchecked' (no checksums recorded) and
+        a list of the files that are missing or don't match """
+        expected = target_metadata.get_checksums()
+        if expected is None:
+            return 'unchecked', []
+        algorithms = {suffix: checksum.split(':')[0] \
+                      for suffix, checksum in expected.items()}
+        actual = get_checksums(self.get_cached_files(target_metadata),
+                               target_metadata.cached_target, algorithms)
+        bad_files = [target_metadata.cached_target + suffix \
+                     for suffix in find_mismatches(expected, actual)]
+        return ('corrupt' if bad_files else 'ok'), bad_files
+
+    def is_unchanged(self, target, target_metadata, cached_size):
+        """ True if a target on a mounted filesystem has the same size and
+        checksums as the cached copy """
+        if target.get_remote_pref() != "" or target.transform is not None \
+                or target.get_size() != cached_size:
+            return False
+        expected = target_metadata.get_checksums()
+        if expected is None:
+            return False
+        algorithms = {suffix: checksum.split(':')[0] \
+                      for suffix, checksum in expected.items()}
+        with span('checksum_source'):
+            actual = get_checksums(target.files, target.remote_path,
+                                   algorithms)
+        return not find_mismatches(expected, actual)
 
     def inspect_cache(self, force=False, dry_run=False, purge=False, **kwargs):
         """ return cache usage, cache availability
@@ -229,26 +973,29 @@ class Cache():
 
         used_space = 0
         cached_files = {}
-        for target_metadata in self.metadata.iter_cached_files():
-            target_size = target_metadata.get_cached_target_size()[0]
-            if target_size is None:
-                target_size = 0
+        roots = {root: {'used': 0} for root in self.roots}
+        purged = False
+        now = time.time()
+        for target, record in self.iter_index():
+            target_size = record.size
             used_space += target_size
-            target = target_metadata.target_path
-            if target in cached_files:
-                continue
-            lock_date = target_metadata.get_last_lock_date()
-            now = time.time()
+            root = self.roots[record.root] if record.root < len(self.roots) \
+                    else self.cache_root
+            roots[root]['used'] += target_size
+            lock_date = record.lock_date
             if purge and lock_date < now:
+                target_metadata = TargetMetadata(self, target, record.atype)
                 self.remove_cached_file(target_metadata, dry_run)
                 if dry_run:
                     lock_date = '<to-be-purged>'
                 else:
+                    self.access_log.log(target_metadata, 'purge', target_size)
+                    purged = True
                     lock_date = '<purged>'
 
             cached_files[target] = {
                 'size': target_size,
-                'type': target_metadata.atype,
+                'type': record.atype,
                 'lock': lock_date,
             }
 
@@ -259,14 +1006,124 @@ class Cache():
             free_space = total_space - used_space
             LOGGER.debug("%d of %d bytes free", free_space, total_space)
         else:
-            free_space = shutil.disk_usage(self.cache_root).free
+            free_space = self.get_free_space()
             LOGGER.debug("%d bytes free on filysystem", free_space)
+        # space set aside for copies in progress
+        reserved_space = self.reservations.get_reserved()
+        free_space -= reserved_space
+        for root, root_data in roots.items():
+            root_data['free'] = shutil.disk_usage(root).free
+
+        if purged:
+            self.export_metrics()
 
         return {'used': used_space,
                 'free': free_space,
+                'reserved': reserved_space,
                 'root': self.cache_root,
+                'roots': roots,
                 'files': cached_files}
 
+    def iter_inspect(self, atype=None, prefix=None, expired=None,
+                     min_size=None, sort=None):
+        """ yield a dict for each cached asset (target, type, size, lock,
+        and root), reading the index as it goes (see stream_index)
+
+        Filters:
+            atype: only this asset type
+            prefix: only targets starting with this path
+            expired: only expired (True) or locked (False) assets
+            min_size: only assets bigger than this (eg 10G)
+
+        sort by 'size' (biggest first) or 'lock' (soonest expiry first).
+        Sorting has to read every matching asset before yielding any. """
+        if sort is not None and sort not in INSPECT_SORTS:
+            raise Exception("Unknown sort: {}. Use one of: {}".format(
+                sort, ", ".join(INSPECT_SORTS)))
+        records = self.stream_index(prefix=prefix)
+        if sort is not None:
+            key, reverse = INSPECT_SORTS[sort]
+            records = sorted(records, key=lambda r: getattr(r[1], key),
+                             reverse=reverse)
+        for target, record in self.filter_records(records, atype, prefix,
+                                                  expired, min_size):
+            yield {'target': target,
+                   'type': record.atype,
+                   'size': record.size,
+                   'lock': record.lock_date,
+                   'uid': record.uid,
+                   'gid': record.gid,
+                   'root': self.roots[record.root] \
+                           if record.root < len(self.roots) \
+                           else self.cache_root}
+
+    def filter_records(self, records, atype=None, prefix=None, expired=None,
+                       min_size=None):
+        """ yield the (path, IndexRecord) pairs that match the filters
+        (see iter_inspect) """
+        now = time.time()
+        if min_size is not None:
+            min_size = parse_bytes(min_size)
+        for target, record in records:
+            if atype is not None and record.atype != atype:
+                continue
+            if prefix is not None and \
+                    (target is None or not target.startswith(prefix)):
+                continue
+            if expired is not None and (record.lock_date <= now) != expired:
+                continue
+            if min_size is not None and record.size <= min_size:
+                continue
+            yield target, record
+
+    def inspect_summary(self, atype=None, prefix=None, expired=None,
+                        min_size=None):
+        """ return counts and bytes for the cache (or the assets matching
+        the filters, see iter_inspect) without building per asset records
+
+        The index is read once. The asset list is only read to match a
+        prefix. """
+        paths = {}
+        if prefix is not None:
+            # the index has no paths
+            paths = {hash_path(t): t for t, _ in self.metadata.list_assets() \
+                     if t.startswith(prefix)}
+        # unfiltered totals for free space and quotas
+        totals = {'used': 0, 'usage': {}}
+
+        def tally(records):
+            for path_hash, record in records:
+                totals['used'] += record.size
+                if self.quotas:
+                    add_usage(totals['usage'], record)
+                yield paths.get(path_hash, None), record
+
+        now = time.time()
+        summary = {'root': self.cache_root, 'assets': 0, 'used': 0,
+                   'expired_assets': 0, 'expired_bytes': 0, 'types': {}}
+        records = tally(self.iter_index_records())
+        for _, record in self.filter_records(records, atype, prefix,
+                                             expired, min_size):
+            summary['assets'] += 1
+            summary['used'] += record.size
+            if record.lock_date <= now:
+                summary['expired_assets'] += 1
+                summary['expired_bytes'] += record.size
+            type_summary = summary['types'].setdefault(
+                record.atype, {'assets': 0, 'used': 0})
+            type_summary['assets'] += 1
+            type_summary['used'] += record.size
+        if 'cache_size' in self.config:
+            summary['free'] = self.config['cache_size'] - totals['used']
+        else:
+            summary['free'] = self.get_free_space()
+        summary['reserved'] = self.reservations.get_reserved()
+        summary['free'] -= summary['reserved']
+        if self.quotas:
+            summary['quotas'] = self.quotas.report(usage=totals['usage'])
+        return summary
+
+    @timed('check_cache_space')
     def check_cache_space(self):
         """ return the available space on the fs with cache """
         return self.inspect_cache()['free']
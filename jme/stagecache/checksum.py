@@ -0,0 +1,81 @@
+"""
+Fast checksums of cached files, so truncated or corrupt copies (eg from a
+killed rsync) can be found.
+
+After each copy, every file of the asset is hashed and the results saved in
+the asset's metadata (see text_metadata.py):
+
+    /path/.stagecache.filename/checksums
+
+one line per file: the file name after the asset path (empty for single
+file assets) and the checksum. Checksums are tagged with the algorithm, so
+caches can be verified after xxhash is installed or removed:
+
+    xxh64:2f1d33b3ee26a4ae     (if the xxhash module is installed)
+    crc32:8a9136aa             (otherwise, from zlib)
+
+Check a whole cache (or some assets) with `stagecache --verify`.
+
+If cache_skip_unchanged is set, a target on a mounted filesystem whose mtime
+is newer than the cached copy is hashed before it's copied again. If the size
+and checksums still match, the cached copy is kept. (Remote files would have
+to be read in full to hash them, so they are always copied.)
+
+Turn checksums off for a cache with:
+
+cache_checksums: false
+"""
+import logging
+import zlib
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+LOGGER = logging.getLogger(name='checksum')
+
+CHUNK_SIZE = 1024 * 1024
+
+def get_algorithm():
+    """ the fastest algorithm available """
+    return 'crc32' if xxhash is None else 'xxh64'
+
+def file_checksum(path, algorithm=None):
+    """ return "algorithm:hex digest" for a file """
+    if algorithm is None:
+        algorithm = get_algorithm()
+    with open(path, 'rb') as file_handle:
+        chunks = iter(lambda: file_handle.read(CHUNK_SIZE), b'')
+        if algorithm == 'xxh64':
+            if xxhash is None:
+                raise Exception("The xxhash module is needed for xxh64 "
+                                "checksums")
+            hasher = xxhash.xxh64()
+            for chunk in chunks:
+                hasher.update(chunk)
+            digest = hasher.hexdigest()
+        elif algorithm == 'crc32':
+            value = 0
+            for chunk in chunks:
+                value = zlib.crc32(chunk, value)
+            digest = "{:08x}".format(value)
+        else:
+            raise Exception("Unknown checksum algorithm: " + algorithm)
+    return algorithm + ":" + digest
+
+def get_checksums(files, prefix, algorithms=None):
+    """ return {suffix: checksum} for files named prefix + suffix
+
+    algorithms: {suffix: algorithm} to match earlier checksums """
+    if algorithms is None:
+        algorithms = {}
+    checksums = {}
+    for path in files:
+        suffix = path[len(prefix):]
+        checksums[suffix] = file_checksum(path, algorithms.get(suffix, None))
+    return checksums
+
+def find_mismatches(expected, actual):
+    """ return suffixes of files that are missing or differ """
+    return sorted(suffix for suffix in set(expected) | set(actual) \
+                  if expected.get(suffix, None) != actual.get(suffix, None))
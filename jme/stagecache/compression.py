@@ -0,0 +1,202 @@
+"""
+Decide whether transfers from a remote host should be compressed.
+
+Compression can be requested in an asset type definition or in the per-host
+SFTP settings of the config. The asset type wins if it says anything, since
+it knows whether the content is already compressed:
+
+remote:
+    SFTP:
+        default:
+            compress: auto
+        nas.hawaii.edu:
+            compress: true
+            compress_method: ssh
+asset_types:
+    taxdump:
+        suff_list:
+            - /names.dmp
+            - /nodes.dmp
+        compress: true
+
+Values for compress are true, false, or auto. The compress_method is either
+rsync (rsync -z, the default) or ssh (ssh -C).
+
+In auto mode, the achieved throughput with and without compression is recorded
+for each host in {cache_root}/.stagecache.global/compression/{host}. The faster
+mode is used, the other is retried every so often, and compression is dropped
+whenever compressing kept the local CPU busy for nearly the whole transfer.
+The CPU time is taken from each transfer's own rsync process (with os.wait4),
+so transfers running at the same time don't count against each other.
+"""
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(name='compression')
+
+COMPRESS_METHODS = {
+    'rsync': '-z',
+    'ssh': "-e 'ssh -C'",
+}
+
+# auto mode parameters
+EWMA_WEIGHT = 0.3           # weight of newest sample in running average
+CPU_BOUND_FRACTION = 0.9    # CPU time / wall time that counts as CPU bound
+EXPLORE_EVERY = 10          # retry the slower mode every N transfers
+MIN_SAMPLE_SECONDS = 1      # ignore transfers too short to measure
+
+def get_compression_setting(asset_type, config, host=None):
+    """ return (compress, method) for this asset type and host
+
+    compress is one of True, False, 'auto' """
+    sftp_config = config.get('remote', {}).get('SFTP', {})
+    host_config = dict(sftp_config.get('default', {}))
+    if host is not None:
+        host_config.update(sftp_config.get(host, {}))
+
+    compress = asset_type.get('compress', None)
+    if compress is None:
+        compress = host_config.get('compress', False)
+    compress = parse_compress_value(compress)
+
+    method = host_config.get('compress_method', 'rsync')
+    if method not in COMPRESS_METHODS:
+        raise Exception("Unknown compress_method: {}. Use one of: {}".format(
+            method, ", ".join(COMPRESS_METHODS)))
+
+    return compress, method
+
+def parse_compress_value(compress):
+    """ normalize config values like "yes", "Auto", 1 """
+    if isinstance(compress, str):
+        value = compress.strip().lower()
+        if value == 'auto':
+            return 'auto'
+        return value in ['true', 'yes', 'on', '1']
+    return bool(compress)
+
+
+class CompressionStats():
+    """ running throughput averages for one remote host """
+
+    def __init__(self, md_dir, host):
+        self.stats_dir = os.path.join(md_dir, 'compression')
+        self.stats_file = os.path.join(self.stats_dir, host)
+        self.host = host
+
+    def load(self):
+        """ returns dict from mode (z or plain) to [rate, count, cpu_frac] """
+        stats = {}
+        if not os.path.exists(self.stats_file):
+            return stats
+        with open(self.stats_file) as stats_handle:
+            for line in stats_handle:
+                fields = line.strip().split('\t')
+                if len(fields) != 4:
+                    continue
+                mode, rate, count, cpu_frac = fields
+                stats[mode] = [float(rate), int(count), float(cpu_frac)]
+        return stats
+
+    def save(self, stats, umask):
+        """ replace stats file atomically
+
+        (through a temp file of its own, threads save at the same time) """
+        if not os.path.exists(self.stats_dir):
+            os.makedirs(self.stats_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wt', dir=self.stats_dir,
+                                         prefix=self.host + '.',
+                                         suffix='.tmp',
+                                         delete=False) as stats_handle:
+            tmp_file = stats_handle.name
+            try:
+                for mode, (rate, count, cpu_frac) in stats.items():
+                    stats_handle.write("\t".join((mode, str(rate),
+                                                  str(count),
+                                                  str(cpu_frac))) + "\n")
+            except BaseException:
+                os.remove(tmp_file)
+                raise
+        os.chmod(tmp_file, umask)
+        os.replace(tmp_file, self.stats_file)
+
+    def choose(self):
+        """ return True if the next transfer should be compressed """
+        stats = self.load()
+        if 'z' not in stats:
+            return True
+        if 'plain' not in stats:
+            return False
+
+        z_rate, z_count, cpu_frac = stats['z']
+        plain_rate, plain_count, _ = stats['plain']
+        compress = z_rate >= plain_rate and cpu_frac < CPU_BOUND_FRACTION
+
+        # every so often, give the other mode another chance
+        if (z_count + plain_count) % EXPLORE_EVERY == 0:
+            compress = not compress
+
+        LOGGER.debug("%s: compressed %.0f B/s (cpu %.2f), plain %.0f B/s, "
+                     "compress=%s", self.host, z_rate, cpu_frac, plain_rate,
+                     compress)
+        return compress
+
+    def record(self, compressed, nbytes, wall_time, cpu_time, umask):
+        """ fold one transfer into the running averages """
+        if wall_time < MIN_SAMPLE_SECONDS:
+            return
+        mode = 'z' if compressed else 'plain'
+        rate = nbytes / wall_time
+        cpu_frac = cpu_time / wall_time
+        stats = self.load()
+        if mode in stats:
+            old_rate, count, old_cpu_frac = stats[mode]
+            rate = EWMA_WEIGHT * rate + (1 - EWMA_WEIGHT) * old_rate
+            cpu_frac = EWMA_WEIGHT * cpu_frac \
+                    + (1 - EWMA_WEIGHT) * old_cpu_frac
+        else:
+            count = 0
+        stats[mode] = [rate, count + 1, cpu_frac]
+        LOGGER.debug("%s: %s transfer at %.0f B/s using %.2f CPU",
+                     self.host, mode, nbytes / wall_time,
+                     cpu_time / wall_time)
+        self.save(stats, umask)
+
+    @contextmanager
+    def sample(self, compressed, nbytes, umask, dry_run=False):
+        """ time the transfer in the with block and record the result
+
+        yields a dict: set its cpu_time to the CPU seconds used by the
+        transfer's processes (see run_measured)
+
+        Failing to record only logs a warning, it doesn't fail the
+        transfer. """
+        start_wall = time.time()
+        measured = {'cpu_time': 0}
+        yield measured
+        if not dry_run:
+            try:
+                self.record(compressed, nbytes,
+                            time.time() - start_wall,
+                            measured['cpu_time'],
+                            umask)
+            except (OSError, ValueError) as exc:
+                LOGGER.warning("Could not record compression stats for %s: "
+                               "%s", self.host, exc)
+
+def run_measured(command):
+    """ run a shell command (like subprocess.run with check=True)
+
+    returns: user + system time of the command and the processes it waited
+    on (eg rsync and its ssh) """
+    process = subprocess.Popen(command, shell=True)
+    # wait4 only reports this process, unlike RUSAGE_CHILDREN
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return usage.ru_utime + usage.ru_stime
@@ -27,6 +27,27 @@ caches:
         size: 1.0e+10
         time: 12:00
         umask: "664"
+        high_watermark: 0.9
+        low_watermark: 0.75
+        eviction: lru
+        quotas:
+            users:
+                jmeppley: 5G
+                default: 2G
+            groups:
+                lab: 8G
+        metrics_file: /var/lib/node_exporter/textfile/home_cache.prom
+    ram:
+        root: /dev/shm/stagecache
+        size: 2.0e+10
+        next_tier: ssd
+    ssd:
+        root: /local/stagecache
+        roots:
+            - /local2/stagecache
+            - /local3/stagecache
+        placement: hash
+        next_tier: /scratch/stagecache
 remote:
     mappings:
         - pattern: "/mnt/(nas_[^/]+)/(.+)"
@@ -36,13 +57,17 @@ remote:
         default:
             username: jmeppley
             private_key: ~/.ssh/id_rsa
+            compress: auto
         public.server.edu:
             username: anonymous
+            compress: true
+            compress_method: ssh
 asset_types:
     taxdump:
         suff_list:
             - "/nodes.dmp"
             - /names.dmp
+        compress: true
     bwadb:
         suff_patt: '\\.[a-z]+$'
 
@@ -57,6 +82,32 @@ NOTES:
     name
     * the caches list is ignored if it's in a cache config
     * umask must be quoted or an octal ("664" or 0o664)
+    * compress can be true, false, or auto (see compression.py). An asset
+    type setting overrides the host setting.
+    * asset types with recursive: true (like the built in dir type) cache a
+    whole directory tree, copying copy_threads files at once (default 4)
+    * an asset type transform (decompress, gunzip, or unzstd) caches .gz or
+    .zst files decompressed, without the suffix (see transform.py)
+    * transfer limits are set in 'transfers' (see scheduler.py)
+    * eviction is one of: lock_date (default), lru, lfu, gdsf (see
+    eviction.py)
+    * metrics_file is where Prometheus metrics are written (see metrics.py)
+    * next_tier is the name or path of a slower cache. Misses are filled from
+    it and evicted assets are moved down to it (see cache.py)
+    * roots are extra directories (eg on other disks) to spread assets over.
+    Metadata stays in root. placement is free_space (default) or hash.
+    * high_watermark and low_watermark are fractions of the cache size (or
+    percents, eg "90%"). `stagecache --trim` evicts expired files down to the
+    low mark whenever usage is above the high mark.
+    * quotas are bytes per user or group. Expired files of owners over quota
+    are evicted first (see quota.py)
+    * reservation_timeout is how long space set aside for a copy is held if
+    the copying process can't be checked (default 1-0:00, see reservation.py)
+    * checksums (default true) saves a checksum of each copied file for
+    `stagecache --verify`. skip_unchanged (default false) keeps a cached copy
+    whose source was touched but not changed (see checksum.py)
+    * copy_method is auto (default) or rsync. In auto mode files on mounted
+    filesystems are copied in process (see local_copy.py)
 
 The default config is below under DEFAULT_CONFIG. See types.py for asset types.
 
@@ -78,9 +129,16 @@ DEFAULT_CONFIG = {
     'cache_root': '~/.cache',
     'cache_time': '1-0:00',
     'cache_umask': '664',
+    'cache_eviction': 'lock_date',
     'asset_types': types.asset_types
 }
 
+# settings that can be given per cache (as 'cache_X' or caches: name: X)
+CACHE_SETTINGS = ['size', 'time', 'umask', 'eviction', 'metrics_file',
+                  'next_tier', 'roots', 'placement', 'high_watermark',
+                  'low_watermark', 'quotas', 'reservation_timeout',
+                  'checksums', 'skip_unchanged', 'copy_method']
+
 # config file locations
 GLOBAL_CONFIG = '/etc/stagecache.d/config'
 CACHE_CONFIG_TEMPLATE = '{cache_root}/.stagecache.global/config'
@@ -120,7 +178,7 @@ def get_config(cache=None):
 
     # move any globale cache settings into caches
     cache_config['caches'] = {cache_name: {'root': cache_root}}
-    for k in ['size', 'time', 'umask']:
+    for k in CACHE_SETTINGS:
         root_k = 'cache_' + k
         if root_k in cache_config:
             cache_config['caches'][cache_name][k] = cache_config[root_k]
@@ -138,7 +196,7 @@ def get_config(cache=None):
             apply_defaults(config, default)
 
     # copy cache specific settings to top level
-    for k in ['root', 'size', 'time', 'umask']:
+    for k in ['root', ] + CACHE_SETTINGS:
         root_k = 'cache_' + k
         if k in config['caches'][cache_name]:
             config[root_k] = config['caches'][cache_name][k]
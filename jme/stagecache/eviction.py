@@ -0,0 +1,231 @@
+"""
+Policies for choosing which expired assets to delete when space is needed.
+
+Only assets whose lock has expired are ever evicted. The policy just decides
+the order. Choose one per cache in the config:
+
+cache_eviction: gdsf
+caches:
+    scratch:
+        root: /scratch/stagecache
+        eviction: lru
+
+Policies:
+    lock_date: oldest lock end date first (the original behavior)
+    lru: least recently requested first
+    lfu: least frequently requested first (ties broken by recency)
+    gdsf: GreedyDual-Size-Frequency. Evicts the asset with the lowest
+          L + count/size, where L is the priority of the last asset evicted.
+          Small, popular assets stay; big, rarely used ones go.
+
+Access counts and times are recorded in each asset's metadata (see
+text_metadata.py).
+
+simulate() replays a trace of requests against each policy so hit rates can be
+compared before changing a cache's config. A cache's access_log can be used as
+the trace.
+"""
+import logging
+import os
+from jme.stagecache.util import parse_bytes
+from jme.stagecache.access_log import REQUEST_OUTCOMES
+
+LOGGER = logging.getLogger(name='eviction')
+
+class AssetStats():
+    """ the numbers a policy needs to know about one asset """
+    def __init__(self, target, size, lock_date=0, last_access=0,
+                 access_count=0, priority=0, metadata=None, uid=-1, gid=-1):
+        self.target = target
+        self.size = size
+        self.lock_date = lock_date
+        self.last_access = last_access
+        self.access_count = access_count
+        self.priority = priority
+        self.metadata = metadata
+        self.uid = uid
+        self.gid = gid
+
+    @classmethod
+    def from_metadata(cls, target_metadata):
+        """ pull stats from TargetMetadata object """
+        size = target_metadata.get_cached_target_size()[0]
+        uid, gid = target_metadata.get_owner()
+        return cls(target_metadata.target_path,
+                   0 if size is None else size,
+                   lock_date=target_metadata.get_last_lock_date(),
+                   last_access=target_metadata.get_last_access(),
+                   access_count=target_metadata.get_access_count(),
+                   priority=target_metadata.get_priority(),
+                   metadata=target_metadata, uid=uid, gid=gid)
+
+
+class EvictionPolicy():
+    """ evict in order of lock end date """
+    name = 'lock_date'
+
+    def __init__(self, state_file=None, umask=0o664):
+        self.state_file = state_file
+        self.umask = umask
+
+    def on_access(self, asset):
+        """ called after an asset is requested (counts already updated)
+
+        returns a new priority for the asset or None """
+        return None
+
+    def on_evict(self, asset):
+        """ called when an asset is removed """
+        pass
+
+    def save_state(self):
+        """ persist anything that needs to outlive this process """
+        pass
+
+    def sort_key(self, asset):
+        return asset.lock_date
+
+    def order(self, assets):
+        """ return assets in the order they should be evicted """
+        return sorted(assets, key=self.sort_key)
+
+class LRUPolicy(EvictionPolicy):
+    """ evict least recently used first """
+    name = 'lru'
+
+    def sort_key(self, asset):
+        return asset.last_access
+
+class LFUPolicy(EvictionPolicy):
+    """ evict least frequently used first """
+    name = 'lfu'
+
+    def sort_key(self, asset):
+        return (asset.access_count, asset.last_access)
+
+class GDSFPolicy(EvictionPolicy):
+    """ GreedyDual-Size-Frequency (Cherkasova, 1998) with unit cost """
+    name = 'gdsf'
+
+    def __init__(self, state_file=None, umask=0o664):
+        super().__init__(state_file, umask)
+        self.inflation = 0.0
+        if state_file is not None and os.path.exists(state_file):
+            with open(state_file) as state_handle:
+                self.inflation = float(state_handle.read().strip() or 0)
+
+    def on_access(self, asset):
+        asset.priority = self.inflation \
+                + asset.access_count / max(asset.size, 1)
+        return asset.priority
+
+    def on_evict(self, asset):
+        self.inflation = max(self.inflation, asset.priority)
+
+    def save_state(self):
+        if self.state_file is None:
+            return
+        with open(self.state_file, 'wt') as state_handle:
+            state_handle.write(repr(self.inflation))
+        os.chmod(self.state_file, self.umask)
+
+    def sort_key(self, asset):
+        return (asset.priority, asset.last_access)
+
+POLICIES = {policy.name: policy for policy in [EvictionPolicy,
+                                               LRUPolicy,
+                                               LFUPolicy,
+                                               GDSFPolicy]}
+
+def get_policy(name, state_file=None, umask=0o664):
+    """ return an instance of the named policy """
+    try:
+        return POLICIES[name.lower()](state_file, umask)
+    except KeyError:
+        raise Exception("Unknown eviction policy: {}. Use one of: {}".format(
+            name, ", ".join(POLICIES)))
+
+def read_trace(trace_file):
+    """ yield (time, target, size) from a tab separated file
+
+    access logs (see access_log.py) work too, only requests are used """
+    with open(trace_file) as trace_handle:
+        for line in trace_handle:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if len(fields) > 3 and fields[3] not in REQUEST_OUTCOMES:
+                continue
+            when, target, size = fields[:3]
+            yield float(when), target, int(size)
+
+def simulate(policy, trace, capacity, cache_time=0):
+    """ replay requests from trace against a cache of the given capacity
+
+    trace: iterable of (time, target, size)
+    cache_time: seconds each request locks its asset
+
+    An asset that can't fit (because everything else is locked) is counted
+    as a miss and not cached.
+
+    returns dict of counts and ratios """
+    capacity = parse_bytes(capacity)
+    cached = {}
+    used = 0
+    counts = {'requests': 0, 'hits': 0, 'misses': 0, 'evictions': 0,
+              'bytes_requested': 0, 'bytes_hit': 0, 'bypassed': 0}
+
+    for when, target, size in trace:
+        counts['requests'] += 1
+        counts['bytes_requested'] += size
+        asset = cached.get(target, None)
+        if asset is not None and asset.size == size:
+            counts['hits'] += 1
+            counts['bytes_hit'] += size
+        else:
+            counts['misses'] += 1
+            if asset is not None:
+                # changed on source, re-copy
+                used -= asset.size
+                del cached[target]
+
+            if used + size > capacity:
+                expired = [a for a in cached.values() if a.lock_date < when]
+                if used - sum(a.size for a in expired) + size > capacity:
+                    # like the real cache, give up without deleting anything
+                    counts['bypassed'] += 1
+                    continue
+                for victim in policy.order(expired):
+                    policy.on_evict(victim)
+                    used -= victim.size
+                    del cached[victim.target]
+                    counts['evictions'] += 1
+                    if used + size <= capacity:
+                        break
+
+            asset = AssetStats(target, size)
+            cached[target] = asset
+            used += size
+
+        asset.access_count += 1
+        asset.last_access = when
+        asset.lock_date = max(asset.lock_date, when + cache_time)
+        policy.on_access(asset)
+
+    if counts['requests'] > 0:
+        counts['hit_ratio'] = counts['hits'] / counts['requests']
+    else:
+        counts['hit_ratio'] = 0
+    if counts['bytes_requested'] > 0:
+        counts['byte_hit_ratio'] = \
+                counts['bytes_hit'] / counts['bytes_requested']
+    else:
+        counts['byte_hit_ratio'] = 0
+    return counts
+
+def compare_policies(trace_file, capacity, cache_time=0):
+    """ simulate every policy on the trace, return dict of results """
+    return {name: simulate(policy(), read_trace(trace_file), capacity,
+                           cache_time)
+            for name, policy in POLICIES.items()}
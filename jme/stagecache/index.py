@@ -0,0 +1,269 @@
+"""
+Binary index of asset metadata, so the whole cache can be inspected by
+reading one file:
+
+    {cache_root}/.stagecache.global/asset_index
+
+The text metadata files (see text_metadata.py) are still the real record.
+Every write to them also updates the index, and the index is rebuilt from
+them if it is missing or from an older version.
+
+The file is a 64 byte header followed by fixed 80 byte records laid out as an
+open addressing hash table keyed on a hash of the asset path:
+
+    header: magic, version, record size, capacity (slots), slots used
+    record: path hash, state (empty, live, or deleted), root number, asset
+            type, size, lock end date, last access, access count, priority,
+            owner uid and gid (64 bit, so large ids and -1 for unknown fit)
+
+Each field is written in place, so different processes updating different
+fields can't clobber each other. Adding a record and growing the table are
+done holding an flock on .stagecache.global/index_lock. Reads don't lock; they mmap the
+file and scan it.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+from collections import namedtuple
+from jme.stagecache.text_metadata import Lockable
+
+LOGGER = logging.getLogger(name='index')
+
+MAGIC = b'SCIX'
+INDEX_VERSION = 3
+HEADER = struct.Struct('<4sHHQQ')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<8sBB14sqqqqdqq')
+MIN_CAPACITY = 1024
+READ_CHUNK = RECORD.size * 4096
+
+EMPTY, LIVE, DELETED = 0, 1, 2
+
+# md file name -> (offset in record, struct format)
+FIELDS = {
+    'size': (24, 'q'),
+    'cache_lock': (32, 'q'),
+    'last_access': (40, 'q'),
+    'access_count': (48, 'q'),
+    'priority': (56, 'd'),
+    'owner_uid': (64, 'q'),
+    'owner_gid': (72, 'q'),
+}
+
+IndexRecord = namedtuple('IndexRecord', ['root', 'atype', 'size', 'lock_date',
+                                         'last_access', 'access_count',
+                                         'priority', 'uid', 'gid'])
+
+def hash_path(target_path):
+    """ 8 byte hash of an asset path """
+    return hashlib.blake2b(target_path.encode(), digest_size=8).digest()
+
+class IndexVersionError(Exception):
+    pass
+
+class AssetIndex(Lockable):
+    """ the binary index for one cache """
+    use_flock = True
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.cache = cache
+        md_dir = cache.metadata.md_dir
+        self.index_file = os.path.join(md_dir, 'asset_index')
+        self.write_lock = os.path.join(md_dir, 'index_lock')
+
+    def read(self):
+        """ return dict from path hash to IndexRecord for live records
+
+        raises IndexVersionError if the index is missing or out of date """
+        return dict(self.iter_records())
+
+    def iter_records(self):
+        """ yield (path hash, IndexRecord) for each live record, in table
+        order
+
+        raises IndexVersionError if the index is missing or out of date """
+        try:
+            index_handle = open(self.index_file, 'rb')
+        except FileNotFoundError:
+            raise IndexVersionError("No index")
+        with index_handle:
+            if os.fstat(index_handle.fileno()).st_size <= HEADER_SIZE:
+                raise IndexVersionError("Empty index")
+            with mmap.mmap(index_handle.fileno(), 0,
+                           access=mmap.ACCESS_READ) as index_map:
+                self.check_header(index_map[:HEADER.size])
+                # a chunk at a time, so huge indexes aren't copied whole
+                for start in range(HEADER_SIZE, len(index_map), READ_CHUNK):
+                    for record in RECORD.iter_unpack(
+                            index_map[start:start + READ_CHUNK]):
+                        if record[1] == LIVE:
+                            yield record[0], IndexRecord(
+                                record[2],
+                                record[3].rstrip(b'\0').decode(),
+                                *record[4:])
+
+    def check_header(self, header_bytes):
+        """ return capacity and used slot count from header """
+        magic, version, record_size, capacity, used = \
+                HEADER.unpack(header_bytes)
+        if magic != MAGIC or version != INDEX_VERSION \
+                or record_size != RECORD.size:
+            raise IndexVersionError("Index is version {}, not {}".format(
+                version, INDEX_VERSION))
+        return capacity, used
+
+    def get(self, target_path):
+        """ return the IndexRecord for one asset or None """
+        try:
+            with open(self.index_file, 'rb') as index_handle:
+                capacity, _ = self.check_header(
+                    index_handle.read(HEADER.size))
+                slot, state = self.find_slot(index_handle, capacity,
+                                             hash_path(target_path))
+                if state != LIVE:
+                    return None
+                index_handle.seek(HEADER_SIZE + slot * RECORD.size)
+                record = RECORD.unpack(index_handle.read(RECORD.size))
+        except (FileNotFoundError, IndexVersionError, struct.error):
+            return None
+        return IndexRecord(record[2], record[3].rstrip(b'\0').decode(),
+                           *record[4:])
+
+    def find_slot(self, index_handle, capacity, path_hash):
+        """ return slot number and state of the slot for path_hash
+
+        (the first empty slot if there is no record for it) """
+        slot = int.from_bytes(path_hash, 'little') % capacity
+        for _ in range(capacity):
+            index_handle.seek(HEADER_SIZE + slot * RECORD.size)
+            record_hash, state = struct.unpack('<8sB', index_handle.read(9))
+            if state == EMPTY or record_hash == path_hash:
+                return slot, state
+            slot = (slot + 1) % capacity
+        raise Exception("Asset index is full")
+
+    def set_value(self, target_metadata, md_type, value):
+        """ update one field of an asset's record (adding it if needed)
+
+        call after writing the md file """
+        if md_type not in FIELDS:
+            return
+        with self.lock(sleep_interval=0.01):
+            try:
+                capacity = self.write_field(target_metadata, md_type, value)
+            except (FileNotFoundError, IndexVersionError, struct.error):
+                self.rebuild()
+                capacity = self.write_field(target_metadata, md_type, value)
+            if capacity is not None:
+                self.rebuild(capacity)
+
+    def write_field(self, target_metadata, md_type, value):
+        """ returns the capacity if the table is over half full (deleted
+        records included) """
+        offset, field_format = FIELDS[md_type]
+        with open(self.index_file, 'r+b') as index_handle:
+            capacity, used = self.check_header(
+                index_handle.read(HEADER.size))
+            path_hash = hash_path(target_metadata.target_path)
+            slot, state = self.find_slot(index_handle, capacity, path_hash)
+            index_handle.seek(HEADER_SIZE + slot * RECORD.size)
+            if state == LIVE:
+                # just the one field, so other fields aren't overwritten
+                index_handle.seek(offset, os.SEEK_CUR)
+                value = float(value)
+                if field_format != 'd':
+                    value = int(value)
+                index_handle.write(struct.pack('<' + field_format, value))
+                return None
+
+            # new record, the md files already have the new value
+            index_handle.write(self.pack_record(path_hash, target_metadata))
+            if state == EMPTY:
+                used += 1
+                index_handle.seek(0)
+                index_handle.write(HEADER.pack(MAGIC, INDEX_VERSION,
+                                               RECORD.size, capacity, used))
+        return capacity if used * 2 > capacity else None
+
+    def remove(self, target_metadata):
+        """ mark an asset's record deleted """
+        with self.lock(sleep_interval=0.01):
+            try:
+                with open(self.index_file, 'r+b') as index_handle:
+                    capacity, _ = self.check_header(
+                        index_handle.read(HEADER.size))
+                    slot, state = self.find_slot(
+                        index_handle, capacity,
+                        hash_path(target_metadata.target_path))
+                    if state == LIVE:
+                        index_handle.seek(HEADER_SIZE + slot * RECORD.size
+                                          + 8)
+                        index_handle.write(bytes([DELETED, ]))
+            except (FileNotFoundError, IndexVersionError, struct.error):
+                pass
+
+    def read_metadata(self, target_metadata):
+        """ return an IndexRecord from an asset's md files """
+        return IndexRecord(self.get_root_number(target_metadata),
+                           target_metadata.atype,
+                           target_metadata.get_cached_target_size()[0],
+                           target_metadata.get_last_lock_date(),
+                           target_metadata.get_last_access(),
+                           target_metadata.get_access_count(),
+                           target_metadata.get_priority(),
+                           *target_metadata.get_owner())
+
+    def pack_record(self, path_hash, target_metadata):
+        record = self.read_metadata(target_metadata)
+        return RECORD.pack(path_hash, LIVE, record.root,
+                           record.atype.encode()[:14], int(record.size),
+                           int(record.lock_date), int(record.last_access),
+                           int(record.access_count), float(record.priority),
+                           int(record.uid), int(record.gid))
+
+    def get_root_number(self, target_metadata):
+        try:
+            return self.cache.roots.index(target_metadata.cache_root)
+        except ValueError:
+            return 0
+
+    def rebuild(self, capacity=None):
+        """ write a new index from the text metadata of the listed assets
+
+        capacity: the current number of slots. It's kept (dropping deleted
+        records) unless the live records alone fill half of it, or would
+        fit in a quarter of a smaller table.
+
+        call with the index lock held """
+        from jme.stagecache.text_metadata import TargetMetadata
+        assets = self.cache.metadata.list_assets()
+        if capacity is None:
+            capacity = MIN_CAPACITY
+        while capacity < len(assets) * 2:
+            capacity *= 2
+        while capacity > MIN_CAPACITY and capacity >= len(assets) * 8:
+            capacity //= 2
+        LOGGER.info("Rebuilding asset index with %d slots for %d assets",
+                    capacity, len(assets))
+
+        table = bytearray(capacity * RECORD.size)
+        for target_path, atype in assets:
+            target_metadata = TargetMetadata(self.cache, target_path, atype)
+            path_hash = hash_path(target_path)
+            slot = int.from_bytes(path_hash, 'little') % capacity
+            while table[slot * RECORD.size + 8] != EMPTY:
+                slot = (slot + 1) % capacity
+            table[slot * RECORD.size:(slot + 1) * RECORD.size] = \
+                    self.pack_record(path_hash, target_metadata)
+
+        tmp_file = "{}.{}.tmp".format(self.index_file, os.getpid())
+        with open(tmp_file, 'wb') as index_handle:
+            index_handle.write(HEADER.pack(MAGIC, INDEX_VERSION, RECORD.size,
+                                           capacity, len(assets))
+                               .ljust(HEADER_SIZE, b'\0'))
+            index_handle.write(table)
+        os.chmod(tmp_file, self.umask)
+        os.replace(tmp_file, self.index_file)
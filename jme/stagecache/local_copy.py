@@ -0,0 +1,221 @@
+"""
+Copy files from mounted filesystems (local disks, NFS, Lustre) in process,
+instead of running rsync for each one.
+
+The cheapest method that works is used, falling back to the next whenever the
+kernel or filesystem refuses (eg EXDEV, EOPNOTSUPP, ENOSYS):
+
+    * clone: a reflink (FICLONE ioctl) shares the blocks when the source and
+    cache are on the same copy-on-write filesystem (btrfs, xfs, ...)
+    * copy_file_range: copied by the kernel (or by the server for NFS 4.2)
+    * sendfile: copied by the kernel, for older kernels
+    * read/write: copied through a buffer, if all else fails
+
+A method that fails part way through hands over to the next one at the same
+offset. The mtime is copied, like rsync -t. With a transfer limit (see
+scheduler.py), data is copied in chunks with pauses to keep under bwlimit.
+
+Like rsync, data is written to a temp file (.{name}.{pid}.tmp) that is
+renamed into place when it's done. The temp file is first preallocated to the
+full size with fallocate(2), so the disk doesn't fragment and a full disk fails
+the copy before any data is written. Filesystems that can't allocate blocks
+(eg NFS before 4.2) are skipped, rather than have glibc's posix_fallocate
+write every block. For the same reason, files copied by rsync only get
+--preallocate where fallocate(2) works (see supports_fallocate()).
+
+To keep using rsync for a cache:
+
+cache_copy_method: rsync
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import re
+import tempfile
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def load_fallocate():
+    """ return libc's fallocate(fd, mode, offset, len) or None (not linux) """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError, TypeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                         ctypes.c_int64]
+    function.restype = ctypes.c_int
+    return function
+
+LOGGER = logging.getLogger(name='local_copy')
+
+COPY_METHODS = ['auto', 'rsync']
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# errors that mean a method isn't supported here
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSUP,
+               errno.EINVAL, errno.ENOTTY, errno.EBADF, errno.ETXTBSY}
+
+FALLOCATE = load_fallocate()
+# st_dev -> whether fallocate(2) works on that filesystem
+FALLOCATE_SUPPORT = {}
+
+# .{name}.{pid}.tmp, see copy_file (transform.py uses the same names)
+TEMP_FILE = re.compile(r'^\..+\.\d+\.tmp$')
+
+# bytes per step when throttling
+CHUNK_SIZE = 8 * 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+
+def copy_range(src_fd, dest_fd, offset, count):
+    return os.copy_file_range(src_fd, dest_fd, count, offset, offset)
+
+def send_range(src_fd, dest_fd, offset, count):
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    return os.sendfile(dest_fd, src_fd, offset, count)
+
+def buffer_range(src_fd, dest_fd, offset, count):
+    data = os.pread(src_fd, min(count, BUFFER_SIZE), offset)
+    written = 0
+    while written < len(data):
+        written += os.pwrite(dest_fd, data[written:], offset + written)
+    return written
+
+RANGE_METHODS = [('copy_file_range', copy_range),
+                 ('sendfile', send_range),
+                 ('read/write', buffer_range)]
+if not hasattr(os, 'copy_file_range'):
+    RANGE_METHODS.pop(0)
+
+def clone(src_fd, dest_fd):
+    """ True if dest is now a reflink of src """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    except OSError as error:
+        if error.errno in UNSUPPORTED:
+            return False
+        raise
+    return True
+
+def copy_file(src_path, dest_path, bwlimit=None):
+    """ copy one file and its mtime
+
+    The data goes to a hidden temp file next to dest_path, which is renamed
+    when it's complete, so nobody sees a partial copy.
+
+    bwlimit: maximum bytes per second (or None)
+
+    returns the name of the method that copied the data """
+    dest_dir, dest_name = os.path.split(dest_path)
+    tmp_path = os.path.join(dest_dir, ".{}.{}.tmp".format(dest_name,
+                                                          os.getpid()))
+    try:
+        with open(src_path, 'rb') as src_handle, \
+                open(tmp_path, 'wb') as dest_handle:
+            src_fd, dest_fd = src_handle.fileno(), dest_handle.fileno()
+            src_stat = os.fstat(src_fd)
+            size = src_stat.st_size
+
+            # a clone copies nothing, so it doesn't count against bwlimit
+            if size > 0 and clone(src_fd, dest_fd):
+                method = 'clone'
+            else:
+                preallocate(dest_fd, size)
+                method = copy_data(src_fd, dest_fd, size, bwlimit)
+
+        os.utime(tmp_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    LOGGER.debug("Copied %s with %s", src_path, method)
+    return method
+
+def preallocate(dest_fd, size):
+    """ reserve disk blocks for the whole file up front
+
+    Keeps big files from fragmenting and fails before copying anything if
+    the disk is full (ENOSPC is raised). Does nothing where fallocate isn't
+    supported. """
+    if size == 0 or FALLOCATE is None:
+        return
+    # mode 0: allocate and extend the file to size
+    if FALLOCATE(dest_fd, 0, 0, size) == 0:
+        return
+    error = ctypes.get_errno()
+    if error in UNSUPPORTED:
+        LOGGER.debug("Can't preallocate: %s",
+                     errno.errorcode.get(error, error))
+        return
+    raise OSError(error, os.strerror(error))
+
+def is_temp_file(path):
+    """ True if path is the name of a copy in progress (or a crashed one) """
+    return TEMP_FILE.match(os.path.basename(path)) is not None
+
+def supports_fallocate(path):
+    """ True if fallocate(2) can allocate blocks on the filesystem that holds
+    path (or will, if it doesn't exist yet) """
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        path = os.path.dirname(path)
+    device = os.stat(path).st_dev
+    if device not in FALLOCATE_SUPPORT:
+        supported = False
+        if FALLOCATE is not None:
+            try:
+                with tempfile.TemporaryFile(dir=path) as probe_handle:
+                    supported = FALLOCATE(probe_handle.fileno(), 0, 0, 1) \
+                            == 0 or ctypes.get_errno() not in UNSUPPORTED
+            except OSError as error:
+                LOGGER.debug("Can't probe fallocate in %s: %s", path, error)
+        FALLOCATE_SUPPORT[device] = supported
+    return FALLOCATE_SUPPORT[device]
+
+def copy_data(src_fd, dest_fd, size, bwlimit=None):
+    """ copy size bytes with the first range method that works
+
+    returns the name of the last method used """
+    methods = iter(RANGE_METHODS)
+    method, copy_fn = next(methods)
+    step = size if bwlimit is None else min(CHUNK_SIZE, max(1, int(bwlimit)))
+    start = time.time()
+    offset = 0
+    while offset < size:
+        try:
+            copied = copy_fn(src_fd, dest_fd, offset,
+                             min(step, size - offset))
+        except OSError as error:
+            if error.errno not in UNSUPPORTED or method == 'read/write':
+                raise
+            # carry on from the same offset
+            LOGGER.debug("%s failed (%s), trying the next method", method,
+                         errno.errorcode.get(error.errno, error.errno))
+            method, copy_fn = next(methods)
+            continue
+        if copied == 0:
+            if method == 'read/write':
+                # source shrank, drop the rest of the preallocated space
+                os.ftruncate(dest_fd, offset)
+                break
+            # some filesystems just copy nothing instead of failing
+            method, copy_fn = next(methods)
+            continue
+        offset += copied
+        if bwlimit is not None:
+            ahead = offset / bwlimit - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+    return method
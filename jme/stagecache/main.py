@@ -1,8 +1,16 @@
 import re
 import logging
-from jme.stagecache.target import get_target
-from jme.stagecache.types import asset_types
-from jme.stagecache.cache import Cache
+import asyncio
+from jme.stagecache.target import get_target, EmptyTargetException
+from jme.stagecache.cache import Cache, parse_slurm_time
+from jme.stagecache.eviction import compare_policies
+from jme.stagecache.access_log import get_log_files, read_access_log, \
+                                      summarize_access_log
+from jme.stagecache.manage import reconcile_cache, delete_enough_files, \
+                                  verify_cache
+from jme.stagecache.text_metadata import get_cached_target
+from jme.stagecache.staging import stage_many
+from jme.stagecache.wildcard import expand_wildcard
 
 LOGGER = logging.getLogger(name='main')
 
@@ -22,13 +30,65 @@ def cache_target(target_url, cache=None, atype=None, time=None, **kwargs):
     # initialize the Target
     if atype is None:
         atype = 'file'
-    asset_type = asset_types.get(atype, None)
+    asset_type = cache.asset_types.get(atype, None)
     if asset_type is None:
         raise Exception("No asset type defined for '{}!'".format(atype))
     target = get_target(target_url, asset_type, cache.config)
 
     return cache.add_target(target, cache_time=time, **kwargs)
 
+def cache_targets(target_urls, cache=None, atype=None, time=None,
+                  purge=False, **kwargs):
+    """
+    copy a group of targets into the cache, all or nothing
+
+    Nothing is copied unless there is room for all of them.
+
+    return list of cached locations
+    """
+    if purge:
+        raise Exception("Purge one target at a time")
+    cache = Cache(cache)
+    if atype is None:
+        atype = 'file'
+    asset_type = cache.asset_types.get(atype, None)
+    if asset_type is None:
+        raise Exception("No asset type defined for '{}!'".format(atype))
+    targets = [get_target(target_url, asset_type, cache.config) \
+               for target_url in target_urls]
+
+    return cache.add_targets(targets, cache_time=time, **kwargs)
+
+def cache_wildcard(pattern_url, cache=None, atype=None, time=None,
+                   threads=8, purge=False, **kwargs):
+    """
+    stage every file matching a glob or {placeholder} pattern (see
+    wildcard.py), each as its own asset, up to threads at a time (see
+    staging.py)
+
+    return the cached location of the pattern root
+    """
+    if purge:
+        raise Exception("Purge one target at a time")
+    cache = Cache(cache)
+    if atype is None:
+        atype = 'file'
+    asset_type = cache.asset_types.get(atype, None)
+    if asset_type is None:
+        raise Exception("No asset type defined for '{}!'".format(atype))
+    root, target_urls = expand_wildcard(pattern_url, cache.config,
+                                        skip_dirs=atype == 'file')
+    if not target_urls:
+        raise EmptyTargetException("Nothing matches " + pattern_url)
+    if len(cache.roots) > 1:
+        LOGGER.warning("%s has more than one root, so some files may not be "
+                       "under the returned directory", cache.cache_root)
+
+    asyncio.run(stage_many(target_urls, cache=cache, atype=atype,
+                           time=time, max_transfers=int(threads), **kwargs))
+
+    return get_cached_target(cache.cache_root, root)
+
 def query_cache(**kwargs):
     """ return state of cache:
         total space used
@@ -37,3 +97,89 @@ def query_cache(**kwargs):
     """
     cache = kwargs.get('cache', None)
     return Cache(cache).inspect_cache(**kwargs)
+
+def inspect_assets(cache=None, atype=None, prefix=None, expired=None,
+                   larger=None, sort=None, **kwargs):
+    """ yield a dict for each cached asset matching the filters
+
+    expired: True for only expired assets, False for only locked ones
+    larger: only assets bigger than this (eg 10G)
+    sort: 'size' or 'lock' (see Cache.iter_inspect) """
+    return Cache(cache).iter_inspect(atype=atype, prefix=prefix,
+                                     expired=expired, min_size=larger,
+                                     sort=sort)
+
+def summarize_cache(cache=None, atype=None, prefix=None, expired=None,
+                    larger=None, **kwargs):
+    """ return asset counts and bytes used (in total, expired, and by type)
+    without listing assets """
+    return Cache(cache).inspect_summary(atype=atype, prefix=prefix,
+                                        expired=expired, min_size=larger)
+
+def compare_eviction_policies(trace_file, cache=None, size=None, time=None,
+                              **kwargs):
+    """ replay trace against each eviction policy
+
+    cache size and lock time default to the cache's config """
+    config = Cache(cache).config
+    if size is None:
+        if 'cache_size' not in config:
+            raise Exception("No cache_size configured, please give a size "
+                            "to simulate")
+        size = config['cache_size']
+    if time is None:
+        time = config['cache_time']
+    return compare_policies(trace_file, size, parse_slurm_time(time))
+
+def report_access_log(cache=None, top=10, **kwargs):
+    """ summarize hits, misses, and bytes moved from the cache's access log
+    (including rotated logs) """
+    log_files = get_log_files(Cache(cache).access_log.log_file)
+    return summarize_access_log(read_access_log(log_files), int(top))
+
+def trim_cache(cache=None, force=False, dry_run=False, **kwargs):
+    """ evict expired assets down to the low watermark, return bytes freed
+
+    with force, trim even if usage is under the high watermark """
+    return Cache(cache).trim_to_watermark(force=force, dry_run=dry_run)
+
+def reconcile(cache=None, dry_run=False, threads=8, **kwargs):
+    """ check the asset list against the disk and fix it (see manage.py)
+
+    returns lists of problems found """
+    return reconcile_cache(cache, dry_run=dry_run, threads=int(threads))
+
+def verify(target_urls=None, cache=None, threads=8, purge=False,
+           dry_run=False, **kwargs):
+    """ check cached files against their checksums (see manage.py)
+
+    with purge, corrupt assets are removed from the cache """
+    return verify_cache(cache, targets=target_urls or None,
+                        threads=int(threads), purge=purge, dry_run=dry_run)
+
+def free_space(space_to_free, cache=None, atype=None, suffix=None,
+               prefix=None, force=False, dry_run=False, **kwargs):
+    """ delete files to free space_to_free bytes (eg: 100G)
+
+    only expired files are deleted unless force is True
+
+    returns: list of dicts describing the files deleted (or to be deleted) """
+    plan = delete_enough_files(space_to_free, suffix=suffix, atype=atype,
+                               prefix=prefix, cache_root=cache,
+                               include_locked=force, dry_run=dry_run)
+    return [{'target': asset.target,
+             'type': asset.metadata.atype,
+             'size': asset.size,
+             'lock': asset.lock_date} for asset in plan]
+
+def export_metrics(cache=None, **kwargs):
+    """ write Prometheus metrics to the configured metrics_file
+
+    If no metrics_file is configured, nothing is written and the metrics text
+    is returned instead. """
+    cache = Cache(cache)
+    metrics_file = cache.config.get('cache_metrics_file', None)
+    if metrics_file is None:
+        return cache.export_metrics('-')
+    cache.export_metrics(metrics_file)
+    return None
@@ -1,33 +1,149 @@
 """
 Functions for managing and debugging a stagecache cache
+
+plan_eviction() picks assets to delete to free a given amount of space
+(optionally filtered by suffix, asset type, or path prefix) and
+execute_eviction() deletes them with a single update of the asset list.
+
+reconcile_cache() checks that the asset_list matches what is on disk and
+fixes it. The cache roots are scanned with os.scandir in a pool of threads
+and it looks for:
+
+    unlisted:  assets with metadata and files that are not in the asset_list
+    missing:   listed assets whose metadata or files are gone
+    orphans:   .stagecache.* dirs for assets that aren't cached
+    stale locks: write_locks older than lock_age
+    size mismatches: recorded size differs from the files on disk
+
+The asset_list is then rewritten in one atomic replace.
 """
+import logging
 import os, re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from jme.stagecache.cache import Cache
+from jme.stagecache.local_copy import is_temp_file
+from jme.stagecache.target import collect_target_files, \
+                                  CollectTargetFilesException
+from jme.stagecache.text_metadata import TargetMetadata, get_cached_target
+from jme.stagecache.util import parse_bytes
 
-def delete_enough_files(gigs_to_free, suffix=None, cache_root=None):
-    """ detlete enough file to free up the requested number of GB of space
+LOGGER = logging.getLogger(name='manage')
 
-    optinally specify a suffix and only delete matching files """
-    cache = Cache(cache_root)
+STALE_LOCK_AGE = 24 * 60 * 60
+# the journal, index, metrics and transfer locks are flocks, released when
+#  their process dies, and their files are always there
+GLOBAL_LOCKS = ['write_lock', ]
+
+def plan_eviction(cache, space_to_free, suffix=None, atype=None,
+                  prefix=None, include_locked=False):
+    """ choose assets to delete to free up space_to_free bytes (eg: 100G)
+
+    optionally only pick assets matching a suffix, asset type, or path prefix
+
+    Expired assets are picked first, in the order of the cache's eviction
+    policy. If include_locked is True, locked assets follow in order of lock
+    date.
+
+    returns: list of AssetStats objects """
+    space_to_free = parse_bytes(space_to_free)
+    now = time.time()
+    expired = []
+    locked = []
+    for asset in cache.iter_asset_stats():
+        if suffix is not None and not asset.target.endswith(suffix):
+            continue
+        if atype is not None and asset.metadata.atype != atype:
+            continue
+        if prefix is not None and not asset.target.startswith(prefix):
+            continue
+        if asset.lock_date > now:
+            locked.append(asset)
+        else:
+            expired.append(asset)
+
+    candidates = cache.order_evictable(expired)
+    if include_locked:
+        candidates.extend(sorted(locked, key=lambda a: a.lock_date))
+
+    plan = []
+    planned_space = 0
+    for asset in candidates:
+        if planned_space >= space_to_free:
+            break
+        plan.append(asset)
+        planned_space += asset.size
+    return plan
+
+def execute_eviction(cache, plan, dry_run=False):
+    """ delete the assets in a plan from plan_eviction()
+
+    Each asset is checked again under the cache lock: it's skipped if it's
+    gone, being copied, or has been locked again since the plan was made. The
+    asset list is only rewritten once.
 
-    # assets sorted by requested lock date
-    all_assets = sorted(
-         cache.metadata.iter_cached_files(),
-         key=lambda a: a.get_last_lock_date())
+    returns: bytes freed and a list of the assets skipped """
+    if dry_run or len(plan) == 0:
+        return sum(asset.size for asset in plan), []
 
-    needed_space = gigs_to_free * pow(1024,3)
+    # copy down a tier before locking the cache, so nobody waits on it
+    if cache.next_tier is not None:
+        listed = set(a[0] for a in cache.metadata.list_assets())
+        for asset in plan:
+            if get_skip_reason(asset, listed) is None:
+                cache.demote(asset.metadata)
 
-    cum_sum = 0
-    count = 0
-    for a in all_assets:
-         if suffix is None or a.cached_target.endswith(suffix):
-             cum_sum += a.get_cached_target_size()[0]
-             count += 0
-             scache.remove_cached_file(a)
-             if cum_sum > needed_space:
-                 break
-     
-    return count 
+    skipped = []
+    with cache.metadata.lock(sleep_interval=0.2):
+        listed = set(a[0] for a in cache.metadata.list_assets())
+        evict = []
+        for asset in plan:
+            reason = get_skip_reason(asset, listed)
+            if reason is not None:
+                LOGGER.warning("Not removing %s: %s", asset.target, reason)
+                skipped.append(asset)
+            else:
+                evict.append(asset)
+
+        space_freed = cache.remove_cached_files([a.metadata for a in evict])
+        for asset in evict:
+            cache.eviction_policy.on_evict(asset)
+            cache.access_log.log(asset.metadata, 'evict', asset.size)
+        cache.eviction_policy.save_state()
+    LOGGER.info("Removed %d files to free %d bytes", len(evict), space_freed)
+    cache.export_metrics()
+    return space_freed, skipped
+
+def get_skip_reason(asset, listed):
+    """ return why a planned eviction should not go ahead (or None)
+
+    listed: target paths in the asset list """
+    target_metadata = asset.metadata
+    if asset.target not in listed:
+        return "no longer cached"
+    if os.path.exists(target_metadata.write_lock):
+        return "in use"
+    # a plan may include locked assets, but not ones locked after planning
+    if target_metadata.get_last_lock_date() != asset.lock_date \
+            and target_metadata.is_lock_valid():
+        return "locked again"
+    return None
+
+def delete_enough_files(space_to_free, suffix=None, atype=None, prefix=None,
+                        cache_root=None, include_locked=False, dry_run=False):
+    """ delete enough files to free up the requested space (eg: 100G)
+
+    optionally specify a suffix, asset type, or path prefix and only delete
+    matching files
+
+    returns: list of AssetStats for the assets deleted (any that were
+    skipped are logged) """
+    cache = Cache(cache_root)
+    plan = plan_eviction(cache, space_to_free, suffix=suffix, atype=atype,
+                         prefix=prefix, include_locked=include_locked)
+    skipped = execute_eviction(cache, plan, dry_run=dry_run)[1]
+    return [asset for asset in plan if asset not in skipped]
 
 
 def find_unlisted_assets(cache_root=None):
@@ -35,10 +151,301 @@ def find_unlisted_assets(cache_root=None):
     are in the cache's asset_list
 
     returns: list of unlisted assets"""
+    report = reconcile_cache(cache_root, dry_run=True)
+    return [a['target'] for a in report['unlisted']]
+
+def reconcile_cache(cache_root=None, dry_run=False, threads=8,
+                    lock_age=STALE_LOCK_AGE):
+    """ compare the asset_list to what is on disk and repair it
+
+    dry_run: just report problems
+    threads: number of threads scanning the disk and checking assets
+    lock_age: write_locks older than this (in seconds) are removed
+
+    returns: dict of lists of problems found """
+    cache = Cache(cache_root)
+    now = time.time()
+    report = {'unlisted': [], 'missing': [], 'orphans': [],
+              'stale_locks': [], 'size_mismatches': [], 'unidentified': [],
+              'listed': 0, 'scanned': 0}
+
+    def is_stale(mtime):
+        return now - mtime > lock_age
+
+    # read the list first, so assets added during the scan aren't missing
+    listed = cache.metadata.list_assets()
+    report['listed'] = len(listed)
+    listed_paths = set(target for target, atype in listed)
+    with ThreadPoolExecutor(threads) as executor:
+        md_scans = scan_roots(cache.roots, executor)
+        report['scanned'] = len(md_scans)
+
+        # check listed assets against the disk
+        checks = {}
+        for target, atype in listed:
+            md_scan = md_scans.get(target, None)
+            if md_scan is None or 'size' not in md_scan['files']:
+                report['missing'].append({'target': target, 'atype': atype,
+                                          'has_metadata': False})
+            else:
+                checks[target] = executor.submit(check_asset_files, cache,
+                                                 target, atype, md_scan)
+        for target, check in checks.items():
+            result = check.result()
+            if result['actual'] is None:
+                report['missing'].append({'target': target,
+                                          'atype': result['atype'],
+                                          'has_metadata': True})
+            elif result['actual'] != result['recorded']:
+                report['size_mismatches'].append(result)
+
+    for md_scan in md_scans.values():
+        write_lock = md_scan['files'].get('write_lock', None)
+        if write_lock is not None:
+            if is_stale(write_lock):
+                report['stale_locks'].append(
+                    os.path.join(md_scan['md_dir'], 'write_lock'))
+            else:
+                # in use, leave it alone
+                continue
+        if md_scan['target'] in listed_paths:
+            continue
+        md_files = set(md_scan['files']) - set(['write_lock', ])
+        if 'size' in md_files and 'cache_lock' in md_files:
+            atype = identify_type(cache, md_scan['target'], md_scan['root'])
+            if atype is not None:
+                report['unlisted'].append({'target': md_scan['target'],
+                                           'atype': atype})
+            else:
+                # a real asset, but we can't list it without its type
+                report['unidentified'].append(md_scan['target'])
+            continue
+        elif md_files == set(['log', ]):
+            # just the history of an evicted asset
+            continue
+        report['orphans'].append(md_scan['md_dir'])
+
+    for lock_name in GLOBAL_LOCKS:
+        lock_file = os.path.join(cache.metadata.md_dir, lock_name)
+        if os.path.exists(lock_file) and \
+                is_stale(os.path.getmtime(lock_file)):
+            report['stale_locks'].append(lock_file)
+
+    LOGGER.info("Scanned %d assets (%d listed): %s", report['scanned'],
+                report['listed'],
+                ", ".join("{} {}".format(len(v), k) \
+                          for k, v in report.items() if isinstance(v, list)))
+    if not dry_run:
+        repair_cache(cache, report)
+    return report
+
+def repair_cache(cache, report):
+    """ fix the problems found by reconcile_cache() """
+    for lock_file in report['stale_locks']:
+        LOGGER.warning("Removing stale lock: %s", lock_file)
+        try:
+            os.remove(lock_file)
+        except FileNotFoundError:
+            pass
+
+    # a copy of the wrong size is probably cut short, so drop it to be
+    #  copied again
+    corrupt = []
+    for mismatch in report['size_mismatches']:
+        target_metadata = TargetMetadata(cache, mismatch['target'],
+                                         mismatch['atype'])
+        if os.path.exists(target_metadata.write_lock):
+            LOGGER.warning("Not removing %s (size %d, expected %d): it's "
+                           "being copied", mismatch['target'],
+                           mismatch['actual'], mismatch['recorded'])
+            continue
+        LOGGER.warning("Removing %s: size %d, expected %d",
+                       mismatch['target'], mismatch['actual'],
+                       mismatch['recorded'])
+        corrupt.append(target_metadata)
+    if corrupt:
+        with cache.metadata.lock(sleep_interval=0.2):
+            cache.remove_cached_files(corrupt)
+        for target_metadata in corrupt:
+            cache.access_log.log(target_metadata, 'purge')
+
+    for md_dir in report['orphans']:
+        LOGGER.warning("Removing orphaned metadata: %s", md_dir)
+        shutil.rmtree(md_dir, ignore_errors=True)
+
+    missing = []
+    unlisted = [(a['target'], a['atype']) for a in report['unlisted']]
+    if report['missing'] or unlisted:
+        with cache.metadata.lock(sleep_interval=0.2):
+            # it may have been (re)copied since we looked
+            missing = [a for a in report['missing'] \
+                       if is_still_missing(cache, a)]
+            missing_paths = set(a['target'] for a in missing)
+            # re-read the list in case it changed while we were scanning
+            asset_list = [a for a in cache.metadata.list_assets() \
+                          if a[0] not in missing_paths]
+            listed = set(a[0] for a in asset_list)
+            asset_list.extend(a for a in unlisted if a[0] not in listed)
+            cache.metadata.write_asset_list(asset_list)
+
+    for asset in missing:
+        LOGGER.warning("Removed missing asset from list: %s",
+                       asset['target'])
+        if asset['has_metadata']:
+            # archive the size and lock like an eviction would
+            target_metadata = TargetMetadata(cache, asset['target'],
+                                             asset['atype'])
+            target_metadata.remove_target()
+    for target, atype in unlisted:
+        LOGGER.warning("Added unlisted asset to list: %s (%s)",
+                       target, atype)
+
+    # the index may have been written by an older version
+    with cache.index.lock(sleep_interval=0.01):
+        cache.index.rebuild()
+
+def is_still_missing(cache, asset):
+    """ check a missing asset from reconcile_cache() again (call with the
+    cache lock held) """
+    target_metadata = TargetMetadata(cache, asset['target'], asset['atype'])
+    if os.path.exists(target_metadata.write_lock):
+        # being copied
+        return False
+    if not os.path.exists(os.path.join(target_metadata.md_dir, 'size')):
+        return True
+    if not asset['has_metadata']:
+        # it's been added since
+        return False
+    return len(cache.get_cached_files(target_metadata)) == 0
+
+def verify_cache(cache_root=None, targets=None, threads=8, purge=False,
+                 dry_run=False):
+    """ check cached files against their checksums (see checksum.py)
+
+    targets: only check these target paths
+    threads: number of assets to hash at once
+    purge: remove corrupt assets (so they are copied again next time)
+
+    returns: dict with the number of assets that are ok and lists of the
+    corrupt ones, the ones with no checksums, and the ones in use """
     cache = Cache(cache_root)
-    assets_on_disk = find_assets_in_dir(cache.cache_root)
-    listed_assets = cache.inspect_cache()['files']
-    return [a for a in assets_on_disk if a not in listed_assets]
+    listed = cache.metadata.list_assets()
+    if targets is not None:
+        targets = set(targets) | set(os.path.abspath(t) for t in targets)
+        listed = [(t, a) for t, a in listed if t in targets]
+    report = {'checked': 0, 'ok': 0, 'corrupt': [], 'unchecked': [],
+              'busy': []}
+
+    def check(target, atype):
+        target_metadata = TargetMetadata(cache, target, atype)
+        if os.path.exists(target_metadata.write_lock):
+            # being copied right now
+            return target_metadata, 'busy', []
+        return (target_metadata, ) + cache.verify_asset(target_metadata)
+
+    with ThreadPoolExecutor(threads) as executor:
+        checks = [executor.submit(check, target, atype) \
+                  for target, atype in listed]
+        for next_check in checks:
+            target_metadata, status, bad_files = next_check.result()
+            if status == 'busy':
+                report['busy'].append(target_metadata.target_path)
+                continue
+            report['checked'] += 1
+            if status == 'ok':
+                report['ok'] += 1
+            elif status == 'unchecked':
+                report['unchecked'].append(target_metadata.target_path)
+            else:
+                LOGGER.warning("%s is corrupt: %s",
+                               target_metadata.target_path,
+                               ", ".join(bad_files))
+                report['corrupt'].append({
+                    'target': target_metadata.target_path,
+                    'atype': target_metadata.atype,
+                    'files': bad_files})
+
+    if purge and not dry_run and report['corrupt']:
+        corrupt = [TargetMetadata(cache, c['target'], c['atype']) \
+                   for c in report['corrupt']]
+        with cache.metadata.lock(sleep_interval=0.2):
+            cache.remove_cached_files(corrupt)
+        for target_metadata in corrupt:
+            cache.access_log.log(target_metadata, 'purge')
+        cache.export_metrics()
+    return report
+
+def scan_roots(roots, executor):
+    """ find every .stagecache.* dir under the roots
+
+    returns: dict from target path to scan_md_dir() results """
+    md_scans = {}
+    pending = set(executor.submit(scan_dir, root, root) for root in roots)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            root, subdirs, md_dir_scans = future.result()
+            for md_scan in md_dir_scans:
+                # an asset is in one root, the first one wins
+                md_scans.setdefault(md_scan['target'], md_scan)
+            pending.update(executor.submit(scan_dir, root, subdir) \
+                           for subdir in subdirs)
+    return md_scans
+
+def scan_dir(root, path):
+    """ list one directory
+
+    returns: root, subdirectories to scan, and metadata dirs found """
+    subdirs = []
+    md_dir_scans = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if entry.name.startswith('.stagecache.'):
+                    if path == root and entry.name == '.stagecache.global':
+                        continue
+                    md_dir_scans.append(scan_md_dir(root, path, entry))
+                else:
+                    subdirs.append(entry.path)
+    except FileNotFoundError:
+        # deleted while we were looking
+        pass
+    return root, subdirs, md_dir_scans
+
+def scan_md_dir(root, path, md_entry):
+    """ return target path, root, md dir, and the md files with mtimes """
+    files = {}
+    with os.scandir(md_entry.path) as entries:
+        for entry in entries:
+            try:
+                files[entry.name] = entry.stat().st_mtime
+            except FileNotFoundError:
+                pass
+    target = os.path.join(path, md_entry.name[12:])[len(root):]
+    return {'target': target,
+            'root': root,
+            'md_dir': md_entry.path,
+            'files': files}
+
+def check_asset_files(cache, target, atype, md_scan):
+    """ compare the recorded size of an asset to its files (not counting
+    temp files left by copies)
+
+    actual is None if any files are missing """
+    with open(os.path.join(md_scan['md_dir'], 'size')) as size_handle:
+        recorded = int(size_handle.read().strip())
+    cached_target = get_cached_target(md_scan['root'], target)
+    try:
+        files = collect_target_files(os, cached_target,
+                                     cache.asset_types[atype])
+        actual = sum(f['size'] for path, f in files.items() \
+                     if not is_temp_file(path)) if files else None
+    except (CollectTargetFilesException, KeyError):
+        actual = None
+    return {'target': target, 'atype': atype, 'recorded': recorded,
+            'actual': actual}
 
 def find_assets_in_dir(root_dir):
     for current_root, dir_list, file_list in os.walk(root_dir):
@@ -50,6 +457,23 @@ def find_assets_in_dir(root_dir):
                 if os.path.exists(os.path.join(current_root, d, 'cache_lock')):
                     yield os.path.join(current_root, d[12:])[len(root_dir):]
 
+def identify_type(cache, target, root):
+    """ return the type of an unlisted asset from the index (or a guess
+    from its files), or None if it isn't one of the cache's asset types """
+    record = cache.index.get(target)
+    for atype in [None if record is None else record.atype,
+                  guess_type(target, root)]:
+        if atype is None:
+            continue
+        if atype in cache.asset_types:
+            return atype
+        # long names are cut short in the index
+        matches = [name for name in cache.asset_types \
+                   if name.startswith(atype)]
+        if record is not None and atype == record.atype and len(matches) == 1:
+            return matches[0]
+    return None
+
 def guess_type(asset, root):
       local_asset = root + asset
       if os.path.exists(local_asset):
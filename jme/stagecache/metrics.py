@@ -0,0 +1,211 @@
+"""
+Export cache state and activity for the node_exporter textfile collector.
+
+Set the output path in the config (globally or per cache):
+
+cache_metrics_file: /var/lib/node_exporter/textfile/stagecache.prom
+caches:
+    scratch:
+        root: /scratch/stagecache
+        metrics_file: /var/lib/node_exporter/textfile/scratch.prom
+
+The file is rewritten atomically after every request and whenever
+`stagecache --metrics` is run (eg from cron).
+
+Gauges come from inspect_cache(). Counters and the lock wait histogram are
+accumulated from the access log (see access_log.py). The position reached in
+the log is saved in .stagecache.global/metrics_state, so each update only
+reads new lines. If the log was rotated since the last update, the rest of the
+rotated file is read first.
+"""
+import json
+import logging
+import os
+import time
+from jme.stagecache.access_log import parse_access_log_lines
+from jme.stagecache.text_metadata import Lockable
+
+LOGGER = logging.getLogger(name='metrics')
+
+PREFIX = 'stagecache_'
+LOCK_WAIT_BUCKETS = [0.1, 1, 10, 60, 300, 1800]
+COUNTERS = {
+    'requests_total': 'Requests by outcome',
+    'evictions_total': 'Assets deleted to make space',
+    'purges_total': 'Assets deleted on request',
+    'demotions_total': 'Assets moved in from a faster tier',
+    'transfer_bytes_total': 'Bytes copied into the cache',
+    'transfer_seconds_total': 'Time spent copying into the cache',
+    'hit_bytes_total': 'Bytes served from cache without copying',
+}
+
+def new_counters():
+    return {
+        'requests_total': {'hit': 0, 'miss': 0, 'refresh': 0, 'error': 0},
+        'evictions_total': 0,
+        'purges_total': 0,
+        'demotions_total': 0,
+        'transfer_bytes_total': 0,
+        'transfer_seconds_total': 0.0,
+        'hit_bytes_total': 0,
+        'lock_wait_buckets': [0] * len(LOCK_WAIT_BUCKETS),
+        'lock_wait_sum': 0.0,
+        'lock_wait_count': 0,
+    }
+
+def count_event(counters, event):
+    """ add one access log event to counters """
+    outcome = event['outcome']
+    if outcome in counters['requests_total']:
+        counters['requests_total'][outcome] += 1
+        counters['lock_wait_sum'] += event['lock_wait']
+        counters['lock_wait_count'] += 1
+        for i, bound in enumerate(LOCK_WAIT_BUCKETS):
+            if event['lock_wait'] <= bound:
+                counters['lock_wait_buckets'][i] += 1
+    if outcome in ['miss', 'refresh']:
+        counters['transfer_bytes_total'] += event['bytes']
+        counters['transfer_seconds_total'] += event['copy_time']
+    elif outcome == 'hit':
+        counters['hit_bytes_total'] += event['bytes']
+    elif outcome == 'evict':
+        counters['evictions_total'] += 1
+    elif outcome == 'purge':
+        counters['purges_total'] += 1
+    elif outcome == 'demote':
+        counters['demotions_total'] += 1
+
+class MetricsExporter(Lockable):
+    """ keeps running counters for a cache and writes the textfile """
+    use_flock = True
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.cache = cache
+        md_dir = cache.metadata.md_dir
+        self.state_file = os.path.join(md_dir, 'metrics_state')
+        self.write_lock = os.path.join(md_dir, 'metrics_lock')
+        self.log_file = cache.access_log.log_file
+
+    def load_state(self):
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as state_handle:
+                return json.load(state_handle)
+        return {'inode': None, 'offset': 0, 'counters': new_counters()}
+
+    def save_state(self, state):
+        tmp_file = "{}.{}.tmp".format(self.state_file, os.getpid())
+        with open(tmp_file, 'wt') as state_handle:
+            json.dump(state, state_handle)
+        os.chmod(tmp_file, self.umask)
+        os.replace(tmp_file, self.state_file)
+
+    def update_counters(self):
+        """ read new access log lines into saved counters, return counters """
+        state = self.load_state()
+        counters = state['counters']
+        # state may be from before a counter was added
+        for name, value in new_counters().items():
+            counters.setdefault(name, value)
+        if not os.path.exists(self.log_file):
+            return counters
+
+        log_stat = os.stat(self.log_file)
+        if state['inode'] != log_stat.st_ino or \
+                log_stat.st_size < state['offset']:
+            # log was rotated, finish reading the old one if it's there
+            rotated = self.log_file + '.1'
+            if state['inode'] is not None and os.path.exists(rotated) and \
+                    os.stat(rotated).st_ino == state['inode']:
+                self.read_events(rotated, state['offset'], counters)
+            state['offset'] = 0
+            state['inode'] = log_stat.st_ino
+
+        state['offset'] = self.read_events(self.log_file, state['offset'],
+                                           counters)
+        self.save_state(state)
+        return counters
+
+    def read_events(self, log_file, offset, counters):
+        """ count events in log_file after offset, return new offset """
+        with open(log_file, 'rt') as log_handle:
+            log_handle.seek(offset)
+            lines = []
+            for line in iter(log_handle.readline, ''):
+                if not line.endswith('\n'):
+                    # partial line, get it next time
+                    break
+                lines.append(line)
+                offset = log_handle.tell()
+        for event in parse_access_log_lines(lines):
+            count_event(counters, event)
+        return offset
+
+    def get_metrics_text(self):
+        """ return the metrics in Prometheus text format """
+        with self.lock(sleep_interval=0.1):
+            counters = self.update_counters()
+        cache_data = self.cache.inspect_cache()
+        now = time.time()
+        expired_bytes = sum(f['size'] for f in cache_data['files'].values() \
+                            if isinstance(f['lock'], (int, float)) \
+                            and f['lock'] < now)
+        label = '{{cache="{}"}}'.format(self.cache.cache_root)
+
+        lines = []
+        def add_metric(name, metric_type, help_text, values):
+            lines.append("# HELP {}{} {}".format(PREFIX, name, help_text))
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, metric_type))
+            for labels, value in values:
+                lines.append("{}{}{} {}".format(PREFIX, name, labels, value))
+
+        add_metric('used_bytes', 'gauge', 'Bytes used by cached assets',
+                   [(label, cache_data['used'])])
+        add_metric('free_bytes', 'gauge', 'Bytes available in the cache',
+                   [(label, cache_data['free'])])
+        add_metric('assets', 'gauge', 'Number of cached assets',
+                   [(label, len(cache_data['files']))])
+        add_metric('expired_bytes', 'gauge',
+                   'Bytes used by assets whose lock has expired',
+                   [(label, expired_bytes)])
+
+        add_metric('requests_total', 'counter', COUNTERS['requests_total'],
+                   [('{{cache="{}",outcome="{}"}}'.format(
+                       self.cache.cache_root, outcome), count)
+                    for outcome, count in counters['requests_total'].items()])
+        for name in ['evictions_total', 'purges_total', 'demotions_total',
+                     'transfer_bytes_total', 'transfer_seconds_total',
+                     'hit_bytes_total']:
+            add_metric(name, 'counter', COUNTERS[name],
+                       [(label, counters[name])])
+
+        buckets = []
+        for bound, count in zip(LOCK_WAIT_BUCKETS,
+                                counters['lock_wait_buckets']):
+            buckets.append(('{{cache="{}",le="{}"}}'.format(
+                self.cache.cache_root, bound), count))
+        buckets.append(('{{cache="{}",le="+Inf"}}'.format(
+            self.cache.cache_root), counters['lock_wait_count']))
+        add_metric('lock_wait_seconds', 'histogram',
+                   'Time requests spent waiting for locks', [])
+        lines.extend("{}lock_wait_seconds_bucket{} {}".format(PREFIX, l, v) \
+                     for l, v in buckets)
+        lines.append("{}lock_wait_seconds_sum{} {}".format(
+            PREFIX, label, counters['lock_wait_sum']))
+        lines.append("{}lock_wait_seconds_count{} {}".format(
+            PREFIX, label, counters['lock_wait_count']))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_file):
+        """ atomically replace metrics_file with current metrics
+
+        returns the metrics text """
+        text = self.get_metrics_text()
+        tmp_file = "{}.{}.tmp".format(metrics_file, os.getpid())
+        with open(tmp_file, 'wt') as metrics_handle:
+            metrics_handle.write(text)
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, metrics_file)
+        LOGGER.debug("Wrote metrics to %s", metrics_file)
+        return text
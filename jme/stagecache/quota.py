@@ -0,0 +1,146 @@
+"""
+Byte quotas per user and group within a shared cache.
+
+Quotas don't stop anyone from staging files. They change the eviction order:
+when space is needed, expired assets of owners who are over quota go first
+(in the order of the cache's eviction policy) until those owners would be
+back under quota. Then the rest go in the usual order.
+
+Set quotas globally or per cache (user or group names, or numeric ids):
+
+cache_quotas:
+    users:
+        jmeppley: 500G
+        default: 200G
+    groups:
+        lab: 1T
+
+A 'default' applies to every user (or group) without a quota of their own.
+
+The owner of an asset is the user (and primary group) who last copied it
+into the cache. It is saved with the asset's metadata (see text_metadata.py)
+and in the asset index (see index.py). Assets cached before owners were
+recorded are attributed to the owner of the cached file.
+"""
+import grp
+import logging
+import pwd
+from jme.stagecache.util import parse_bytes
+
+LOGGER = logging.getLogger(name='quota')
+
+OWNER_KINDS = {'users': (pwd.getpwnam, 'pw_uid', pwd.getpwuid, 'pw_name'),
+               'groups': (grp.getgrnam, 'gr_gid', grp.getgrgid, 'gr_name')}
+
+def lookup_id(kind, name):
+    """ return numeric id for a user or group name (or id) """
+    if isinstance(name, int) or str(name).isdigit():
+        return int(name)
+    get_entry, id_field = OWNER_KINDS[kind][:2]
+    return getattr(get_entry(name), id_field)
+
+def lookup_name(kind, owner_id):
+    """ return the name for a user or group id (or the id as a string) """
+    get_entry, name_field = OWNER_KINDS[kind][2:]
+    try:
+        return getattr(get_entry(owner_id), name_field)
+    except (KeyError, OverflowError):
+        return str(owner_id)
+
+def add_usage(usage, record):
+    """ add an IndexRecord's size to its owners in {(kind, id): bytes} """
+    for kind, owner_id in (('users', record.uid), ('groups', record.gid)):
+        usage[(kind, owner_id)] = usage.get((kind, owner_id), 0) + record.size
+
+class Quotas():
+    """ quotas for one cache """
+    def __init__(self, quota_config=None):
+        self.limits = {}
+        self.defaults = {}
+        if quota_config is None:
+            quota_config = {}
+        for kind, limits in quota_config.items():
+            if kind not in OWNER_KINDS:
+                raise Exception("Unknown quota type: {}. Use one of: {}"\
+                                .format(kind, ", ".join(OWNER_KINDS)))
+            self.limits[kind] = {}
+            for name, limit in limits.items():
+                if name == 'default':
+                    self.defaults[kind] = parse_bytes(limit)
+                    continue
+                try:
+                    owner_id = lookup_id(kind, name)
+                except KeyError:
+                    LOGGER.warning("Ignoring quota for unknown %s: %s",
+                                   kind[:-1], name)
+                    continue
+                self.limits[kind][owner_id] = parse_bytes(limit)
+
+    def __bool__(self):
+        return bool(self.defaults) or \
+                any(len(limits) > 0 for limits in self.limits.values())
+
+    def get_limit(self, kind, owner_id):
+        """ return quota in bytes or None """
+        if owner_id < 0:
+            # unknown owner
+            return None
+        return self.limits.get(kind, {}).get(owner_id,
+                                             self.defaults.get(kind, None))
+
+    def get_usage(self, records):
+        """ return {(kind, id): bytes} for IndexRecords """
+        usage = {}
+        for record in records:
+            add_usage(usage, record)
+        return usage
+
+    def get_overages(self, records):
+        """ return {(kind, id): bytes over quota} for owners over quota """
+        overages = {}
+        for (kind, owner_id), used in self.get_usage(records).items():
+            limit = self.get_limit(kind, owner_id)
+            if limit is not None and used > limit:
+                overages[(kind, owner_id)] = used - limit
+        return overages
+
+    def order(self, assets, records):
+        """ move assets of owners over quota to the front (keeping the
+        given order) until their owners would be back under quota
+
+        assets: AssetStats in eviction order
+        records: IndexRecords of every asset in the cache """
+        if not self:
+            return assets
+        overages = self.get_overages(records)
+        if not overages:
+            return assets
+        first, rest = [], []
+        for asset in assets:
+            owners = [('users', asset.uid), ('groups', asset.gid)]
+            if any(overages.get(owner, 0) > 0 for owner in owners):
+                first.append(asset)
+                for owner in owners:
+                    if owner in overages:
+                        overages[owner] -= asset.size
+            else:
+                rest.append(asset)
+        LOGGER.debug("%d assets of owners over quota go first", len(first))
+        return first + rest
+
+    def report(self, records=None, usage=None):
+        """ return usage and quota for each owner with assets or a quota
+
+        give the IndexRecords or their usage (see add_usage) """
+        if usage is None:
+            usage = self.get_usage(records)
+        report = {}
+        for kind in OWNER_KINDS:
+            owners = set(owner_id for k, owner_id in usage if k == kind)
+            owners.update(self.limits.get(kind, {}))
+            report[kind] = {}
+            for owner_id in sorted(owners):
+                report[kind][lookup_name(kind, owner_id)] = {
+                    'used': usage.get((kind, owner_id), 0),
+                    'quota': self.get_limit(kind, owner_id)}
+        return report
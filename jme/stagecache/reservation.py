@@ -0,0 +1,139 @@
+"""
+Reserve cache space for copies in progress.
+
+When a copy is about to start, a reservation file is written to
+{cache_root}/.stagecache.global/reservations/ with the target path, the
+number of bytes to set aside, and when the reservation times out. Reserved
+bytes are taken out of the free space seen by every process (see
+Cache.inspect_cache()), so concurrent copies can't overcommit the cache even
+when it has no cache_size and the copies haven't written anything yet.
+
+The asset is only added to the asset list once the copy succeeds, then the
+reservation is released. If the copy fails, the reservation is just released.
+
+Reservation files are named {node}.{pid}.{count}. A reservation whose process
+is gone (only checked for processes on this node) or that has timed out is
+deleted by the next process to look. Set the timeout per cache:
+
+cache_reservation_timeout: 1-0:00
+"""
+import itertools
+import logging
+import os
+import socket
+import time
+from jme.stagecache.text_metadata import Lockable, makedirs
+
+LOGGER = logging.getLogger(name='reservation')
+
+DEFAULT_TIMEOUT = 24 * 60 * 60
+
+class Reservation():
+    """ space set aside for one copy """
+    def __init__(self, reservation_file, target_path, size, expires):
+        self.reservation_file = reservation_file
+        self.target_path = target_path
+        self.size = int(size)
+        self.expires = float(expires)
+
+        node, pid, _ = os.path.basename(reservation_file).rsplit('.', 2)
+        self.node = node
+        self.pid = int(pid)
+
+    def write(self, umask):
+        tmp_file = "{}.tmp".format(self.reservation_file)
+        with open(tmp_file, 'wt') as reservation_handle:
+            reservation_handle.write("\t".join((self.target_path,
+                                                str(self.size),
+                                                str(self.expires))) + "\n")
+        os.chmod(tmp_file, umask)
+        os.replace(tmp_file, self.reservation_file)
+
+    @classmethod
+    def read(cls, reservation_file):
+        with open(reservation_file) as reservation_handle:
+            fields = reservation_handle.readline().rstrip('\n').split('\t')
+        return cls(reservation_file, *fields)
+
+    def is_stale(self, now=None):
+        """ True if the reservation timed out or its process is gone """
+        if now is None:
+            now = time.time()
+        if self.expires < now:
+            return True
+        if self.node != socket.gethostname():
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # someone else's process, but it's alive
+            pass
+        return False
+
+
+class Reservations(Lockable):
+    """ the reservations in one cache """
+
+    # shared by threads, next() on a count is atomic
+    reservation_count = itertools.count(1)
+
+    def __init__(self, cache, timeout=None):
+        super().__init__(cache)
+        self.md_dir = os.path.join(cache.metadata.md_dir, 'reservations')
+        self.timeout = DEFAULT_TIMEOUT if timeout is None else timeout
+
+    def reserve(self, target_path, size):
+        """ set aside size bytes for target_path, returns the Reservation """
+        if not os.path.exists(self.md_dir):
+            makedirs(self.md_dir, self.umask_dir)
+        reservation_file = os.path.join(self.md_dir, "{}.{}.{}".format(
+            socket.gethostname(), os.getpid(),
+            next(Reservations.reservation_count)))
+        reservation = Reservation(reservation_file, target_path, size,
+                                  time.time() + self.timeout)
+        reservation.write(self.umask)
+        LOGGER.debug("Reserved %d bytes for %s", size, target_path)
+        return reservation
+
+    def release(self, reservation):
+        """ give back the space (it's fine if it's already gone) """
+        if reservation is None:
+            return
+        try:
+            os.remove(reservation.reservation_file)
+        except FileNotFoundError:
+            pass
+        LOGGER.debug("Released %d bytes for %s", reservation.size,
+                     reservation.target_path)
+
+    def get_reservations(self):
+        """ return live Reservations, deleting stale ones """
+        try:
+            names = os.listdir(self.md_dir)
+        except FileNotFoundError:
+            return []
+        now = time.time()
+        reservations = []
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            reservation_file = os.path.join(self.md_dir, name)
+            try:
+                reservation = Reservation.read(reservation_file)
+            except (FileNotFoundError, ValueError, TypeError):
+                # released or half written
+                continue
+            if reservation.is_stale(now):
+                LOGGER.warning("Releasing stale reservation of %d bytes "
+                               "for %s", reservation.size,
+                               reservation.target_path)
+                self.release(reservation)
+                continue
+            reservations.append(reservation)
+        return reservations
+
+    def get_reserved(self):
+        """ return total bytes reserved """
+        return sum(r.size for r in self.get_reservations())
@@ -0,0 +1,276 @@
+"""
+Share transfer slots and bandwidth between all processes using a cache.
+
+Each process that wants to copy something into the cache leaves a ticket in
+{cache_root}/.stagecache.global/transfers/ and waits until its ticket is at
+the head of the queue and there is a free slot for its host. Tickets are
+ordered by priority (higher first), then size (smaller first), then age.
+Tickets that have waited longer than the aging time go to the front, so big
+transfers are not starved.
+
+If a total bandwidth is configured, a starting transfer gets an even share
+of it (split between the transfers running then), but no more than the
+running transfers have left unallocated (rsync --bwlimit). If they have
+allocated all of it, it waits.
+
+While a process waits or copies, it touches its ticket every timeout / 3
+seconds. A ticket that hasn't been touched for the timeout, or whose process
+is gone (only checked for processes on this node), is deleted by the next
+process to look, so crashed processes on other nodes don't hold slots.
+
+Configure with:
+
+transfers:
+    slots: 8            # concurrent transfers from all hosts
+    per_host: 2         # concurrent transfers from any one host
+    bandwidth: 1e9      # total bytes per second
+    aging: 600          # seconds
+    timeout: 900        # seconds
+remote:
+    SFTP:
+        nas.hawaii.edu:
+            max_transfers: 4   # overrides per_host for this host
+
+Nothing is queued unless at least one limit is configured.
+"""
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from jme.stagecache.text_metadata import Lockable, makedirs
+
+LOGGER = logging.getLogger(name='scheduler')
+
+DEFAULT_AGING = 600
+DEFAULT_TIMEOUT = 15 * 60
+
+class Ticket():
+    """ one process's request for a transfer slot """
+    def __init__(self, ticket_file, host, size, priority, requested,
+                 state='waiting', allocation=0, mtime=None):
+        self.ticket_file = ticket_file
+        self.host = host
+        self.size = int(size)
+        self.priority = int(priority)
+        self.requested = float(requested)
+        self.state = state
+        # bandwidth (bytes/s) given to the transfer once active
+        self.allocation = float(allocation)
+        # when the ticket was last written or touched
+        self.mtime = time.time() if mtime is None else mtime
+
+        # ticket files are named {node}.{pid}.{count}
+        node, pid, _ = os.path.basename(ticket_file).rsplit('.', 2)
+        self.node = node
+        self.pid = int(pid)
+
+    def write(self, umask):
+        with open(self.ticket_file, 'wt') as ticket_handle:
+            ticket_handle.write("\t".join((self.host,
+                                           str(self.size),
+                                           str(self.priority),
+                                           str(self.requested),
+                                           self.state,
+                                           str(self.allocation))) + "\n")
+        os.chmod(self.ticket_file, umask)
+
+    def touch(self, umask):
+        """ show we're still alive (rewrite the ticket if it was removed) """
+        try:
+            os.utime(self.ticket_file)
+        except FileNotFoundError:
+            self.write(umask)
+
+    @classmethod
+    def read(cls, ticket_file):
+        with open(ticket_file) as ticket_handle:
+            fields = ticket_handle.readline().strip().split('\t')
+            mtime = os.fstat(ticket_handle.fileno()).st_mtime
+        return cls(ticket_file, *fields, mtime=mtime)
+
+    def is_stale(self, timeout=DEFAULT_TIMEOUT, now=None):
+        """ True if the ticket hasn't been touched for timeout seconds or
+        its process is gone
+
+        We can only check processes on this node """
+        if now is None:
+            now = time.time()
+        if now - self.mtime > timeout:
+            return True
+        if self.node != socket.gethostname():
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # someone else's process, but it's alive
+            pass
+        return False
+
+    def sort_key(self, now, aging):
+        aged = now - self.requested > aging
+        return (not aged, -self.priority, self.size, self.requested)
+
+
+class TransferQueue(Lockable):
+    """ node-wide queue of transfers into one cache """
+
+    # shared by threads, next() on a count is atomic
+    ticket_count = itertools.count(1)
+    use_flock = True
+
+    def __init__(self, cache):
+        super().__init__(cache)
+        self.config = cache.config
+        transfer_config = self.config.get('transfers', {})
+        self.slots = transfer_config.get('slots', None)
+        self.per_host = transfer_config.get('per_host', None)
+        self.bandwidth = transfer_config.get('bandwidth', None)
+        self.aging = transfer_config.get('aging', DEFAULT_AGING)
+        self.timeout = transfer_config.get('timeout', DEFAULT_TIMEOUT)
+        self.md_dir = os.path.join(cache.metadata.md_dir, 'transfers')
+        self.write_lock = os.path.join(self.md_dir, 'write_lock')
+
+    def is_enabled(self):
+        """ only bother queueing if some limit is set """
+        if self.slots is not None or self.per_host is not None \
+                or self.bandwidth is not None:
+            return True
+        for host_config in self.config.get('remote', {}) \
+                                      .get('SFTP', {}).values():
+            if 'max_transfers' in host_config:
+                return True
+        return False
+
+    def get_host_limit(self, host):
+        """ concurrent transfers allowed from host """
+        return self.config.get('remote', {}) \
+                          .get('SFTP', {}) \
+                          .get(host, {}) \
+                          .get('max_transfers', self.per_host)
+
+    @contextmanager
+    def slot(self, host, size, priority=0, sleep_interval=1, dry_run=False):
+        """ wait for a free transfer slot and hold it in the with block
+
+        yields the bandwidth (in bytes/s) this transfer may use, or None """
+        if dry_run or not self.is_enabled():
+            yield None
+            return
+
+        if not os.path.exists(self.md_dir):
+            makedirs(self.md_dir, self.umask_dir)
+
+        ticket_file = os.path.join(self.md_dir, "{}.{}.{}".format(
+            socket.gethostname(), os.getpid(),
+            next(TransferQueue.ticket_count)))
+        ticket = Ticket(ticket_file, host, size, priority, time.time())
+        try:
+            with self.lock(sleep_interval=0.2):
+                ticket.write(self.umask)
+
+            LOGGER.debug("Waiting for transfer slot for %s", host)
+            while True:
+                with self.lock(sleep_interval=0.2):
+                    tickets = self.load_tickets()
+                    if self.may_start(ticket, tickets):
+                        allocation = self.get_allocation(ticket, tickets)
+                        if allocation is None or allocation > 0:
+                            ticket.state = 'active'
+                            ticket.allocation = allocation or 0
+                            ticket.write(self.umask)
+                            break
+                time.sleep(sleep_interval)
+                ticket.touch(self.umask)
+
+            LOGGER.debug("Transfer slot acquired after %.1f seconds",
+                         time.time() - ticket.requested)
+            with self.heartbeat(ticket):
+                yield allocation
+        finally:
+            try:
+                os.remove(ticket_file)
+            except FileNotFoundError:
+                pass
+
+    def get_allocation(self, ticket, tickets):
+        """ return the bandwidth for ticket if it starts now (None if there's
+        no limit)
+
+        An even share, but no more than the active tickets have left """
+        if self.bandwidth is None:
+            return None
+        active = [t for t in tickets if t.state == 'active' \
+                  and t.ticket_file != ticket.ticket_file]
+        unallocated = float(self.bandwidth) - sum(t.allocation \
+                                                  for t in active)
+        return max(0, min(unallocated,
+                          float(self.bandwidth) / (len(active) + 1)))
+
+    @contextmanager
+    def heartbeat(self, ticket):
+        """ touch the ticket every timeout / 3 seconds in a daemon thread
+        while in the with block """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.timeout / 3):
+                ticket.touch(self.umask)
+
+        thread = threading.Thread(target=beat, name='ticket_heartbeat',
+                                  daemon=True)
+        thread.start()
+        try:
+            yield None
+        finally:
+            stop.set()
+            thread.join()
+
+    def load_tickets(self):
+        """ return tickets of live processes, remove dead or timed out
+        ones """
+        now = time.time()
+        tickets = []
+        for ticket_name in os.listdir(self.md_dir):
+            if ticket_name == 'write_lock':
+                continue
+            ticket_file = os.path.join(self.md_dir, ticket_name)
+            try:
+                ticket = Ticket.read(ticket_file)
+            except (FileNotFoundError, ValueError, TypeError):
+                # removed or half written
+                continue
+            if ticket.is_stale(self.timeout, now):
+                LOGGER.warning("Removing stale transfer ticket: %s",
+                               ticket_name)
+                os.remove(ticket_file)
+                continue
+            tickets.append(ticket)
+        return tickets
+
+    def may_start(self, ticket, tickets):
+        """ True if there is a slot left for us after the tickets ahead of us
+        in line have taken theirs """
+        others = [t for t in tickets if t.ticket_file != ticket.ticket_file]
+        taken = [t for t in others if t.state == 'active']
+
+        # hand out slots in queue order until we get to our ticket
+        now = time.time()
+        waiting = [t for t in others if t.state == 'waiting'] + [ticket, ]
+        for next_ticket in sorted(waiting,
+                                  key=lambda t: t.sort_key(now, self.aging)):
+            if self.slots is not None and len(taken) >= self.slots:
+                return False
+            host_limit = self.get_host_limit(next_ticket.host)
+            if host_limit is not None and \
+                    sum(1 for t in taken \
+                        if t.host == next_ticket.host) >= host_limit:
+                continue
+            if next_ticket is ticket:
+                return True
+            taken.append(next_ticket)
+        return False
@@ -47,9 +47,11 @@ def generate_ssh_keys():
 
 
 @contextmanager
-def passwordless_sftp(host, username):
+def passwordless_sftp(host, username, compress=False):
     """ attempt to connect to host as user
         try all the keys in order returned by generate_ssh_keys
+
+        set compress to True to ask for SSH transport compression
         
         return sftp session object using the first key that works
         """
@@ -57,6 +59,7 @@ def passwordless_sftp(host, username):
     for ssh_key in generate_ssh_keys():
         try:
             transport = paramiko.Transport(host)
+            transport.use_compression(compress)
             transport.connect(username=username, pkey=ssh_key)
         except paramiko.SSHException as e:
             # try another key
@@ -0,0 +1,125 @@
+"""
+Stage many targets at once from asyncio code.
+
+    from jme.stagecache.staging import stage_many
+    paths = await stage_many(['/mnt/nas/genome.fasta',
+                              ('SFTP://server/db/nr', 'lastdb')],
+                             cache='scratch')
+
+or, to use each target as soon as it's ready:
+
+    async for result in iter_stage_many(targets, cache='scratch'):
+        if result.error is None:
+            start_job(result.cached_path)
+
+Targets are URLs/paths or (URL, asset type) tuples. The Cache (and its
+config) is only loaded once. Work is done in a thread pool: up to max_probes
+targets are checked at once (remote file stats and cache lookups, plus the
+whole request if it looks like a hit), and up to max_transfers are copied at
+once. Each request goes through Cache.add_target(), so the usual target and
+cache locks (and the node-wide transfer queue, see scheduler.py) apply.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from jme.stagecache.cache import Cache
+from jme.stagecache.target import get_target
+from jme.stagecache.text_metadata import TargetMetadata
+
+LOGGER = logging.getLogger(name='staging')
+
+class StageResult():
+    """ what happened to one target """
+    def __init__(self, target_url, atype, cached_path=None, error=None):
+        self.target_url = target_url
+        self.atype = atype
+        self.cached_path = cached_path
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return "StageResult({!r}, error={!r})".format(self.target_url,
+                                                         self.error)
+        return "StageResult({!r}, {!r})".format(self.target_url,
+                                                self.cached_path)
+
+def probe_target(cache, target_url, atype):
+    """ build the Target and check for a current copy in the cache
+
+    returns: the Target and True if the request will probably be a hit """
+    asset_type = cache.asset_types.get(atype, None)
+    if asset_type is None:
+        raise Exception("No asset type defined for '{}!'".format(atype))
+    target = get_target(target_url, asset_type, cache.config)
+    target_metadata = TargetMetadata(cache, target.path_string, atype)
+    cache_mtime = target_metadata.get_cached_target_size()[1]
+    return target, cache_mtime is not None \
+            and cache_mtime >= target.get_mtime()
+
+async def iter_stage_many(targets, cache=None, atype='file', time=None,
+                          max_probes=8, max_transfers=4, force=False,
+                          dry_run=False, priority=0):
+    """ stage targets concurrently, yield a StageResult for each as it
+    finishes
+
+    cache: a Cache object or a cache name or root
+    atype: asset type for targets not given as (url, atype) tuples
+    time: cache lifetime (defaults to the cache's config) """
+    loop = asyncio.get_running_loop()
+    if not isinstance(cache, Cache):
+        cache = await loop.run_in_executor(None, Cache, cache)
+
+    probe_slots = asyncio.Semaphore(max_probes)
+    transfer_slots = asyncio.Semaphore(max_transfers)
+    executor = ThreadPoolExecutor(max_probes + max_transfers)
+
+    async def stage_one(target_url, target_atype):
+        try:
+            async with probe_slots:
+                target, is_hit = await loop.run_in_executor(
+                    executor, probe_target, cache, target_url, target_atype)
+            add_target = partial(cache.add_target, target, cache_time=time,
+                                 force=force, dry_run=dry_run,
+                                 priority=priority)
+            slots = probe_slots if is_hit and not force else transfer_slots
+            async with slots:
+                cached_path = await loop.run_in_executor(executor,
+                                                         add_target)
+            return StageResult(target_url, target_atype, cached_path)
+        except Exception as exc:
+            LOGGER.warning("Could not stage %s: %r", target_url, exc)
+            return StageResult(target_url, target_atype, error=exc)
+
+    tasks = []
+    for target in targets:
+        if isinstance(target, str):
+            target = (target, atype)
+        tasks.append(asyncio.ensure_future(stage_one(*target)))
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            yield await next_result
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False)
+
+async def stage_many(targets, cache=None, atype='file', time=None, **kwargs):
+    """ stage targets concurrently (see iter_stage_many for options)
+
+    returns: dict from target URL to cached path
+    raises an Exception after all are done if any failed """
+    cached_paths = {}
+    failures = []
+    async for result in iter_stage_many(targets, cache=cache, atype=atype,
+                                        time=time, **kwargs):
+        if result.error is None:
+            cached_paths[result.target_url] = result.cached_path
+        else:
+            failures.append(result)
+    if failures:
+        raise Exception("Could not stage {} of {} targets: {}".format(
+            len(failures), len(failures) + len(cached_paths),
+            ", ".join("{} ({!r})".format(f.target_url, f.error) \
+                      for f in failures)))
+    return cached_paths
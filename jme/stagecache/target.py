@@ -2,14 +2,26 @@ import glob
 import logging
 import re
 import os
-import subprocess
 import stat
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager, nullcontext
 from jme.stagecache.util import parse_url
 from jme.stagecache.ssh import passwordless_sftp
+from jme.stagecache.compression import get_compression_setting, \
+                                       COMPRESS_METHODS, run_measured
+from jme.stagecache.local_copy import copy_file, supports_fallocate
+from jme.stagecache.transform import get_transform, get_method, \
+                                     derived_path, estimate_size, \
+                                     transform_file, transformed_target_path
+from jme.stagecache.timing import span, timed
 
 LOGGER = logging.getLogger(name='target')
 
+# directories listed at once when walking a tree
+WALK_THREADS = 8
+# files copied at once for recursive asset types (unless set in the type)
+COPY_THREADS = 4
+
 class EmptyTargetException(Exception):
     pass
 
@@ -25,13 +37,17 @@ def get_target(target_url, asset_type, config={}):
     else:
         if remote.protocol.upper() in ['SFTP', 'SCP']:
             LOGGER.info("Target on remote host: " + remote.host)
-            return SFTP_Target(remote, asset_type)
+            return SFTP_Target(remote, asset_type, config)
         else:
             raise Exception("Unsupported protocol: " + remote.protocol)
 
-def collect_target_files(fs, target_path, asset_type):
+@timed('collect_target_files')
+def collect_target_files(fs, target_path, asset_type, dirs=None):
     """
     look on fs for target files using target_path prefix and asset_type
+
+    dirs: if given, the mtimes of directories walked for recursive asset
+    types are added to it (so added or removed files can be noticed)
     """
 
     # collect as dict to remove duplicates
@@ -75,6 +91,17 @@ def collect_target_files(fs, target_path, asset_type):
                      remote_dir)
         errors["SUFF:" + patt] = inst
 
+    # walk the whole tree under target_path
+    if is_recursive(asset_type):
+        try:
+            tree_files, tree_dirs = walk_tree(fs, target_path)
+            files.update(tree_files)
+            if dirs is not None:
+                dirs.update(tree_dirs)
+        except Exception as inst:
+            LOGGER.error("ERROR: walking directory tree: " + target_path)
+            errors[target_path] = inst
+
     # if we have any errors, raise a new Exception
     if errors:
         raise CollectTargetFilesException(files, errors)
@@ -82,6 +109,67 @@ def collect_target_files(fs, target_path, asset_type):
     # done
     return files
 
+def walk_tree(fs, top, threads=WALK_THREADS):
+    """ list every file under top, several directories at a time
+
+    fs is the os module or an sftp client. Symlinks are followed, like
+    rsync -L.
+
+    returns: dicts from file path to mtime and size and from directory path
+    to mtime """
+    files = {}
+    dirs = {top: fs.stat(top).st_mtime}
+    with ThreadPoolExecutor(threads) as executor:
+        pending = set([executor.submit(list_tree_dir, fs, top), ])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, subdirs = future.result()
+                files.update(dir_files)
+                dirs.update(subdirs)
+                pending.update(executor.submit(list_tree_dir, fs, subdir) \
+                               for subdir in subdirs)
+    return files, dirs
+
+def list_tree_dir(fs, path):
+    """ return files (with mtime and size) and subdirs (with mtime) of one
+    directory """
+    files = {}
+    subdirs = {}
+    if fs is os:
+        with os.scandir(path) as entries:
+            attrs = [(entry.path, entry.stat()) for entry in entries]
+    else:
+        # one round trip for the whole directory
+        attrs = []
+        for attr in fs.listdir_attr(path):
+            entry_path = os.path.join(path, attr.filename)
+            if stat.S_ISLNK(attr.st_mode):
+                attr = fs.stat(entry_path)
+            attrs.append((entry_path, attr))
+    for entry_path, attr in attrs:
+        if os.path.basename(entry_path).startswith('.stagecache.'):
+            # cache metadata (when walking a cached copy)
+            continue
+        if stat.S_ISDIR(attr.st_mode):
+            subdirs[entry_path] = attr.st_mtime
+        else:
+            files[entry_path] = {'mtime': attr.st_mtime,
+                                 'size': attr.st_size}
+    return files, subdirs
+
+def prune_tree(top):
+    """ remove empty directories under (and including) top """
+    for dir_path, _, _ in os.walk(top, topdown=False):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            # not empty
+            pass
+
+def is_recursive(asset_type):
+    return asset_type['contents'].get('recursive', False)
+
 class CollectTargetFilesException(Exception):
     def __init__(self, files, errors):
         self.files = files
@@ -93,8 +181,21 @@ class Target():
 
     def __init__(self, path_string, asset_type):
         self.path_string = os.path.abspath(path_string)
-        self.remote_path = path_string
+        # normalized (eg no trailing slash), so file paths under it line up
+        # with the cached copy
+        self.remote_path = os.path.normpath(path_string)
         self.asset_type = asset_type
+        self.host = 'localhost'
+        # no point compressing local copies
+        self.compress = False
+        self.compress_method = 'rsync'
+        # decompress while staging (see transform.py)
+        self.transform = get_transform(asset_type)
+        if self.transform is not None and not is_recursive(asset_type):
+            # cached (and known to the cache) under a name that can't clash
+            # with an untransformed asset
+            self.path_string = transformed_target_path(self.transform,
+                                                       self.path_string)
 
     @contextmanager
     def filesystem(self):
@@ -107,9 +208,11 @@ class Target():
             LOGGER.debug("looking for target files: {} ({})".format(
                 self.remote_path, self.asset_type))
 
+            dirs = {}
             files = collect_target_files(fs,
                                          self.remote_path,
-                                         self.asset_type)
+                                         self.asset_type,
+                                         dirs=dirs)
 
             if len(files) == 0:
                 raise EmptyTargetException(
@@ -118,8 +221,27 @@ class Target():
                 )
 
             self.mtime = max(d['mtime'] for d in files.values())
+            if dirs:
+                self.mtime = max(self.mtime, max(dirs.values()))
             self.size = sum(d['size'] for d in files.values())
             self.files = list(files.keys())
+            self.file_stats = files
+
+            if self.transform is not None:
+                derived = set(derived_path(self.transform, f) for f in files)
+                if len(derived) < len(files):
+                    raise Exception("{} has both compressed and "
+                                    "decompressed copies of some files"
+                                    .format(self.remote_path))
+                # the space needed is the decompressed size
+                self.size = 0
+                for remote_file, stats in files.items():
+                    method = get_method(self.transform, remote_file)
+                    if method is not None:
+                        stats['size_hint'] = estimate_size(fs, remote_file,
+                                                           method,
+                                                           stats['size'])
+                    self.size += stats.get('size_hint', stats['size'])
 
     def get_mtime(self):
         """
@@ -144,33 +266,84 @@ class Target():
         """ empty string for local files """
         return ""
 
-    def copy_to(self, dest_path, umask=0o664, dry_run=False):
-        """ Use rsync to copy files """
+    @timed('copy_to')
+    def copy_to(self, dest_path, umask=0o664, dry_run=False, compress=False,
+                bwlimit=None, copy_method='auto'):
+        """ Use rsync to copy files (or copy local files in process, see
+        local_copy.py)
+
+        Files whose cached copy already has the same size and mtime are
+        skipped (rsync's quick check). For recursive asset types, files are
+        copied several at a time and cached files that are no longer in the
+        source are deleted.
+
+        if compress is True, use the configured compress_method
+        bwlimit is the maximum bytes per second (or None)
+        copy_method is auto or rsync """
 
         if 'files' not in self.__dict__:
             self.get_target_files()
 
         # for each file:
         #  rsync -lt [username@host:]remote_path cached_target_dir
-        rsync_cmd_templ = 'rsync -Lt {remote_pref}{remote_file} {cached_file}'
+        # (rsync writes to a temp file and renames it when it's done)
+        rsync_cmd_templ = 'rsync -Lt {rsync_opts}{remote_pref}' \
+                          '{remote_file} {cached_file}'
         remote_pref = self.get_remote_pref()
-        # if target is a dir, we need to adjust
-        if os.path.dirname(next(iter(self.files))) == self.remote_path:
-            cached_dir = dest_path
-        else:
-            cached_dir = os.path.dirname(dest_path)
-
-        LOGGER.info("syncing files from " + self.remote_path)
-        for remote_file in self.files:
-            cached_file = os.path.join(cached_dir,
-                                       os.path.basename(remote_file))
-            rsync_cmd = rsync_cmd_templ.format(**locals())
-            LOGGER.debug("Running: " + rsync_cmd)
+        rsync_opts = ""
+        if not dry_run and supports_fallocate(dest_path):
+            # elsewhere, rsync would write every block to preallocate
+            rsync_opts = "--preallocate "
+        if compress and remote_pref:
+            rsync_opts += COMPRESS_METHODS[self.compress_method] + " "
+
+        recursive = is_recursive(self.asset_type)
+        threads = self.asset_type.get('copy_threads', COPY_THREADS) \
+                if recursive else 1
+        if bwlimit is not None:
+            # split between files copied at once
+            bwlimit = bwlimit / min(threads, len(self.files))
+            # rsync wants KiB per second
+            rsync_opts += "--bwlimit={} ".format(max(1, int(bwlimit / 1024)))
+
+        local_copy = remote_pref == "" and copy_method != 'rsync'
+        # CPU time of each rsync (for auto compression)
+        cpu_times = []
+
+        def sync_file(remote_file):
+            cached_file = self.get_cached_file(remote_file, dest_path)
+            if self.is_current(remote_file, cached_file):
+                LOGGER.debug("%s is up to date", cached_file)
+                return
+            method = get_method(self.transform, remote_file)
+            if method is not None:
+                LOGGER.debug("Decompressing (%s) %s to %s", method,
+                             remote_file, cached_file)
+            elif local_copy:
+                LOGGER.debug("Copying %s to %s", remote_file, cached_file)
+            else:
+                rsync_cmd = rsync_cmd_templ.format(
+                    rsync_opts=rsync_opts, remote_pref=remote_pref,
+                    remote_file=remote_file, cached_file=cached_file)
+                LOGGER.debug("Running: " + rsync_cmd)
 
             if not dry_run:
+                cached_dir = os.path.dirname(cached_file)
                 if not os.path.exists(cached_dir):
-                    os.makedirs(cached_dir)
-                subprocess.run(rsync_cmd, shell=True, check=True)
+                    os.makedirs(cached_dir, exist_ok=True)
+                if method is not None:
+                    stats = self.file_stats[remote_file]
+                    with span('transform', file=remote_file):
+                        transform_file(source_fs, remote_file, cached_file,
+                                       method, stats['mtime'],
+                                       size_hint=stats.get('size_hint', 0),
+                                       bwlimit=bwlimit)
+                elif local_copy:
+                    with span('local_copy', file=remote_file):
+                        copy_file(remote_file, cached_file, bwlimit=bwlimit)
+                else:
+                    with span('rsync', file=remote_file):
+                        cpu_times.append(run_measured(rsync_cmd))
 
                 # set umask
                 try:
@@ -181,19 +354,93 @@ class Target():
                     # move on if the umask is OK.
                     LOGGER.warn("Unable to set umask.")
 
+        LOGGER.info("syncing files from " + self.remote_path)
+        # only connect if something needs decompressing
+        needs_fs = not dry_run and any(get_method(self.transform, f) \
+                                       for f in self.files)
+        with (self.filesystem() if needs_fs else nullcontext()) as source_fs:
+            if threads > 1:
+                with ThreadPoolExecutor(threads) as executor:
+                    # result() raises the first failure
+                    for _ in executor.map(sync_file, self.files):
+                        pass
+            else:
+                for remote_file in self.files:
+                    sync_file(remote_file)
+
+        self.cpu_time = sum(cpu_times)
+
+        if recursive and not dry_run:
+            self.remove_deleted_files(dest_path)
+
+        if self.transform is not None and not dry_run:
+            # now we know the real size
+            self.size = sum(os.path.getsize(self.get_cached_file(f,
+                                                                 dest_path)) \
+                            for f in self.files)
+
+    def get_cached_file(self, remote_file, dest_path):
+        """ where remote_file goes: the same path relative to the asset
+        (minus any suffix the transform removes) """
+        return derived_path(self.transform,
+                            dest_path + remote_file[len(self.remote_path):])
+
+    def is_current(self, remote_file, cached_file):
+        """ True if cached_file has the size and mtime of remote_file """
+        remote_stats = getattr(self, 'file_stats', {}).get(remote_file, None)
+        if remote_stats is None:
+            return False
+        try:
+            cached_stats = os.stat(cached_file)
+        except FileNotFoundError:
+            return False
+        if get_method(self.transform, remote_file) is not None:
+            # sizes differ, but the mtime is the source's
+            return int(cached_stats.st_mtime) == int(remote_stats['mtime'])
+        return cached_stats.st_size == remote_stats['size'] \
+                and int(cached_stats.st_mtime) == int(remote_stats['mtime'])
+
+    def remove_deleted_files(self, dest_path):
+        """ delete cached files that are gone from the source tree """
+        if not os.path.isdir(dest_path):
+            return
+        wanted = set(self.get_cached_file(remote_file, dest_path) \
+                     for remote_file in self.files)
+        cached_files = walk_tree(os, dest_path)[0]
+        for cached_file in cached_files:
+            if cached_file not in wanted:
+                LOGGER.debug("Removing %s (gone from source)", cached_file)
+                os.remove(cached_file)
+        prune_tree(dest_path)
+
+class CachedTarget(Target):
+    """ An asset already copied into another cache tier
+
+    path_string is the original asset path (so the metadata matches between
+    tiers), but files are read from the cached copy """
+
+    def __init__(self, path_string, asset_type, cached_path):
+        super().__init__(path_string, asset_type)
+        self.remote_path = os.path.normpath(cached_path)
+        # already decompressed
+        self.transform = None
+
 class SFTP_Target(Target):
     """ Represents an asset somewhere on a remote filesystem """
-    def __init__(self, remote, asset_type):
+    def __init__(self, remote, asset_type, config={}):
         super().__init__(os.path.join(remote.host, remote.path), asset_type)
         self.host = remote.host
-        self.remote_path = remote.path
+        self.remote_path = os.path.normpath(remote.path)
         self.username = remote.user
+        self.compress, self.compress_method = \
+                get_compression_setting(asset_type, config, self.host)
 
     @contextmanager
     def filesystem(self):
         LOGGER.info("Connecting to %s as %s", self.host, self.username)
 
-        with passwordless_sftp(self.host, self.username) as sftp:
+        with passwordless_sftp(self.host, self.username,
+                               compress=self.compress is True) as sftp:
             yield sftp
 
                     
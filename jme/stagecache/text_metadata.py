@@ -8,10 +8,35 @@ There are four metadata files in the cache for each:
     /path/.stagecache.filename/log     A record of past requests
     /path/.stagecache.filename/write_lock
                                        Exists if cache being updated
+and some that track usage for the eviction policies (see eviction.py):
+    /path/.stagecache.filename/access_count  Number of requests
+    /path/.stagecache.filename/last_access   Time of last request
+    /path/.stagecache.filename/priority      Policy specific priority
+and the user and group who cached it (for quotas, see quota.py):
+    /path/.stagecache.filename/owner_uid
+    /path/.stagecache.filename/owner_gid
+and a checksum of each file in the asset (see checksum.py):
+    /path/.stagecache.filename/checksums
+
+If the cache has more than one root, each asset (and its metadata) is in
+just one of them (see Cache.get_root()).
 
 There are also global metadata files in cache_root:
     .stagecache.global/asset_list    list of assets in this cache
+    .stagecache.global/asset_journal changes to the list since it was written
+    .stagecache.global/asset_index   binary copy of every asset's size, lock
+                                     date, and usage (see index.py)
     .stagecache.global/write_lock
+and locks for the short updates to them (journal_lock, index_lock,
+metrics_lock). Those are held with flock(2), so they are released when the
+process holding them dies, and the files are left in place.
+
+The asset list is a snapshot. Adding and removing assets only appends lines
+(+ or -, path, type) to the journal, which is replayed over the snapshot when
+the list is read. When the journal gets bigger than the snapshot, the two are
+compacted into a new snapshot. Both files start with a generation number, and
+a journal is only replayed over the snapshot of the same generation, so a
+crash part way through compaction can't apply changes twice.
 
 Usage:
     Initialize TargetMetadata() class with cache_root and target paths.
@@ -22,6 +47,8 @@ TargetMetadata Functions:
     set_cached_target_size(size): writes size to file
     get_last_lock_date(): returns the most recent lock end date
     set_cache_lock_date(date): writes new date to lock file
+    record_access(): count a request for this asset
+    get_owner(): returns uid and gid of the user who cached it
     get_write_lock():
                         mark file as in progress (wait for existing lock)
     release_write_lock(): remove in_progress mark
@@ -31,12 +58,15 @@ CacheMetadata Functions:
     iter_cached_files(locked=None):
                         return list of assets with sizes and lock dates
     remove_cached_file(path): remove record of asset
+    remove_cached_files(paths): remove records of several assets at once
+    write_asset_list(asset_list): replace list of assets
     add_cached_file(path): add record of asset
 
 All functions take cache=cache_root as a kwarg
 All get_ functions throw FileNotFound exception if asset not yet in cache
 
 """
+import fcntl
 import logging
 import os
 import time
@@ -59,6 +89,10 @@ def makedirs(path, mode=509):
             pass
 
 class Lockable():
+    # hold an flock on write_lock instead of creating it (for short
+    # critical sections that a crash shouldn't leave locked)
+    use_flock = False
+
     def __init__(self, cache):
         self.umask = cache.config['cache_umask']
         self.umask_dir = self.umask + 0o111
@@ -73,6 +107,10 @@ class Lockable():
         
         see get_write_lock for arguments
         """
+        if self.use_flock:
+            with self.flock(dry_run):
+                yield None
+            return
         try:
             self.get_write_lock(sleep_interval, force, dry_run)
             yield None
@@ -92,15 +130,37 @@ class Lockable():
                 return
             LOGGER.info('Waiting for lock...')
             LOGGER.debug("force is "+ str(force))
-            while os.path.exists(self.write_lock):
-                time.sleep(sleep_interval)
 
         if dry_run:
             return
-        with open(self.write_lock, 'wt') as LOCK:
+        # create it atomically, so two threads or processes can't both think
+        # they got it
+        while True:
+            try:
+                lock_fd = os.open(self.write_lock,
+                                  os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                break
+            except FileExistsError:
+                time.sleep(sleep_interval)
+        with os.fdopen(lock_fd, 'wt') as LOCK:
             LOCK.write('locked')
         os.chmod(self.write_lock, self.umask)
 
+    @contextmanager
+    def flock(self, dry_run=False):
+        """ hold an exclusive flock on write_lock in the with block """
+        if dry_run:
+            yield None
+            return
+        lock_fd = os.open(self.write_lock, os.O_WRONLY | os.O_CREAT,
+                          self.umask)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield None
+        finally:
+            # closing it releases the lock
+            os.close(lock_fd)
+
     def release_write_lock(self):
         """ remove in_progress mark """
         LOGGER.debug('Releasing lock (%s)...', self.write_lock)
@@ -112,7 +172,8 @@ class Lockable():
 class TargetMetadata(Lockable):
     def __init__(self, cache, target_path, atype):
         super().__init__(cache)
-        self.cache_root = os.path.abspath(cache.cache_root)
+        self.cache = cache
+        self.cache_root = os.path.abspath(cache.get_root(target_path))
         self.target_path = target_path
         self.atype = atype
         self.cached_target = get_cached_target(self.cache_root, 
@@ -135,26 +196,37 @@ class TargetMetadata(Lockable):
                       
 
     def get_md_value(self, md_type, delete=False):
-        """  returns mtime of md file and int value from file """
+        """  returns int (or float) value from file and mtime of md file """
         md_file = os.path.join(self.md_dir, md_type)
         if not os.path.exists(md_file):
             # file not in cache!
             return (0, None)
         mtime = os.path.getmtime(md_file)
         with open(md_file, 'rt') as md_handle:
-            value = int(md_handle.readlines()[0].strip())
+            value = md_handle.readlines()[0].strip()
+        try:
+            value = int(value)
+        except ValueError:
+            value = float(value)
         if delete:
             os.remove(md_file)
         return value, mtime
 
-    def set_md_value(self, md_type, value):
-        """ writes value to md file """
+    def set_md_value(self, md_type, value, catalog=True):
+        """ writes value to md file
+
+        the old value is archived in the log unless catalog is False """
         md_file = os.path.join(self.md_dir, md_type)
-        if os.path.exists(md_file):
+        if catalog and os.path.exists(md_file):
             self.catalog(md_type)
+        if isinstance(value, float) and not value.is_integer():
+            value = repr(value)
+        else:
+            value = str(int(value))
         with open(md_file, 'wt') as SIZE:
-            SIZE.write(str(int(value)))
+            SIZE.write(value)
         os.chmod(md_file, self.umask)
+        self.cache.index.set_value(self, md_type, value)
 
     def catalog(self, md_type):
         """ archives old md and returns value """
@@ -193,10 +265,205 @@ class TargetMetadata(Lockable):
         lock_date = self.get_last_lock_date()
         return lock_date > time.time()
 
+    def record_access(self, when=None):
+        """ count a request for this asset """
+        if when is None:
+            when = int(time.time())
+        self.set_md_value('access_count', self.get_access_count() + 1,
+                          catalog=False)
+        self.set_md_value('last_access', when, catalog=False)
+
+    def get_access_count(self):
+        """ returns number of times asset was requested """
+        return self.get_md_value('access_count')[0]
+
+    def get_last_access(self):
+        """ returns the time of the last request """
+        return self.get_md_value('last_access')[0]
+
+    def get_priority(self):
+        """ returns the eviction priority set by the policy """
+        return self.get_md_value('priority')[0]
+
+    def set_priority(self, priority):
+        """ saves the eviction priority """
+        self.set_md_value('priority', priority, catalog=False)
+
+    def get_owner(self):
+        """ returns uid and gid of the user who cached the asset
+
+        falls back to the owner of the cached file, or -1 if unknown """
+        uid, uid_mtime = self.get_md_value('owner_uid')
+        gid, gid_mtime = self.get_md_value('owner_gid')
+        if uid_mtime is None or gid_mtime is None:
+            try:
+                file_stat = os.stat(self.cached_target)
+                file_owner = (file_stat.st_uid, file_stat.st_gid)
+            except OSError:
+                file_owner = (-1, -1)
+            if uid_mtime is None:
+                uid = file_owner[0]
+            if gid_mtime is None:
+                gid = file_owner[1]
+        return uid, gid
+
+    def set_owner(self, uid=None, gid=None):
+        """ saves the owner (defaults to the current user and group) """
+        self.set_md_value('owner_uid', os.getuid() if uid is None else uid,
+                          catalog=False)
+        self.set_md_value('owner_gid', os.getgid() if gid is None else gid,
+                          catalog=False)
+
+    def get_checksums(self):
+        """ returns {file suffix: checksum} or None if not recorded """
+        checksum_file = os.path.join(self.md_dir, 'checksums')
+        if not os.path.exists(checksum_file):
+            return None
+        checksums = {}
+        with open(checksum_file, 'rt') as checksum_handle:
+            for line in checksum_handle:
+                suffix, checksum = line.rstrip('\n').split('\t')
+                checksums[suffix] = checksum
+        return checksums
+
+    def set_checksums(self, checksums):
+        """ saves {file suffix: checksum} """
+        checksum_file = os.path.join(self.md_dir, 'checksums')
+        tmp_file = "{}.{}.tmp".format(checksum_file, os.getpid())
+        with open(tmp_file, 'wt') as checksum_handle:
+            for suffix, checksum in sorted(checksums.items()):
+                checksum_handle.write(suffix + "\t" + checksum + "\n")
+        os.chmod(tmp_file, self.umask)
+        os.replace(tmp_file, checksum_file)
+
     def remove_target(self):
         """ archive metadata for this asset """
+        for md_type in ['access_count', 'last_access', 'priority',
+                        'owner_uid', 'owner_gid', 'checksums']:
+            md_file = os.path.join(self.md_dir, md_type)
+            if os.path.exists(md_file):
+                os.remove(md_file)
         self.catalog('cache_lock')
-        return self.catalog('size')
+        size = self.catalog('size')
+        self.cache.index.remove(self)
+        return size
+
+
+class AssetJournal(Lockable):
+    """ the asset list snapshot and its journal of changes """
+    use_flock = True
+
+    def __init__(self, cache, md_dir):
+        super().__init__(cache)
+        self.snapshot = os.path.join(md_dir, "asset_list")
+        self.journal = os.path.join(md_dir, "asset_journal")
+        self.write_lock = os.path.join(md_dir, "journal_lock")
+
+    def read(self):
+        """ return dict of path: type from snapshot and journal """
+        for _ in range(3):
+            generation, assets = read_asset_file(self.snapshot)
+            journal_generation, changes = read_asset_file(self.journal)
+            if journal_generation <= generation:
+                break
+            # the snapshot was compacted after we read it, try again
+        if journal_generation == generation:
+            for change, target_path, atype in changes:
+                if change == '+':
+                    assets[target_path] = atype
+                else:
+                    assets.pop(target_path, None)
+        return assets
+
+    def append(self, changes):
+        """ record a list of (+/-, path, type) changes with one write """
+        lines = "".join("\t".join(change) + "\n" for change in changes)
+        with self.lock(sleep_interval=0.05):
+            # start a new journal if there is none or it's from before the
+            #  last snapshot (eg a compaction died before emptying it)
+            generation = read_generation(self.snapshot)
+            if read_generation(self.journal) != generation:
+                self.write_asset_file(self.journal, generation, [])
+            with open(self.journal, 'at') as journal:
+                journal.write(lines)
+            if os.path.getsize(self.journal) > max(COMPACT_SIZE,
+                                                   get_size(self.snapshot)):
+                self.compact()
+
+    def compact(self):
+        """ roll the journal into a new snapshot (call with lock held) """
+        LOGGER.debug("Compacting %s", self.journal)
+        generation = read_asset_file(self.snapshot)[0]
+        self.replace(self.read().items(), generation)
+
+    def replace(self, asset_list, generation=None):
+        """ write a new snapshot and empty the journal """
+        if generation is None:
+            generation = read_asset_file(self.snapshot)[0]
+        self.write_asset_file(self.snapshot, generation + 1, asset_list)
+        self.write_asset_file(self.journal, generation + 1, [])
+
+    def write_asset_file(self, asset_file, generation, lines):
+        """ atomically replace a snapshot or journal """
+        tmp_file = "{}.{}.tmp".format(asset_file, os.getpid())
+        with open(tmp_file, 'wt') as assets:
+            assets.write("#generation {}\n".format(generation))
+            for line in lines:
+                assets.write("\t".join(line) + "\n")
+        os.chmod(tmp_file, self.umask)
+        os.replace(tmp_file, asset_file)
+
+COMPACT_SIZE = 64 * 1024
+
+def get_size(path):
+    """ size of file or 0 if it's not there """
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+def read_generation(asset_file):
+    """ generation of a snapshot or journal (None if it's missing) """
+    try:
+        with open(asset_file) as assets:
+            first_line = assets.readline()
+    except FileNotFoundError:
+        return None if asset_file.endswith('journal') else 0
+    if first_line.startswith('#generation ') and first_line.endswith("\n"):
+        return int(first_line.split()[1])
+    return 0
+
+def read_asset_file(asset_file):
+    """ read a snapshot or journal
+
+    returns generation and a dict of path: type (from a snapshot) or a list
+    of (+/-, path, type) (from a journal) """
+    is_journal = asset_file.endswith('journal')
+    generation = 0
+    items = [] if is_journal else dict()
+    if not os.path.exists(asset_file):
+        return generation, items
+    with open(asset_file) as assets:
+        for asset_line in assets:
+            if not asset_line.endswith("\n"):
+                # partly written, ignore it
+                break
+            asset_line = asset_line.strip()
+            if len(asset_line) == 0:
+                continue
+            if asset_line.startswith('#generation '):
+                generation = int(asset_line.split()[1])
+                continue
+            asset = tuple(a.strip() for a in asset_line.split('\t'))
+            if is_journal:
+                if len(asset) != 3 or asset[0] not in ['+', '-']:
+                    raise Exception("Bad journal entry!\n%r" % (asset,))
+                items.append(asset)
+            else:
+                if len(asset) != 2:
+                    raise Exception("Asset tuple is NOT length 2!\n%r" % (asset,))
+                items[asset[0]] = asset[1]
+    return generation, items
 
 
 class CacheMetadata(Lockable):
@@ -210,6 +477,7 @@ class CacheMetadata(Lockable):
         self.asset_list = os.path.join(self.md_dir, "asset_list")
         if not os.path.exists(self.md_dir):
             makedirs(self.md_dir, self.umask_dir)
+        self.journal = AssetJournal(cache, self.md_dir)
         LOGGER.debug("""created CacheMetadata: 
                       cache_root=%s
                       md_dir=%s
@@ -230,64 +498,56 @@ class CacheMetadata(Lockable):
     def list_assets(self):
         """ return list of path, type tuples in cache """
         LOGGER.debug("Fetching asset list: %s", self.asset_list)
-        if os.path.exists(self.asset_list):
-            asset_list = list()
-            with open(self.asset_list) as assets:
-                for asset_line in assets:
-                    asset_line = asset_line.strip()
-                    if len(asset_line) == 0:
-                        continue
-                    asset = tuple(a.strip() for a in asset_line.split('\t'))
-                    if len(asset) != 2:
-                        raise Exception("Asset tuple is NOT length 2!\n%r" % (asset,))
-                    asset_list.append(asset)
-
-            LOGGER.debug("Found %d assets in %s",
-                         len(asset_list),
-                         self.asset_list,
-                        )
-            return asset_list
-        else:
-            return []
+        asset_list = list(self.journal.read().items())
+        LOGGER.debug("Found %d assets in %s",
+                     len(asset_list),
+                     self.asset_list,
+                    )
+        return asset_list
+
 
+    def write_asset_list(self, asset_list):
+        """ atomically replace the asset list with (path, type) tuples """
+        with self.journal.lock(sleep_interval=0.05):
+            self.journal.replace(asset_list)
 
     def remove_cached_file(self, target_metadata):
         """ remove record of cached file, return size """
-        count = 0
-        # read asset list
-        asset_list = self.list_assets()
-        # write new (edited) asset list
-        with open(self.asset_list, 'wt') as assets:
-            for target_path, atype in asset_list:
-                if target_path != target_metadata.target_path:
-                    assets.write(target_path + "\t" + atype + "\n")
-                else:
-                    count += 1
-        os.chmod(self.asset_list, self.umask)
-
-        if count == 0:
-            LOGGER.error("No match for " + target_metadata.target_path)
-            raise Exception("Error recording assets")
-
-        if count > 1:
-            LOGGER.warning("Found {} listings for {}".format(count,
-                                                 target_metadata.target_path))
-
-        return target_metadata.remove_target()
-
-    def add_cached_file(self, target_metadata, target_size, lock_end_date):
-        """ add record of asset """
+        return self.remove_cached_files([target_metadata, ])
+
+    def remove_cached_files(self, target_metadatas):
+        """ remove records of cached files with one update of the asset list,
+        return total size
+
+        Targets that aren't listed (eg removed by someone else) are skipped
+        with a warning. """
+        assets = self.journal.read()
+        listed = []
+        for target_metadata in target_metadatas:
+            if target_metadata.target_path in assets:
+                listed.append(target_metadata)
+            else:
+                LOGGER.warning("No match for %s in the asset list, skipping",
+                               target_metadata.target_path)
+
+        # record removals
+        self.journal.append(('-', tm.target_path, tm.atype) for tm in listed)
+        return sum(tm.remove_target() for tm in listed)
+
+    def add_cached_file(self, target_metadata, target_size, lock_end_date,
+                        copied=False):
+        """ add record of asset
+
+        copied: the files were just copied, so the current user owns it """
         # add to global md
-        paths_in_cache = set(a[0] for a in self.list_assets())
+        paths_in_cache = self.journal.read()
         if target_metadata.target_path not in paths_in_cache:
             LOGGER.debug("%s not in %s, adding...",
                          target_metadata.target_path,
                          paths_in_cache)
             # add to list if not there yet
-            with open(self.asset_list, 'at') as assets:
-                assets.write(target_metadata.target_path + "\t" \
-                              + target_metadata.atype + "\n")
-            os.chmod(self.asset_list, self.umask)
+            self.journal.append([('+', target_metadata.target_path,
+                                  target_metadata.atype), ])
             added_to_list = True
         else:
             LOGGER.debug("%s alread in asset list",
@@ -295,6 +555,8 @@ class CacheMetadata(Lockable):
             added_to_list = False
 
         # add file specific md
+        if copied:
+            target_metadata.set_owner()
         target_metadata.set_cached_target_size(target_size)
         target_metadata.set_cache_lock_date(lock_end_date)
 
@@ -0,0 +1,154 @@
+"""
+Lightweight timing spans for finding out where the time goes.
+
+Code is instrumented with:
+
+    with span('copy', target=path):
+        ...
+
+or for a whole function:
+
+    @timed('free_up_cache_space')
+    def free_up_cache_space(...):
+
+or, for intervals that don't fit in a with block (eg waiting on a lock):
+
+    start = time.time()
+    with some_lock:
+        record_span('lock_wait', start)
+
+Spans cost almost nothing unless someone is listening. To listen, register a
+hook. It is called with each Span as it finishes:
+
+    from jme.stagecache.timing import add_span_hook, SpanRecorder
+    recorder = SpanRecorder()
+    add_span_hook(recorder)
+    ...
+    print(recorder.summary())
+
+The stagecache --profile option does this and prints the summary when done.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+LOGGER = logging.getLogger(name='timing')
+
+SPAN_HOOKS = []
+LOCAL = threading.local()
+
+class Span():
+    """ one timed interval """
+    def __init__(self, name, start, duration=None, parent=None, **attrs):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.parent = parent
+        self.attrs = attrs
+
+    def path(self):
+        """ names of this span and its parents, outermost first """
+        if self.parent is None:
+            return self.name
+        return self.parent.path() + "/" + self.name
+
+    def to_dict(self):
+        return {'name': self.name,
+                'path': self.path(),
+                'start': self.start,
+                'duration': self.duration,
+                'attrs': {k: str(v) for k, v in self.attrs.items()}}
+
+def add_span_hook(hook):
+    """ hook(span) will be called for every finished span """
+    SPAN_HOOKS.append(hook)
+
+def remove_span_hook(hook):
+    SPAN_HOOKS.remove(hook)
+
+def get_current_span():
+    stack = getattr(LOCAL, 'stack', None)
+    return stack[-1] if stack else None
+
+def emit(finished_span):
+    for hook in list(SPAN_HOOKS):
+        try:
+            hook(finished_span)
+        except Exception as exc:
+            LOGGER.warning("Span hook failed: %r", exc)
+
+@contextmanager
+def span(name, **attrs):
+    """ time the with block """
+    if not SPAN_HOOKS:
+        yield None
+        return
+
+    current = Span(name, time.time(), parent=get_current_span(), **attrs)
+    stack = getattr(LOCAL, 'stack', None)
+    if stack is None:
+        stack = LOCAL.stack = []
+    stack.append(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.time() - current.start
+        stack.pop()
+        emit(current)
+
+def timed(name):
+    """ decorator to time every call to a function """
+    def decorator(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+def record_span(name, start, **attrs):
+    """ record a span from start until now, returns the duration """
+    duration = time.time() - start
+    if SPAN_HOOKS:
+        emit(Span(name, start, duration, get_current_span(), **attrs))
+    return duration
+
+
+class SpanRecorder():
+    """ a span hook that keeps every span """
+    def __init__(self):
+        self.spans = []
+
+    def __call__(self, finished_span):
+        self.spans.append(finished_span)
+
+    def summary(self):
+        """ return total time and count for each span path, in the order
+        they started """
+        totals = OrderedDict()
+        for recorded in sorted(self.spans, key=lambda s: s.start):
+            path = recorded.path()
+            if path not in totals:
+                totals[path] = {'count': 0, 'seconds': 0.0}
+            totals[path]['count'] += 1
+            totals[path]['seconds'] += recorded.duration
+        return totals
+
+    def to_dict(self):
+        return {'summary': self.summary(),
+                'spans': [s.to_dict() for s in self.spans]}
+
+    def format_summary(self):
+        """ return the summary as an indented table """
+        lines = []
+        for path, totals in self.summary().items():
+            depth = path.count('/')
+            lines.append("{:>10.3f}s {:>5}x  {}{}".format(
+                totals['seconds'],
+                totals['count'],
+                "  " * depth,
+                path.split('/')[-1]))
+        return "\n".join(lines)
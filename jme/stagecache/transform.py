@@ -0,0 +1,200 @@
+"""
+Decompress files while they are staged, so jobs read the plain file and the
+CPU time is spent once per node instead of once per job.
+
+Set a transform in an asset type:
+
+asset_types:
+    fastq_gz:
+        suff_list:
+            - ""
+        transform: decompress
+
+Transforms are:
+
+    * gunzip: .gz files (multi-member files like bgzip output are fine)
+    * unzstd: .zst files (needs the zstandard module)
+    * decompress: either one, picked by the file name
+
+The built in 'decompress' asset type is a single file with the decompress
+transform:
+
+    stagecache -a decompress /mnt/nas/sample.fastq.gz
+
+Files are read from the source (over SFTP for remote files) and decompressed
+as they arrive into a hidden temp file that is renamed when it's done. The
+cached copy drops the compression suffix and gets the source's mtime, so it's
+only decompressed again when the source changes. Files of an asset without a
+matching suffix are copied as usual.
+
+A single file asset is kept in a directory named for the source and the
+method, so it can't be mistaken for a plain copy of a file with the
+decompressed name (eg /mnt/nas/sample.fastq):
+
+    /cache/mnt/nas/sample.fastq.gz.gunzip/sample.fastq
+
+Within a multi-file asset, the decompressed names are next to the others, so
+an asset with both sample.fastq and sample.fastq.gz is refused.
+
+Space is reserved using the uncompressed size: the ISIZE trailer of gzip
+files or the content size in zstd frame headers. ISIZE is only the size of
+the last member mod 4GiB, so it's taken as a lower bound: 4GiB is added until
+it's at least the compressed size, and if the file is big enough to have
+wrapped, it's no less than UNKNOWN_RATIO times the compressed size. If
+adding 4GiB makes it more than PLAUSIBLE_RATIO times the compressed size (eg
+bgzip's empty last block), or the size isn't known, it's guessed at
+UNKNOWN_RATIO times the compressed size. The real size is recorded once the
+file is done.
+"""
+import gzip
+import logging
+import os
+import struct
+import time
+from jme.stagecache.local_copy import preallocate
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = logging.getLogger(name='transform')
+
+# transform -> the compression suffixes it handles
+TRANSFORMS = {'gunzip': ['.gz', ],
+              'unzstd': ['.zst', ],
+              'decompress': ['.gz', '.zst']}
+SUFFIX_METHODS = {'.gz': 'gunzip', '.zst': 'unzstd'}
+
+BUFFER_SIZE = 1024 * 1024
+UNKNOWN_RATIO = 4
+PLAUSIBLE_RATIO = 16
+ISIZE_MODULUS = 2 ** 32
+ZSTD_HEADER_SIZE = 18
+
+def get_transform(asset_type):
+    """ return the asset type's transform (or None) """
+    transform = asset_type.get('transform', None)
+    if transform is not None and transform not in TRANSFORMS:
+        raise Exception("Unknown transform: {}. Use one of: {}".format(
+            transform, ", ".join(TRANSFORMS)))
+    return transform
+
+def get_method(transform, path):
+    """ return gunzip or unzstd if the transform applies to path (or None) """
+    if transform is None:
+        return None
+    for suffix in TRANSFORMS[transform]:
+        if path.endswith(suffix):
+            return SUFFIX_METHODS[suffix]
+    return None
+
+def derived_path(transform, path):
+    """ path without the compression suffix (if the transform applies) """
+    method = get_method(transform, path)
+    if method is None:
+        return path
+    return path[:path.rindex('.')]
+
+def transformed_target_path(transform, path):
+    """ the asset path for a single transformed file (see above) """
+    method = get_method(transform, path)
+    if method is None:
+        return path
+    return os.path.join(path + '.' + method,
+                        os.path.basename(derived_path(transform, path)))
+
+def open_source(fs, path):
+    """ open a file on fs (the os module or an sftp client) for reading """
+    if fs is os:
+        return open(path, 'rb')
+    return fs.open(path, 'rb')
+
+def estimate_size(fs, path, method, compressed_size):
+    """ return the (likely) decompressed size of a file """
+    with open_source(fs, path) as compressed_handle:
+        if method == 'gunzip' and compressed_size >= 18:
+            compressed_handle.seek(-4, os.SEEK_END)
+            size = struct.unpack('<I', compressed_handle.read(4))[0]
+            unwrapped = size
+            while unwrapped < compressed_size:
+                unwrapped += ISIZE_MODULUS
+            if unwrapped == size \
+                    or unwrapped <= compressed_size * PLAUSIBLE_RATIO:
+                if compressed_size * UNKNOWN_RATIO >= ISIZE_MODULUS:
+                    # may have wrapped (again)
+                    return max(unwrapped, compressed_size * UNKNOWN_RATIO)
+                return unwrapped
+        if method == 'unzstd' and zstandard is not None:
+            size = zstandard.frame_content_size(
+                compressed_handle.read(ZSTD_HEADER_SIZE))
+            if size >= 0:
+                return size
+    return compressed_size * UNKNOWN_RATIO
+
+def open_decompressed(compressed_handle, method):
+    """ return a file object that reads the decompressed data """
+    if method == 'gunzip':
+        return gzip.GzipFile(fileobj=compressed_handle, mode='rb')
+    if zstandard is None:
+        raise Exception("The zstandard module is needed to decompress .zst "
+                        "files")
+    return zstandard.ZstdDecompressor().stream_reader(compressed_handle,
+                                                      read_across_frames=True)
+
+class ThrottledReader():
+    """ read from a file object no faster than bwlimit bytes per second """
+    def __init__(self, handle, bwlimit):
+        self.handle = handle
+        self.bwlimit = bwlimit
+        self.start = time.time()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.handle.read(size)
+        self.bytes_read += len(data)
+        ahead = self.bytes_read / self.bwlimit - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+        return data
+
+def transform_file(fs, src_path, dest_path, method, mtime, size_hint=0,
+                   bwlimit=None):
+    """ decompress src_path (on fs) into dest_path
+
+    mtime: the source mtime, given to the cached file
+    size_hint: expected decompressed size, preallocated up front
+    bwlimit: maximum compressed bytes per second (or None)
+
+    returns the decompressed size """
+    dest_dir, dest_name = os.path.split(dest_path)
+    tmp_path = os.path.join(dest_dir, ".{}.{}.tmp".format(dest_name,
+                                                          os.getpid()))
+    try:
+        with open_source(fs, src_path) as compressed_handle, \
+                open(tmp_path, 'wb') as dest_handle:
+            if hasattr(compressed_handle, 'prefetch'):
+                # paramiko: read ahead while we decompress
+                compressed_handle.prefetch()
+            if bwlimit is not None:
+                compressed_handle = ThrottledReader(compressed_handle,
+                                                    bwlimit)
+            preallocate(dest_handle.fileno(), size_hint)
+            size = 0
+            with open_decompressed(compressed_handle, method) as reader:
+                for chunk in iter(lambda: reader.read(BUFFER_SIZE), b''):
+                    dest_handle.write(chunk)
+                    size += len(chunk)
+            # drop any preallocated space past the end
+            dest_handle.truncate(size)
+
+        os.utime(tmp_path, (mtime, mtime))
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    LOGGER.debug("Decompressed %s (%s) into %d bytes", src_path, method,
+                 size)
+    return size
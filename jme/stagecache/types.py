@@ -8,7 +8,9 @@ asset_types = {
     'taxdump': {'name': 'taxdump',
                 'contents': {
                     'suff_list': ['/names.dmp', '/nodes.dmp']
-                }
+                },
+                # plain text compresses well
+                'compress': True,
                },
     'bwadb': {'name': 'bwadb',
               'contents': {
@@ -18,6 +20,15 @@ asset_types = {
     'prefix': {'name': 'prefix',
                'contents': {'suff_patt': '[^/]*$'}
               },
+    # every file under a directory
+    'dir': {'name': 'dir',
+            'contents': {'recursive': True}
+           },
+    # one file, cached decompressed (see transform.py)
+    'decompress': {'name': 'decompress',
+                   'contents': {'suff_list': ['']},
+                   'transform': 'decompress',
+                  },
 }
 
 def cleanup_asset_types(asset_types):
@@ -25,8 +36,9 @@ def cleanup_asset_types(asset_types):
         # add name to def, so we don't have to keep track
         type_def['name'] = name
 
-        # if suff_xxxx definitions are top level, move to contents
-        for key in type_def:
-            if key.startswith('suff_'):
+        # if suff_xxxx (or recursive) definitions are top level, move to
+        # contents
+        for key in list(type_def):
+            if key.startswith('suff_') or key == 'recursive':
                 type_def.setdefault('contents', {})[key] = type_def[key]
 
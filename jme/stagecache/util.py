@@ -2,6 +2,7 @@
 miscelaneous functions
 
 def human_readable_bytes(byt):
+def parse_bytes(size):
 def path_up_to_wildcard(full_path):
 def parse_url(url, config, use_local=False, has_wildcards=False):
 def user_from_config(config, host):
@@ -42,6 +43,20 @@ def human_readable_bytes(byt):
     format_str = float_fmt + ['', 'K', 'M', 'G', 'T', 'P', 'E'][illion]
     return (format_str % (byt * 1.0 / (1024 ** illion))).lstrip('0')
 
+BYTES_REXP = re.compile(r'^\s*([0-9.]+(?:e[+-]?\d+)?)\s*([KMGTPE]?)i?B?\s*$',
+                        re.IGNORECASE)
+def parse_bytes(size):
+    """ turn 1.5e12, "1.5T", "500G", or "20KB" into a number of bytes.
+    Suffixes are powers of 1024 to match human_readable_bytes """
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = BYTES_REXP.search(str(size))
+    if match is None:
+        raise ValueError("Cannot parse size: " + repr(size))
+    number, suffix = match.groups()
+    power_1024 = ['', 'K', 'M', 'G', 'T', 'P', 'E'].index(suffix.upper())
+    return int(float(number) * (1024 ** power_1024))
+
 def path_up_to_wildcard(full_path):
     """ If a given path has a wildcard placeholder ( eg {sample} ),
     return the last directory before that point """
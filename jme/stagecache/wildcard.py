@@ -0,0 +1,112 @@
+"""
+Stage every file matching a pattern.
+
+Patterns can use glob wildcards (*, ?, [abc]) or placeholders like {sample}
+(which match like *) in any part of the path after the first directory:
+
+    /mnt/nas_1/project/{sample}/reads.{direction}.fastq
+    SFTP://server.edu/data/run_*/counts.tsv
+
+Matches are found on the source (over one SFTP connection for remote files)
+by listing just the directories the pattern can reach. Each match is staged
+as its own asset, several at a time, and the cached copy of the pattern root
+(the last directory before the first wildcard) is returned:
+
+    /cache/root/mnt/nas_1/project
+
+Hidden files only match if the pattern part starts with a dot, as in a shell.
+"""
+import fnmatch
+import logging
+import os
+import re
+import stat
+from contextlib import contextmanager
+from jme.stagecache.ssh import passwordless_sftp
+from jme.stagecache.util import parse_url
+
+LOGGER = logging.getLogger(name='wildcard')
+
+PLACEHOLDER_REXP = re.compile(r'\{[^{}/]*\}')
+MAGIC_REXP = re.compile(r'[*?[]')
+
+def pattern_to_glob(pattern):
+    """ turn {name} placeholders into * """
+    return PLACEHOLDER_REXP.sub('*', pattern)
+
+def split_pattern(pattern):
+    """ return the root dir (with no wildcards) and a list of the path parts
+    after it """
+    parts = pattern_to_glob(pattern).split('/')
+    for i, part in enumerate(parts):
+        if MAGIC_REXP.search(part):
+            return '/'.join(parts[:i]) or '/', parts[i:]
+    # no wildcards: the pattern is just one path
+    return os.path.dirname(pattern), [os.path.basename(pattern), ]
+
+def is_dir(fs, path):
+    try:
+        return stat.S_ISDIR(fs.stat(path).st_mode)
+    except OSError:
+        return None
+
+def match_pattern(fs, pattern, skip_dirs=True):
+    """ return sorted paths on fs (the os module or an sftp client) that
+    match pattern
+
+    skip_dirs: don't return directories """
+    root, parts = split_pattern(pattern)
+    current = [root, ]
+    for level, part in enumerate(parts):
+        last = level == len(parts) - 1
+        matches = []
+        for dir_path in current:
+            if MAGIC_REXP.search(part):
+                try:
+                    names = fs.listdir(dir_path)
+                except OSError:
+                    continue
+                names = [n for n in names if fnmatch.fnmatchcase(n, part) \
+                         and (part.startswith('.') or not n.startswith('.'))]
+            else:
+                names = [part, ]
+            for name in names:
+                path = os.path.join(dir_path, name)
+                path_is_dir = is_dir(fs, path)
+                if path_is_dir is None:
+                    continue
+                if last:
+                    if not (skip_dirs and path_is_dir):
+                        matches.append(path)
+                elif path_is_dir:
+                    matches.append(path)
+        current = matches
+    return sorted(current)
+
+@contextmanager
+def source_filesystem(remote):
+    """ the os module for local files or an sftp client for remote ones """
+    if remote is None:
+        yield os
+    else:
+        with passwordless_sftp(remote.host, remote.user) as sftp:
+            yield sftp
+
+def expand_wildcard(pattern_url, config, skip_dirs=True):
+    """ find the files matching a pattern (a path or URL)
+
+    returns: the pattern root path on the source and a list of URLs (or
+    paths) of the matching files """
+    remote = parse_url(pattern_url, config, use_local=True,
+                       has_wildcards=True)
+    pattern = os.path.abspath(pattern_url) if remote is None \
+            else remote.path
+    root = split_pattern(pattern)[0]
+    with source_filesystem(remote) as fs:
+        matches = match_pattern(fs, pattern, skip_dirs=skip_dirs)
+    LOGGER.info("%d files match %s", len(matches), pattern_url)
+    if remote is not None:
+        matches = ["{}://{}@{}{}".format(remote.protocol, remote.user,
+                                         remote.host, path) \
+                   for path in matches]
+    return root, matches
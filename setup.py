@@ -27,6 +27,7 @@ setup(name=NAME,
 	  packages=find_namespace_packages(include=['jme.*']),
       scripts=['stagecache'],
       install_requires=['paramiko', 'pyyaml', 'docopt'],
+      extras_require={'xxhash': ['xxhash'], 'zstd': ['zstandard']},
       classifiers=[
           'Development Status :: 3 - Alpha',
           'Environment :: Console',
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""
+bench_cache.py
+
+Time cache metadata operations on synthetic caches of increasing size, so
+that changes to text_metadata.py and cache.py that don't scale show up.
+
+For each cache size, a cache is filled with that many small local files
+(metadata is written directly, so setup is quick) and these are timed:
+
+    hit:        add_target() of an asset that is already cached
+    miss:       add_target() of a new asset (copied in process, see
+                local_copy.py)
+    inspect:    inspect_cache()
+    evict:      free_up_cache_space() deleting EVICTIONS expired assets
+    contention: PROCS processes making hit and miss requests at once
+
+Results are written as JSON. Give an earlier result file with --baseline to
+list benchmarks that got slower by more than the tolerance (and exit with
+status 1 if any did).
+
+Run from the top of the repository:
+
+    PYTHONPATH=. python test/bench/bench_cache.py -s 1000,10000 -o bench.json
+
+Usage:
+    bench_cache.py [options]
+
+Options:
+    -h --help                Show this screen.
+    -s SIZES, --sizes SIZES  Comma separated asset counts
+                             [default: 1000,10000,100000]
+    -b NAMES, --bench NAMES  Comma separated benchmarks to run
+                             [default: hit,miss,inspect,evict,contention]
+    -r N, --repeat N         Requests to time in each benchmark [default: 20]
+    -e N, --evictions N      Assets to evict in the evict benchmark
+                             [default: 100]
+    -p N, --procs N          Processes in the contention benchmark
+                             [default: 8]
+    --asset_bytes BYTES      Size of each synthetic asset [default: 1024]
+    -d DIR, --dir DIR        Where to build caches (default: temp dir)
+    -k, --keep               Don't delete the caches when done
+    -o FILE, --output FILE   Write results to FILE instead of stdout
+    --baseline FILE          Compare to results from an earlier run
+    --tolerance FRACTION     Allowed slow down [default: 0.25]
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from docopt import docopt
+from jme.stagecache import VERSION
+from jme.stagecache.cache import Cache
+from jme.stagecache.target import get_target
+from jme.stagecache.text_metadata import TargetMetadata
+
+LOGGER = logging.getLogger(name='bench')
+
+BENCHMARKS = ['hit', 'miss', 'inspect', 'evict', 'contention']
+
+def make_source_files(source_dir, count, asset_bytes):
+    """ make sure there are at least count files to stage, return paths """
+    os.makedirs(source_dir, exist_ok=True)
+    data = b'x' * asset_bytes
+    paths = []
+    for i in range(count):
+        # spread files over subdirectories like a real file tree
+        path = os.path.join(source_dir, "{:03d}".format(i % 1000),
+                            "asset_{:07d}".format(i))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as source_handle:
+                source_handle.write(data)
+        paths.append(path)
+    return paths
+
+def make_synthetic_cache(cache_root, sources, asset_bytes, headroom):
+    """ build a cache holding every source file
+
+    cached copies are empty files, only the metadata has the sizes. The cache
+    size is set to leave headroom bytes free. """
+    md_dir = os.path.join(cache_root, '.stagecache.global')
+    os.makedirs(md_dir)
+    with open(os.path.join(md_dir, 'config'), 'wt') as config_handle:
+        config_handle.write("cache_size: {}\n".format(
+            len(sources) * asset_bytes + headroom))
+
+    cache = Cache(cache_root)
+    lock_date = int(time.time()) + 24 * 60 * 60
+    with open(cache.metadata.asset_list, 'wt') as asset_list:
+        for path in sources:
+            target_metadata = TargetMetadata(cache, path, 'file')
+            open(target_metadata.cached_target, 'wb').close()
+            target_metadata.set_md_value('size', asset_bytes, catalog=False)
+            target_metadata.set_md_value('cache_lock', lock_date,
+                                         catalog=False)
+            asset_list.write(path + "\tfile\n")
+    with cache.index.lock(sleep_interval=0.01):
+        cache.index.rebuild()
+    return cache
+
+def expire_locks(cache):
+    """ make every asset in the cache evictable """
+    lock_date = int(time.time()) - 60
+    for target_metadata in cache.metadata.iter_cached_files():
+        target_metadata.set_md_value('cache_lock', lock_date, catalog=False)
+        lock_date -= 1
+
+def summarize(times):
+    """ return stats for a list of durations in seconds """
+    times = sorted(times)
+    count = len(times)
+    if count == 0:
+        return {'count': 0}
+    return {'count': count,
+            'total': sum(times),
+            'mean': sum(times) / count,
+            'median': times[count // 2],
+            'p95': times[min(count - 1, int(count * .95))],
+            'max': times[-1]}
+
+def time_requests(cache, paths, cache_time='1-0:00'):
+    """ stage each path, return list of durations """
+    times = []
+    for path in paths:
+        target = get_target(path, cache.asset_types['file'])
+        start = time.time()
+        cache.add_target(target, cache_time=cache_time)
+        times.append(time.time() - start)
+    return times
+
+def bench_hit(cache, sources, new_sources, arguments):
+    paths = random.sample(sources, min(arguments['repeat'], len(sources)))
+    return summarize(time_requests(cache, paths))
+
+def bench_miss(cache, sources, new_sources, arguments):
+    return summarize(time_requests(cache, new_sources['miss']))
+
+def bench_inspect(cache, sources, new_sources, arguments):
+    times = []
+    for _ in range(max(1, arguments['repeat'] // 10)):
+        start = time.time()
+        cache.inspect_cache()
+        times.append(time.time() - start)
+    return summarize(times)
+
+def bench_evict(cache, sources, new_sources, arguments):
+    """ free enough space that EVICTIONS assets have to go """
+    expire_locks(cache)
+    needed = cache.check_cache_space() \
+            + (arguments['evictions'] - 1) * arguments['asset_bytes'] + 1
+    start = time.time()
+    cache.free_up_cache_space(needed)
+    result = summarize([time.time() - start, ])
+    result['evictions'] = arguments['evictions']
+    return result
+
+def contention_worker(job):
+    """ run in a subprocess: alternate hits and misses on a shared cache """
+    cache_root, hits, misses = job
+    cache = Cache(cache_root)
+    times = []
+    for hit, miss in zip(hits, misses):
+        times.extend(time_requests(cache, [hit, miss]))
+    return times
+
+def bench_contention(cache, sources, new_sources, arguments):
+    procs = arguments['procs']
+    # a small set of hot assets so processes wait on each other's locks
+    hot = random.sample(sources, min(len(sources), procs))
+    jobs = []
+    for i in range(procs):
+        misses = new_sources['contention'][i::procs]
+        hits = [random.choice(hot) for _ in misses]
+        jobs.append((cache.cache_root, hits, misses))
+    start = time.time()
+    with multiprocessing.Pool(procs) as pool:
+        times = [t for worker_times in pool.map(contention_worker, jobs) \
+                 for t in worker_times]
+    result = summarize(times)
+    result['procs'] = procs
+    result['wall'] = time.time() - start
+    return result
+
+BENCH_FUNCTIONS = {'hit': bench_hit,
+                   'miss': bench_miss,
+                   'inspect': bench_inspect,
+                   'evict': bench_evict,
+                   'contention': bench_contention}
+
+def run_benchmarks(work_dir, sizes, benchmarks, arguments):
+    """ return list of result dicts, one per size and benchmark """
+    repeat = arguments['repeat']
+    procs = arguments['procs']
+    asset_bytes = arguments['asset_bytes']
+    extra = {'miss': repeat if 'miss' in benchmarks else 0,
+             'contention': repeat * procs if 'contention' in benchmarks \
+                                          else 0}
+    results = []
+    for size in sizes:
+        all_sources = make_source_files(os.path.join(work_dir, 'source'),
+                                        size + sum(extra.values()),
+                                        asset_bytes)
+        sources = all_sources[:size]
+        new_sources = {}
+        start = size
+        for name, count in extra.items():
+            new_sources[name] = all_sources[start:start + count]
+            start += count
+
+        cache_root = os.path.join(work_dir, 'cache_{}'.format(size))
+        if os.path.exists(cache_root):
+            shutil.rmtree(cache_root)
+        setup_start = time.time()
+        cache = make_synthetic_cache(cache_root, sources, asset_bytes,
+                                     headroom=2 * asset_bytes * start)
+        LOGGER.info("Built cache of %d assets in %.1f seconds", size,
+                    time.time() - setup_start)
+
+        # evict goes last because it expires all the locks
+        for name in sorted(benchmarks, key=BENCHMARKS.index):
+            LOGGER.info("Running %s on %d assets", name, size)
+            result = BENCH_FUNCTIONS[name](cache, sources, new_sources,
+                                           arguments)
+            result.update({'benchmark': name, 'assets': size})
+            LOGGER.info("%s %d: median %.4fs", name, size,
+                        result.get('median', 0))
+            results.append(result)
+
+        if not arguments['keep']:
+            shutil.rmtree(cache_root)
+    return results
+
+def compare_results(results, baseline, tolerance):
+    """ return list of (benchmark, assets, old, new) that slowed down """
+    old_medians = {(r['benchmark'], r['assets']): r['median'] \
+                   for r in baseline['results'] if 'median' in r}
+    slower = []
+    for result in results:
+        key = (result['benchmark'], result['assets'])
+        if key in old_medians and 'median' in result and \
+                result['median'] > old_medians[key] * (1 + tolerance):
+            slower.append(key + (old_medians[key], result['median']))
+    return slower
+
+def main(arguments):
+    logging.basicConfig(level=logging.WARNING)
+    LOGGER.setLevel(logging.INFO)
+    arguments = {
+        'repeat': int(arguments['--repeat']),
+        'evictions': int(arguments['--evictions']),
+        'procs': int(arguments['--procs']),
+        'asset_bytes': int(arguments['--asset_bytes']),
+        'keep': arguments['--keep'],
+        'sizes': [int(float(s)) for s in arguments['--sizes'].split(',')],
+        'benchmarks': arguments['--bench'].split(','),
+        'dir': arguments['--dir'],
+        'output': arguments['--output'],
+        'baseline': arguments['--baseline'],
+        'tolerance': float(arguments['--tolerance']),
+    }
+    for name in arguments['benchmarks']:
+        if name not in BENCH_FUNCTIONS:
+            raise Exception("Unknown benchmark: {}. Use one of: {}".format(
+                name, ", ".join(BENCHMARKS)))
+
+    work_dir = arguments['dir']
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='stagecache_bench.')
+    work_dir = os.path.abspath(work_dir)
+    try:
+        results = run_benchmarks(work_dir, arguments['sizes'],
+                                 arguments['benchmarks'], arguments)
+    finally:
+        if arguments['dir'] is None and not arguments['keep']:
+            shutil.rmtree(work_dir)
+
+    report = {'version': VERSION,
+              'time': time.time(),
+              'node': socket.gethostname(),
+              'python': platform.python_version(),
+              'settings': {k: arguments[k] for k in ['repeat', 'evictions',
+                                                     'procs', 'asset_bytes']},
+              'results': results}
+    if arguments['output'] is None:
+        print(json.dumps(report, indent=1))
+    else:
+        with open(arguments['output'], 'wt') as output_handle:
+            json.dump(report, output_handle, indent=1)
+
+    if arguments['baseline'] is not None:
+        with open(arguments['baseline']) as baseline_handle:
+            baseline = json.load(baseline_handle)
+        slower = compare_results(results, baseline, arguments['tolerance'])
+        for name, size, old, new in slower:
+            print("SLOWER: {} ({} assets): {:.4f}s -> {:.4f}s".format(
+                name, size, old, new), file=sys.stderr)
+        if slower:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -0,0 +1,26 @@
+"""
+Setup shared by the tests
+
+make_cache() stands in for the setup each test module used to repeat: wipe
+the root, create .stagecache.global and write its config. It isn't part of
+any one feature.
+"""
+import os
+import shutil
+import yaml
+from jme.stagecache.cache import Cache
+
+def make_cache(root, clean=(), **config):
+    """ return a Cache in a new, empty root
+
+    config: settings for the cache's config file (eg cache_size=1000)
+    clean: other paths to delete first (eg extra roots or source files) """
+    for path in [root, ] + list(clean):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    os.makedirs(os.path.join(root, '.stagecache.global'))
+    if config:
+        with open(os.path.join(root, '.stagecache.global', 'config'),
+                  'wt') as cfg:
+            yaml.safe_dump(config, cfg, default_flow_style=False)
+    return Cache(root)
@@ -0,0 +1,39 @@
+import gzip
+import os
+from jme.stagecache.access_log import AccessEvent, AccessLog, \
+                                      get_log_files, read_access_log, \
+                                      summarize_access_log
+from jme.stagecache.cache import Cache
+from jme.stagecache.eviction import read_trace
+
+def test_access_log():
+    cache = Cache('test/.cache.tmp')
+    access_log = AccessLog(cache)
+    for log_file in get_log_files(access_log.log_file):
+        os.remove(log_file)
+
+    # a rotated, compressed log
+    with gzip.open(access_log.log_file + '.1.gz', 'wt') as rotated:
+        rotated.write(AccessEvent('/a', 'file', 'miss', 100).to_line())
+        rotated.write(AccessEvent('/b', 'file', 'miss', 50).to_line())
+
+    access_log.write(AccessEvent('/a', 'file', 'hit', 100))
+    access_log.write(AccessEvent('/b', 'file', 'evict', 50))
+    access_log.write(AccessEvent('/b', 'file', 'miss', 50))
+    access_log.write(AccessEvent('/c', 'file', 'error'))
+
+    log_files = get_log_files(access_log.log_file)
+    assert log_files == [access_log.log_file + '.1.gz', access_log.log_file]
+
+    report = summarize_access_log(read_access_log(log_files))
+    assert report['requests'] == 5
+    assert report['hit_ratio'] == 0.2
+    assert report['bytes_saved'] == 100
+    assert report['bytes_transferred'] == 200
+    assert report['bytes_evicted'] == 50
+    assert report['top_misses'][0] == {'target': '/b', 'misses': 2,
+                                       'bytes': 100}
+
+    # the log doubles as a trace for the eviction simulator
+    trace = list(read_trace(access_log.log_file))
+    assert [t[1] for t in trace] == ['/a', '/b']
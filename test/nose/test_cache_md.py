@@ -20,6 +20,8 @@ def test_cache_md():
     # clean up from earlier tests
     if os.path.exists(md.asset_list):
         os.remove(md.asset_list)
+    if os.path.exists(md.journal.journal):
+        os.remove(md.journal.journal)
     if os.path.exists(md.write_lock):
         os.remove(md.write_lock)
 
@@ -34,8 +36,14 @@ def test_cache_md():
     tm1 = TargetMetadata(cache, t1.path_string, 'file')
     tm2 = TargetMetadata(cache, t2.path_string, 'file')
 
-    md.add_cached_file(tm1, 10, int(time.time()) + 0)
+    md.add_cached_file(tm1, 10, int(time.time()) + 0, copied=True)
     md.add_cached_file(tm2, 20, int(time.time()) + 10000000)
+    assert tm1.get_owner() == (os.getuid(), os.getgid())
+
+    # extending the lock doesn't change the owner
+    tm1.set_owner(12345, 678)
+    md.add_cached_file(tm1, 10, int(time.time()) + 0)
+    assert tm1.get_owner() == (12345, 678)
 
     cache_list = list(md.iter_cached_files())
     assert len(cache_list) == 2
@@ -0,0 +1,65 @@
+import os
+import time
+from jme.stagecache.checksum import file_checksum, find_mismatches
+from jme.stagecache.manage import verify_cache
+from jme.stagecache.target import get_target
+from jme.stagecache.text_metadata import TargetMetadata
+from helpers import make_cache
+
+def make_source(name, **config):
+    """ return a cache and a source file for it """
+    cache = make_cache('test/.cache.tmp/' + name, **config)
+    source = os.path.abspath('test/.cache.tmp/{}_source'.format(name))
+    with open(source, 'wt') as source_handle:
+        source_handle.write("some data\n")
+    return cache, source
+
+def test_checksums():
+    assert file_checksum('setup.py') == file_checksum('setup.py', 'crc32') \
+            or file_checksum('setup.py').startswith('xxh64:')
+    assert find_mismatches({'': 'a', '.b': 'b'}, {'': 'a', '.c': 'c'}) == \
+            ['.b', '.c']
+
+def test_verify():
+    cache, source = make_source('verify', cache_checksums=True)
+    cached = cache.add_target(get_target(source, cache.asset_types['file']))
+    target_metadata = TargetMetadata(cache, source, 'file')
+    assert list(target_metadata.get_checksums()) == ['', ]
+
+    report = verify_cache(cache.cache_root)
+    assert report['checked'] == 1
+    assert report['ok'] == 1
+
+    # truncated copy
+    with open(cached, 'wt') as cached_handle:
+        cached_handle.write("some")
+    report = verify_cache(cache.cache_root, targets=[source, ])
+    assert report['ok'] == 0
+    assert report['corrupt'] == [{'target': source, 'atype': 'file',
+                                  'files': [cached, ]}]
+
+    # purge drops it from the cache
+    verify_cache(cache.cache_root, purge=True)
+    assert not os.path.exists(cached)
+    assert cache.metadata.list_assets() == []
+
+def test_skip_unchanged():
+    cache, source = make_source('skip_unchanged', cache_skip_unchanged=True)
+    target = get_target(source, cache.asset_types['file'])
+    cached = cache.add_target(target)
+    cached_mtime = os.path.getmtime(cached)
+
+    # touched, but the same: not copied again
+    later = time.time() + 10
+    os.utime(source, (later, later))
+    cache.add_target(get_target(source, cache.asset_types['file']))
+    assert os.path.getmtime(cached) == cached_mtime
+
+    # changed: copied again
+    with open(source, 'wt') as source_handle:
+        source_handle.write("other data\n")
+    later += 10
+    os.utime(source, (later, later))
+    cache.add_target(get_target(source, cache.asset_types['file']))
+    with open(cached) as cached_handle:
+        assert cached_handle.read() == "other data\n"
@@ -0,0 +1,80 @@
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from jme.stagecache import compression
+from jme.stagecache.compression import get_compression_setting, \
+                                       CompressionStats, run_measured
+from jme.stagecache.types import asset_types
+
+def test_compression_setting():
+    config = {'remote': {'SFTP': {'default': {'compress': 'auto'},
+                                  'nas.edu': {'compress': 'no',
+                                              'compress_method': 'ssh'}}}}
+    assert get_compression_setting(asset_types['file'], config) \
+            == ('auto', 'rsync')
+    assert get_compression_setting(asset_types['file'], config, 'nas.edu') \
+            == (False, 'ssh')
+    # asset type wins
+    assert get_compression_setting(asset_types['taxdump'], config,
+                                   'nas.edu') == (True, 'ssh')
+    assert get_compression_setting(asset_types['file'], {}) \
+            == (False, 'rsync')
+
+def test_compression_stats():
+    md_dir = 'test/.cache.tmp/.stagecache.global'
+    shutil.rmtree(os.path.join(md_dir, 'compression'), ignore_errors=True)
+    stats = CompressionStats(md_dir, 'nas.edu')
+
+    # try compression first, then without
+    assert stats.choose()
+    stats.record(True, 1000, 10, 1, 0o664)
+    assert not stats.choose()
+    stats.record(False, 1000, 2, 1, 0o664)
+
+    # plain is faster
+    assert not stats.choose()
+
+    # CPU bound compression is dropped even if it looks faster
+    stats = CompressionStats(md_dir, 'fast.edu')
+    stats.record(True, 1000, 1, 1, 0o664)
+    stats.record(False, 500, 1, 0, 0o664)
+    assert not stats.choose()
+
+    # threads saving at once don't trip over each other's temp files
+    stats = CompressionStats(md_dir, 'busy.edu')
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda i: stats.record(i % 2, 1000, 1, 0, 0o664),
+                          range(64)))
+    assert sorted(stats.load()) == ['plain', 'z']
+    assert os.listdir(stats.stats_dir).count('busy.edu') == 1
+    assert not [f for f in os.listdir(stats.stats_dir) if f.endswith('.tmp')]
+
+    # and a failed save doesn't fail the transfer
+    stats = CompressionStats(md_dir, 'missing/host')
+    min_sample_seconds = compression.MIN_SAMPLE_SECONDS
+    compression.MIN_SAMPLE_SECONDS = 0
+    try:
+        with stats.sample(True, 1000, 0o664) as measured:
+            measured['cpu_time'] = 0
+    finally:
+        compression.MIN_SAMPLE_SECONDS = min_sample_seconds
+    assert not os.path.exists(stats.stats_file)
+
+def test_run_measured():
+    spin = sys.executable + ' -c "import time; end = time.time() + 0.5; ' \
+            '[0 for _ in iter(lambda: time.time() < end, False)]"'
+    with ThreadPoolExecutor(1) as executor:
+        idle = executor.submit(run_measured, 'sleep 1')
+        busy = run_measured(spin)
+        # the spinner finishing doesn't count against the other transfer
+        assert idle.result() < 0.2
+    assert busy > 0.3
+
+    try:
+        run_measured('exit 3')
+    except subprocess.CalledProcessError as error:
+        assert error.returncode == 3
+    else:
+        assert False, "failure not raised"
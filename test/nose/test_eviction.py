@@ -0,0 +1,62 @@
+import os
+import time
+from jme.stagecache.cache import Cache
+from jme.stagecache.eviction import AssetStats, get_policy, simulate, \
+                                    POLICIES
+from jme.stagecache.text_metadata import TargetMetadata
+
+def test_policy_order():
+    assets = [AssetStats('big_popular', 1000, lock_date=1, last_access=30,
+                         access_count=20),
+              AssetStats('small_old', 10, lock_date=2, last_access=10,
+                         access_count=2),
+              AssetStats('recent_once', 100, lock_date=3, last_access=40,
+                         access_count=1)]
+
+    def first(name):
+        policy = get_policy(name)
+        for asset in assets:
+            policy.on_access(asset)
+        return policy.order(assets)[0].target
+
+    assert first('lock_date') == 'big_popular'
+    assert first('lru') == 'small_old'
+    assert first('lfu') == 'recent_once'
+    assert first('gdsf') == 'recent_once'
+
+def test_simulate():
+    # a small popular file and a stream of big one-off files
+    trace = []
+    for i in range(20):
+        trace.append((i * 10, 'popular', 10))
+        trace.append((i * 10 + 5, 'oneoff.' + str(i), 60))
+
+    results = {name: simulate(policy(), trace, 100)
+               for name, policy in POLICIES.items()}
+    for counts in results.values():
+        assert counts['requests'] == 40
+        assert counts['hits'] + counts['misses'] == 40
+    assert results['gdsf']['hits'] == 19
+    assert results['lfu']['hits'] == 19
+
+    # nothing can be evicted while locked
+    counts = simulate(get_policy('lru'), trace, 100, cache_time=1000)
+    assert counts['bypassed'] > 0
+
+def test_record_access():
+    cache = Cache('test/.cache.tmp')
+    metadata = TargetMetadata(cache, os.path.abspath('eviction.test'),
+                              'file')
+    for md_type in ['access_count', 'last_access', 'priority']:
+        md_file = os.path.join(metadata.md_dir, md_type)
+        if os.path.exists(md_file):
+            os.remove(md_file)
+
+    assert metadata.get_access_count() == 0
+    metadata.record_access()
+    metadata.record_access()
+    assert metadata.get_access_count() == 2
+    assert metadata.get_last_access() <= time.time()
+
+    metadata.set_priority(0.125)
+    assert metadata.get_priority() == 0.125
@@ -0,0 +1,61 @@
+import os
+import time
+from jme.stagecache.cache import InsufficientSpaceError
+from jme.stagecache.target import get_target
+from helpers import make_cache
+
+def make_group(name, sizes):
+    """ return a cache of 1000 bytes and targets of the given sizes """
+    root = 'test/.cache.tmp/' + name
+    source_dir = os.path.abspath('test/.cache.tmp/{}_sources'.format(name))
+    cache = make_cache(root, clean=[source_dir], cache_size=1000)
+    os.makedirs(source_dir)
+    targets = []
+    for i, size in enumerate(sizes):
+        path = os.path.join(source_dir, 'input_{}'.format(i))
+        with open(path, 'wb') as source_handle:
+            source_handle.write(b'x' * size)
+        targets.append(get_target(path, cache.asset_types['file']))
+    return cache, targets
+
+def test_group_space():
+    cache, targets = make_group('group_space', [400, 300, 400])
+
+    # one fits, but all three don't: nothing is copied
+    cache.add_target(targets[0])
+    try:
+        cache.add_targets(targets)
+        assert False, "group should not fit"
+    except InsufficientSpaceError:
+        pass
+    assert [a[0] for a in cache.metadata.list_assets()] == \
+            [targets[0].path_string, ]
+    assert cache.reservations.get_reservations() == []
+
+    # two do
+    cached_paths = cache.add_targets(targets[:2] + targets[:1])
+    assert len(cached_paths) == 3
+    assert cached_paths[0] == cached_paths[2]
+    assert all(os.path.exists(p) for p in cached_paths)
+    assert cache.inspect_cache()['used'] == 700
+
+def test_group_failure():
+    cache, targets = make_group('group_failure', [100, 200, 300])
+    copy_target = cache.copy_target
+
+    def fail_third(target, target_metadata, *args, **kwargs):
+        if target.path_string == targets[2].path_string:
+            raise IOError("copy failed")
+        return copy_target(target, target_metadata, *args, **kwargs)
+    cache.copy_target = fail_third
+    try:
+        cache.add_targets(targets)
+        assert False, "copy didn't fail"
+    except IOError:
+        pass
+
+    # the copies that worked are kept but can be evicted
+    files = cache.inspect_cache()['files']
+    assert sorted(files) == [t.path_string for t in targets[:2]]
+    assert all(f['lock'] <= time.time() for f in files.values())
+    assert cache.reservations.get_reservations() == []
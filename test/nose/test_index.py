@@ -0,0 +1,92 @@
+import os
+import shutil
+import struct
+from jme.stagecache.cache import Cache
+from jme.stagecache import index
+from jme.stagecache.index import IndexVersionError, hash_path
+from jme.stagecache.text_metadata import TargetMetadata
+
+def test_index():
+    root = 'test/.cache.tmp/index'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+    md = cache.metadata
+
+    metadatas = [TargetMetadata(cache, '/data/{}'.format(i), 'file') \
+                 for i in range(5)]
+    for i, metadata in enumerate(metadatas):
+        md.add_cached_file(metadata, 10 * (i + 1), 1000 + i)
+    metadatas[0].record_access(when=500)
+    metadatas[0].set_priority(1.5)
+    md.remove_cached_files(metadatas[3:])
+
+    # writes to md files show up in the index
+    records = cache.index.read()
+    assert len(records) == 3
+    record = records[hash_path('/data/0')]
+    assert record.size == 10
+    assert record.lock_date == 1000
+    assert record.last_access == 500
+    assert record.access_count == 1
+    assert record.priority == 1.5
+    assert cache.index.get('/data/2').size == 30
+    # ids past 2**31 (eg from LDAP or idmapping) fit
+    metadatas[1].set_owner(2 ** 32 - 2, 2 ** 31)
+    assert cache.index.get('/data/1')[-2:] == (2 ** 32 - 2, 2 ** 31)
+    with cache.index.lock():
+        cache.index.rebuild()
+    assert cache.index.get('/data/1')[-2:] == (2 ** 32 - 2, 2 ** 31)
+    assert cache.index.get('/data/4') is None
+
+    # inspect reads the index
+    files = cache.inspect_cache()['files']
+    assert sorted(files) == ['/data/0', '/data/1', '/data/2']
+    assert files['/data/1'] == {'size': 20, 'type': 'file', 'lock': 1001}
+    assert [a.target for a in cache.get_evictable_assets()] == \
+            ['/data/0', '/data/1', '/data/2']
+
+    # an index from another version is rebuilt from the md files
+    with open(cache.index.index_file, 'r+b') as index_handle:
+        index_handle.seek(4)
+        index_handle.write(struct.pack('<H', index.INDEX_VERSION + 1))
+    try:
+        cache.index.read()
+        assert False, "old index was read"
+    except IndexVersionError:
+        pass
+    assert cache.inspect_cache()['files']['/data/2']['size'] == 30
+    assert len(cache.index.read()) == 3
+
+    # the table grows when it gets half full
+    min_capacity = index.MIN_CAPACITY
+    index.MIN_CAPACITY = 4
+    try:
+        os.remove(cache.index.index_file)
+        for i in range(5, 12):
+            metadata = TargetMetadata(cache, '/data/{}'.format(i), 'file')
+            md.add_cached_file(metadata, 1, 1000)
+    finally:
+        index.MIN_CAPACITY = min_capacity
+    with open(cache.index.index_file, 'rb') as index_handle:
+        capacity, used = cache.index.check_header(
+            index_handle.read(index.HEADER.size))
+    assert used == 10
+    assert capacity >= 2 * used
+    assert len(cache.index.read()) == 10
+
+    # deleted records are dropped, the table only grows for live ones
+    index.MIN_CAPACITY = 4
+    try:
+        for i in range(12, 60):
+            metadata = TargetMetadata(cache, '/data/{}'.format(i), 'file')
+            md.add_cached_file(metadata, 1, 1000)
+            md.remove_cached_file(metadata)
+    finally:
+        index.MIN_CAPACITY = min_capacity
+    with open(cache.index.index_file, 'rb') as index_handle:
+        churn_capacity, used = cache.index.check_header(
+            index_handle.read(index.HEADER.size))
+    assert churn_capacity == capacity
+    assert len(cache.index.read()) == 10
+    assert cache.inspect_cache()['used'] == 67
@@ -0,0 +1,53 @@
+import os
+import time
+from jme.stagecache.text_metadata import TargetMetadata
+from helpers import make_cache
+
+def test_iter_inspect():
+    cache = make_cache('test/.cache.tmp/inspect', cache_size=10000)
+
+    now = int(time.time())
+    for path, atype, size, lock_date in [('/data/a', 'file', 100, now - 10),
+                                         ('/data/b', 'file', 300, now + 100),
+                                         ('/db/c', 'prefix', 200, now + 50),
+                                         ('/db/d', 'prefix', 50, now - 20)]:
+        metadata = TargetMetadata(cache, path, atype)
+        cache.metadata.add_cached_file(metadata, size, lock_date, copied=True)
+
+    # in index order
+    assets = sorted(cache.iter_inspect(), key=lambda a: a['target'])
+    assert [a['target'] for a in assets] == \
+            ['/data/a', '/data/b', '/db/c', '/db/d']
+    assert assets[2] == {'target': '/db/c', 'type': 'prefix', 'size': 200,
+                         'lock': now + 50, 'uid': os.getuid(),
+                         'gid': os.getgid(), 'root': cache.cache_root}
+
+    def targets(**kwargs):
+        found = [a['target'] for a in cache.iter_inspect(**kwargs)]
+        return found if 'sort' in kwargs else sorted(found)
+    assert targets(atype='prefix') == ['/db/c', '/db/d']
+    assert targets(prefix='/data/') == ['/data/a', '/data/b']
+    assert targets(expired=True) == ['/data/a', '/db/d']
+    assert targets(expired=False) == ['/data/b', '/db/c']
+    assert targets(min_size=100) == ['/data/b', '/db/c']
+    assert targets(sort='size') == ['/data/b', '/db/c', '/data/a', '/db/d']
+    assert targets(sort='lock', expired=False) == ['/db/c', '/data/b']
+
+    summary = cache.inspect_summary()
+    assert summary['assets'] == 4
+    assert summary['used'] == 650
+    assert summary['free'] == 9350
+    assert summary['expired_assets'] == 2
+    assert summary['expired_bytes'] == 150
+    assert summary['types'] == {'file': {'assets': 2, 'used': 400},
+                                'prefix': {'assets': 2, 'used': 250}}
+
+    summary = cache.inspect_summary(prefix='/db/', expired=True)
+    assert (summary['assets'], summary['used']) == (1, 50)
+    assert summary['free'] == 9350
+
+    # a missing index is rebuilt as it's read
+    os.remove(cache.index.index_file)
+    assert targets(prefix='/db/') == ['/db/c', '/db/d']
+    os.remove(cache.index.index_file)
+    assert cache.inspect_summary()['used'] == 650
@@ -0,0 +1,97 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+from jme.stagecache.cache import Cache
+from jme.stagecache import text_metadata
+from jme.stagecache.text_metadata import TargetMetadata, read_asset_file
+
+def test_journal():
+    root = 'test/.cache.tmp/journal'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+    md = cache.metadata
+    journal = md.journal
+
+    metadatas = [TargetMetadata(cache, '/data/{}'.format(i), 'file') \
+                 for i in range(5)]
+    for metadata in metadatas:
+        md.add_cached_file(metadata, 10, 0)
+    md.remove_cached_files(metadatas[1:3])
+
+    # only the journal has been written to
+    assert not os.path.exists(journal.snapshot)
+    assert len(read_asset_file(journal.journal)[1]) == 7
+    assert [a[0] for a in md.list_assets()] == \
+            ['/data/0', '/data/3', '/data/4']
+
+    # a partly written line is ignored
+    with open(journal.journal, 'at') as journal_handle:
+        journal_handle.write('+\t/data/partial')
+    assert len(md.list_assets()) == 3
+
+    # compaction writes a new snapshot and empties the journal
+    with journal.lock():
+        journal.compact()
+    assert read_asset_file(journal.snapshot)[0] == 1
+    assert read_asset_file(journal.journal) == (1, [])
+    assert [a[0] for a in md.list_assets()] == \
+            ['/data/0', '/data/3', '/data/4']
+
+    # a journal left over from before compaction is not replayed
+    journal.write_asset_file(journal.journal, 0, [('-', '/data/0', 'file')])
+    assert len(md.list_assets()) == 3
+    os.remove(journal.journal)
+
+    # compaction died after the snapshot was written: the stale journal is
+    #  replaced, so new changes aren't lost
+    journal.write_asset_file(journal.journal, 1, [])
+    journal.write_asset_file(journal.snapshot, 2,
+                             read_asset_file(journal.snapshot)[1].items())
+    md.add_cached_file(metadatas[1], 10, 0)
+    assert read_asset_file(journal.journal)[0] == 2
+    assert [a[0] for a in md.list_assets()] == \
+            ['/data/0', '/data/3', '/data/4', '/data/1']
+    md.remove_cached_files(metadatas[1:2])
+
+    # unlisted targets in a batch are skipped, the rest are removed
+    assert md.remove_cached_files(metadatas[:2]) == 10
+    assert [a[0] for a in md.list_assets()] == ['/data/3', '/data/4']
+    md.add_cached_file(metadatas[0], 10, 0)
+    os.remove(journal.journal)
+
+    # big journals are compacted automatically
+    compact_size = text_metadata.COMPACT_SIZE
+    text_metadata.COMPACT_SIZE = 10
+    try:
+        for _ in range(3):
+            for metadata in metadatas[1:3]:
+                md.add_cached_file(metadata, 10, 0)
+            md.remove_cached_files(metadatas[1:3])
+        for metadata in metadatas[1:3]:
+            md.add_cached_file(metadata, 10, 0)
+    finally:
+        text_metadata.COMPACT_SIZE = compact_size
+    assert read_asset_file(journal.snapshot)[0] > 1
+    assert os.path.getsize(journal.journal) < 100
+    assert len(md.list_assets()) == 5
+
+def test_dead_lock_holder():
+    root = 'test/.cache.tmp/journal_lock'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+
+    # a process killed while holding the journal lock doesn't keep it
+    script = ("import os, signal; from jme.stagecache.cache import Cache; "
+              "cache = Cache({!r});\n"
+              "with cache.metadata.journal.lock():\n"
+              "    os.kill(os.getpid(), signal.SIGKILL)").format(root)
+    result = subprocess.run([sys.executable, '-c', script])
+    assert result.returncode == -signal.SIGKILL
+    assert os.path.exists(cache.metadata.journal.write_lock)
+    cache.metadata.add_cached_file(TargetMetadata(cache, '/data/x', 'file'),
+                                   10, 0)
+    assert '/data/x' in dict(cache.metadata.list_assets())
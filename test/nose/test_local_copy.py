@@ -0,0 +1,130 @@
+import ctypes
+import errno
+import os
+import shutil
+from jme.stagecache import local_copy
+from jme.stagecache.local_copy import copy_file
+
+def make_source(name, size):
+    root = 'test/.cache.tmp/' + name
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+    source = os.path.join(root, 'source')
+    with open(source, 'wb') as source_handle:
+        source_handle.write(bytes(range(256)) * (size // 256))
+    os.utime(source, (1000000000, 1000000000))
+    return source, os.path.join(root, 'copy')
+
+def check_copy(source, dest):
+    with open(source, 'rb') as src, open(dest, 'rb') as dst:
+        assert src.read() == dst.read()
+    assert os.path.getmtime(dest) == 1000000000
+
+def test_copy_file():
+    source, dest = make_source('local_copy', 256 * 1000)
+    assert copy_file(source, dest) in ['clone', 'copy_file_range',
+                                       'sendfile', 'read/write']
+    check_copy(source, dest)
+
+    # throttled copies go in chunks
+    chunk_size = local_copy.CHUNK_SIZE
+    local_copy.CHUNK_SIZE = 25600
+    try:
+        os.remove(dest)
+        copy_file(source, dest, bwlimit=1e9)
+    finally:
+        local_copy.CHUNK_SIZE = chunk_size
+    check_copy(source, dest)
+
+def test_copy_fallback():
+    source, dest = make_source('local_copy_fallback', 256 * 1000)
+
+    def unsupported(src_fd, dest_fd, offset, count):
+        raise OSError(errno.EXDEV, "cross device")
+
+    def partial(src_fd, dest_fd, offset, count):
+        if offset > 0:
+            raise OSError(errno.EOPNOTSUPP, "not supported")
+        return local_copy.buffer_range(src_fd, dest_fd, offset, 1000)
+
+    range_methods = local_copy.RANGE_METHODS
+    clone = local_copy.clone
+    local_copy.RANGE_METHODS = [('first', unsupported), ('second', partial),
+                                ('read/write', local_copy.buffer_range)]
+    local_copy.clone = lambda src_fd, dest_fd: False
+    try:
+        assert copy_file(source, dest) == 'read/write'
+    finally:
+        local_copy.RANGE_METHODS = range_methods
+        local_copy.clone = clone
+    check_copy(source, dest)
+
+def test_copy_no_space():
+    source, dest = make_source('local_copy_no_space', 256 * 1000)
+
+    def no_space(dest_fd, size):
+        raise OSError(errno.ENOSPC, "no space left on device")
+
+    preallocate = local_copy.preallocate
+    clone = local_copy.clone
+    local_copy.preallocate = no_space
+    local_copy.clone = lambda src_fd, dest_fd: False
+    try:
+        copy_file(source, dest)
+        assert False, "copy should fail"
+    except OSError as error:
+        assert error.errno == errno.ENOSPC
+    finally:
+        local_copy.preallocate = preallocate
+        local_copy.clone = clone
+
+    # no partial or temp files are left
+    assert os.listdir(os.path.dirname(dest)) == ['source', ]
+
+def test_preallocate():
+    source, dest = make_source('local_copy_preallocate', 10)
+    with open(dest, 'wb') as dest_handle:
+        local_copy.preallocate(dest_handle.fileno(), 1000)
+    if local_copy.FALLOCATE is not None:
+        assert os.path.getsize(dest) in [0, 1000]
+
+    def fail_with(error):
+        def fallocate(fd, mode, offset, length):
+            ctypes.set_errno(error)
+            return -1
+        return fallocate
+
+    fallocate = local_copy.FALLOCATE
+    try:
+        # eg NFS 3: skipped
+        local_copy.FALLOCATE = fail_with(errno.EOPNOTSUPP)
+        with open(dest, 'wb') as dest_handle:
+            local_copy.preallocate(dest_handle.fileno(), 1000)
+        local_copy.FALLOCATE = fail_with(errno.ENOSPC)
+        with open(dest, 'wb') as dest_handle:
+            local_copy.preallocate(dest_handle.fileno(), 1000)
+        assert False, "ENOSPC not raised"
+    except OSError as error:
+        assert error.errno == errno.ENOSPC
+    finally:
+        local_copy.FALLOCATE = fallocate
+
+def test_supports_fallocate():
+    source, dest = make_source('local_copy_supports', 10)
+    fallocate = local_copy.FALLOCATE
+    try:
+        # eg NFS 3: rsync isn't asked to preallocate either
+        local_copy.FALLOCATE_SUPPORT.clear()
+        local_copy.FALLOCATE = lambda fd, mode, offset, length: \
+                ctypes.set_errno(errno.EOPNOTSUPP) or -1
+        assert not local_copy.supports_fallocate(dest + '.d/new/file')
+        local_copy.FALLOCATE_SUPPORT.clear()
+        local_copy.FALLOCATE = lambda fd, mode, offset, length: 0
+        assert local_copy.supports_fallocate(dest)
+        # checked once per filesystem
+        local_copy.FALLOCATE = None
+        assert local_copy.supports_fallocate(os.path.dirname(dest))
+    finally:
+        local_copy.FALLOCATE = fallocate
+        local_copy.FALLOCATE_SUPPORT.clear()
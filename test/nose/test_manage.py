@@ -0,0 +1,169 @@
+import os
+import shutil
+import time
+from jme.stagecache.cache import Cache
+from jme.stagecache.manage import reconcile_cache, find_unlisted_assets, \
+                                 plan_eviction, execute_eviction, repair_cache
+from jme.stagecache.text_metadata import TargetMetadata
+
+def add_asset(cache, name, size=10, listed=True):
+    metadata = TargetMetadata(cache, '/data/' + name, 'file')
+    with open(metadata.cached_target, 'wt') as cached_file:
+        cached_file.write('x' * size)
+    if listed:
+        cache.metadata.add_cached_file(metadata, size, int(time.time()))
+    else:
+        metadata.set_cached_target_size(size)
+        metadata.set_cache_lock_date(int(time.time()))
+    return metadata
+
+def test_reconcile():
+    root = 'test/.cache.tmp/reconcile'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+
+    add_asset(cache, 'ok')
+    unlisted = add_asset(cache, 'unlisted', listed=False)
+    missing = add_asset(cache, 'missing')
+    os.remove(missing.cached_target)
+    wrong_size = add_asset(cache, 'wrong_size')
+    wrong_size.set_cached_target_size(5)
+    orphan = TargetMetadata(cache, '/data/orphan', 'file')
+    stale = add_asset(cache, 'stale')
+    with open(stale.write_lock, 'wt') as lock:
+        lock.write('locked')
+    os.utime(stale.write_lock, (1, 1))
+    in_use = TargetMetadata(cache, '/data/in_use', 'file')
+    with open(in_use.write_lock, 'wt') as lock:
+        lock.write('locked')
+    # unlisted, but the index knows the type
+    tree = TargetMetadata(cache, '/data/tree', 'dir')
+    os.makedirs(tree.cached_target)
+    with open(os.path.join(tree.cached_target, 'a'), 'wt') as cached_file:
+        cached_file.write('x' * 10)
+    tree.set_cached_target_size(10)
+    tree.set_cache_lock_date(int(time.time()))
+    # unlisted and of no known type
+    mystery = TargetMetadata(cache, '/data/mystery', 'taxdb')
+    mystery.set_cached_target_size(10)
+    mystery.set_cache_lock_date(int(time.time()))
+
+    assert sorted(find_unlisted_assets(root)) == ['/data/tree',
+                                                  '/data/unlisted']
+
+    report = reconcile_cache(root, dry_run=True, threads=2)
+    assert report['listed'] == 4
+    assert report['scanned'] == 9
+    assert sorted((a['target'], a['atype']) for a in report['unlisted']) == \
+            [('/data/tree', 'dir'), ('/data/unlisted', 'file')]
+    assert report['unidentified'] == ['/data/mystery']
+    assert [a['target'] for a in report['missing']] == ['/data/missing']
+    assert report['orphans'] == [orphan.md_dir]
+    assert report['stale_locks'] == [stale.write_lock]
+    assert report['size_mismatches'] == [{'target': '/data/wrong_size',
+                                          'atype': 'file',
+                                          'recorded': 5,
+                                          'actual': 10}]
+    # nothing changed
+    assert os.path.exists(orphan.md_dir)
+    assert len(cache.metadata.list_assets()) == 4
+
+    reconcile_cache(root, threads=2)
+    assert sorted(a[0] for a in cache.metadata.list_assets()) == \
+            ['/data/ok', '/data/stale', '/data/tree', '/data/unlisted']
+    assert not os.path.exists(orphan.md_dir)
+    # left alone
+    assert os.path.exists(mystery.md_dir)
+    assert not os.path.exists(stale.write_lock)
+    assert os.path.exists(in_use.write_lock)
+    # dropped to be copied again
+    assert not os.path.exists(wrong_size.cached_target)
+    assert unlisted.get_cached_target_size()[0] == 10
+
+    # a copier's temp file in a tree doesn't count toward its size
+    with open(os.path.join(tree.cached_target, '.b.12345.tmp'), 'wt') \
+            as tmp_file:
+        tmp_file.write('x' * 5)
+    report = reconcile_cache(root, threads=2)
+    for problem in ['unlisted', 'missing', 'orphans', 'stale_locks',
+                    'size_mismatches']:
+        assert report[problem] == [], problem
+
+def test_repair_recopied():
+    root = 'test/.cache.tmp/reconcile_recopied'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+    gone = add_asset(cache, 'gone')
+    os.remove(gone.cached_target)
+    report = reconcile_cache(root, dry_run=True, threads=2)
+    assert [a['target'] for a in report['missing']] == ['/data/gone']
+
+    # copied again before the repair
+    add_asset(cache, 'gone')
+    repair_cache(cache, report)
+    assert [a[0] for a in cache.metadata.list_assets()] == ['/data/gone']
+    assert gone.get_cached_target_size()[0] == 10
+
+def test_plan_eviction():
+    root = 'test/.cache.tmp/free'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+
+    now = int(time.time())
+    for i, name in enumerate(['a.txt', 'b.txt', 'c.gz', 'd.txt']):
+        metadata = add_asset(cache, name, size=100)
+        metadata.set_cache_lock_date(now - 100 + i)
+    locked = add_asset(cache, 'locked.txt', size=100)
+    locked.set_cache_lock_date(now + 1000)
+
+    plan = plan_eviction(cache, 150, suffix='.txt')
+    assert [a.target for a in plan] == ['/data/a.txt', '/data/b.txt']
+    plan = plan_eviction(cache, '1K', prefix='/data/c')
+    assert [a.target for a in plan] == ['/data/c.gz']
+    plan = plan_eviction(cache, '1K', atype='file')
+    assert len(plan) == 4
+    plan = plan_eviction(cache, '1K', include_locked=True)
+    assert plan[-1].target == '/data/locked.txt'
+
+    assert execute_eviction(cache, plan, dry_run=True) == (500, [])
+    assert len(cache.metadata.list_assets()) == 5
+
+    plan = plan_eviction(cache, 250)
+    assert execute_eviction(cache, plan) == (300, [])
+    assert [a[0] for a in cache.metadata.list_assets()] == \
+            ['/data/d.txt', '/data/locked.txt']
+    assert not os.path.exists(plan[0].metadata.cached_target)
+
+def test_eviction_changed():
+    root = 'test/.cache.tmp/free_changed'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+
+    now = int(time.time())
+    for i, name in enumerate(['gone', 'in_use', 'relocked', 'ok']):
+        metadata = add_asset(cache, name, size=100)
+        metadata.set_cache_lock_date(now - 100 + i)
+    locked = add_asset(cache, 'locked', size=100)
+    locked.set_cache_lock_date(now + 1000)
+    plan = plan_eviction(cache, '1K', include_locked=True)
+    assert len(plan) == 5
+
+    # things change before the plan is carried out
+    by_target = {asset.target: asset for asset in plan}
+    with cache.metadata.lock():
+        cache.remove_cached_files([by_target['/data/gone'].metadata])
+    with open(by_target['/data/in_use'].metadata.write_lock, 'wt') as lock:
+        lock.write('locked')
+    by_target['/data/relocked'].metadata.set_cache_lock_date(now + 1000)
+
+    space_freed, skipped = execute_eviction(cache, plan)
+    assert space_freed == 200
+    assert sorted(a.target for a in skipped) == \
+            ['/data/gone', '/data/in_use', '/data/relocked']
+    assert sorted(a[0] for a in cache.metadata.list_assets()) == \
+            ['/data/in_use', '/data/relocked']
+    assert os.path.exists(by_target['/data/relocked'].metadata.cached_target)
@@ -0,0 +1,42 @@
+import os
+from jme.stagecache.access_log import AccessEvent
+from jme.stagecache.cache import Cache
+from jme.stagecache.metrics import MetricsExporter
+
+def test_metrics_counters():
+    cache = Cache('test/.cache.tmp')
+    exporter = MetricsExporter(cache)
+    for md_file in [exporter.state_file, exporter.log_file,
+                    exporter.log_file + '.1']:
+        if os.path.exists(md_file):
+            os.remove(md_file)
+
+    cache.access_log.write(AccessEvent('/a', 'file', 'miss', 100))
+    counters = exporter.update_counters()
+    assert counters['requests_total']['miss'] == 1
+    assert counters['transfer_bytes_total'] == 100
+
+    # only new lines are counted
+    cache.access_log.write(AccessEvent('/a', 'file', 'hit', 100))
+    counters = exporter.update_counters()
+    assert counters['requests_total']['miss'] == 1
+    assert counters['requests_total']['hit'] == 1
+
+    # rotate log after one more event
+    cache.access_log.write(AccessEvent('/a', 'file', 'evict', 100))
+    os.rename(exporter.log_file, exporter.log_file + '.1')
+    cache.access_log.write(AccessEvent('/b', 'file', 'miss', 10))
+    counters = exporter.update_counters()
+    assert counters['evictions_total'] == 1
+    assert counters['transfer_bytes_total'] == 110
+    assert counters['lock_wait_count'] == 3
+
+def test_metrics_file():
+    cache = Cache('test/.cache.tmp')
+    metrics_file = 'test/.cache.tmp/metrics.prom'
+    cache.export_metrics(metrics_file)
+    with open(metrics_file) as metrics_handle:
+        metrics_text = metrics_handle.read()
+    assert 'stagecache_used_bytes{cache="' in metrics_text
+    assert '# TYPE stagecache_lock_wait_seconds histogram' in metrics_text
+    assert not os.path.exists(metrics_file + '.{}.tmp'.format(os.getpid()))
@@ -0,0 +1,41 @@
+import time
+from jme.stagecache.manage import plan_eviction
+from jme.stagecache.quota import Quotas
+from jme.stagecache.text_metadata import TargetMetadata
+from helpers import make_cache
+
+def test_quotas():
+    cache = make_cache('test/.cache.tmp/quota', cache_size=10000,
+                       cache_eviction='lock_date',
+                       cache_quotas={'users': {1001: 300, 'default': 1000}})
+    assert cache.quotas.get_limit('users', 1001) == 300
+    assert cache.quotas.get_limit('users', 1002) == 1000
+    assert cache.quotas.get_limit('groups', 1001) is None
+    assert not Quotas()
+
+    # user 1001 has 500 bytes, 200 over quota
+    now = int(time.time())
+    for name, uid, size, lock_date in [('a', 1002, 100, now - 30),
+                                       ('b', 1001, 150, now - 20),
+                                       ('c', 1002, 100, now - 10),
+                                       ('d', 1001, 150, now - 5),
+                                       ('e', 1001, 200, now + 100)]:
+        metadata = TargetMetadata(cache, '/data/' + name, 'file')
+        cache.metadata.add_cached_file(metadata, size, lock_date)
+        metadata.set_owner(uid, 100)
+    assert cache.index.get('/data/e').uid == 1001
+
+    # 1001's expired files go first, but only until it's under quota
+    assert [a.target for a in cache.get_evictable_assets()] == \
+            ['/data/b', '/data/d', '/data/a', '/data/c']
+    assert [a.target for a in plan_eviction(cache, 200)] == \
+            ['/data/b', '/data/d']
+
+    metadata = TargetMetadata(cache, '/data/e', 'file')
+    metadata.set_cached_target_size(100)
+    assert [a.target for a in cache.get_evictable_assets()] == \
+            ['/data/b', '/data/a', '/data/c', '/data/d']
+
+    report = cache.inspect_summary()['quotas']['users']
+    assert [(u['used'], u['quota']) for u in report.values()] == \
+            [(400, 300), (200, 1000)]
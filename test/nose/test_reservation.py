@@ -0,0 +1,58 @@
+import os
+import subprocess
+import time
+from jme.stagecache.reservation import Reservation
+from jme.stagecache.target import get_target
+from helpers import make_cache
+
+def test_reservations():
+    cache = make_cache('test/.cache.tmp/reservation', cache_size=10000)
+    reservations = cache.reservations
+
+    # reserved space isn't free
+    reservation = reservations.reserve('/data/a', 3000)
+    assert cache.inspect_cache()['free'] == 7000
+    assert cache.inspect_cache()['reserved'] == 3000
+    reservations.release(reservation)
+    reservations.release(reservation)
+    assert cache.inspect_cache()['free'] == 10000
+
+    # reservations of dead processes and timed out ones are dropped
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    reservation = reservations.reserve('/data/b', 1000)
+    dead_file = reservation.reservation_file.replace(
+        ".{}.".format(os.getpid()), ".{}.".format(dead.pid))
+    Reservation(dead_file, '/data/b', 1000, time.time() + 60).write(0o664)
+    reservations.timeout = -1
+    reservations.reserve('/data/c', 1000)
+    assert [r.target_path for r in reservations.get_reservations()] == \
+            ['/data/b', ]
+    assert sorted(os.listdir(reservations.md_dir)) == \
+            [os.path.basename(reservation.reservation_file), ]
+    reservations.release(reservation)
+
+def test_failed_copy():
+    cache = make_cache('test/.cache.tmp/reservation_copy')
+    target = get_target(os.path.abspath('setup.py'),
+                        cache.asset_types['file'])
+
+    def fail_copy(*args, **kwargs):
+        assert cache.inspect_cache()['reserved'] == target.get_size()
+        raise IOError("copy failed")
+    copy_target = cache.copy_target
+    cache.copy_target = fail_copy
+    try:
+        cache.add_target(target)
+        assert False, "copy didn't fail"
+    except IOError:
+        pass
+    assert cache.metadata.list_assets() == []
+    assert cache.reservations.get_reservations() == []
+
+    cache.copy_target = copy_target
+    cached_path = cache.add_target(target)
+    assert os.path.exists(cached_path)
+    assert cache.inspect_cache()['files'][target.path_string]['size'] == \
+            target.get_size()
+    assert cache.reservations.get_reservations() == []
@@ -0,0 +1,72 @@
+import os
+from jme.stagecache.cache import Cache, InsufficientSpaceError
+from jme.stagecache.text_metadata import TargetMetadata
+from helpers import make_cache
+
+def make_roots(root, extra_roots, placement):
+    return make_cache(root, clean=extra_roots, cache_size=10000,
+                      cache_placement=placement,
+                      cache_roots=[os.path.abspath(p) for p in extra_roots])
+
+def test_roots():
+    extra_roots = ['test/.cache.tmp/multi_b', 'test/.cache.tmp/multi_c']
+    cache = make_roots('test/.cache.tmp/multi_a', extra_roots, 'hash')
+    assert len(cache.roots) == 3
+    assert all(os.path.exists(root) for root in cache.roots)
+
+    # hash placement spreads assets and is stable
+    paths = ['/data/file.{}'.format(i) for i in range(30)]
+    roots = {path: cache.get_root(path) for path in paths}
+    assert len(set(roots.values())) == 3
+    cache = Cache('test/.cache.tmp/multi_a')
+    assert all(cache.get_root(path) == roots[path] for path in paths)
+
+    # existing assets are found where they are, whatever the placement
+    metadata = TargetMetadata(cache, paths[0], 'file')
+    assert metadata.cache_root == roots[paths[0]]
+    cache.placement = 'free_space'
+    assert cache.get_root(paths[0]) == roots[paths[0]]
+
+    # inspect adds up all the roots
+    for path in paths[:6]:
+        metadata = TargetMetadata(cache, path, 'file')
+        cache.metadata.add_cached_file(metadata, 100, 0)
+    cache_data = cache.inspect_cache()
+    assert cache_data['used'] == 600
+    assert cache_data['free'] == 9400
+    assert sum(r['used'] for r in cache_data['roots'].values()) == 600
+
+def test_full_root():
+    extra_roots = ['test/.cache.tmp/full_b', ]
+    cache = make_roots('test/.cache.tmp/full_a', extra_roots, 'hash')
+    full_root, other_root = cache.roots
+    # pretend the roots are on different filesystems and the first is full
+    cache.get_device = lambda root: root
+    cache.get_device_free_space = \
+            lambda root: 50 if root == full_root else 10 ** 9
+
+    # expired assets on both roots, the other root's go first
+    paths = ['/data/file.{}'.format(i) for i in range(10)]
+    for path in paths:
+        metadata = TargetMetadata(cache, path, 'file')
+        lock_date = 1 if metadata.cache_root == other_root else 2
+        cache.metadata.add_cached_file(metadata, 100, lock_date)
+    on_full = [p for p in paths if cache.get_root(p) == full_root]
+    assert on_full and len(on_full) < len(paths)
+
+    # the cache has room, but not the destination root
+    assert cache.check_cache_space() == 9000
+    assert cache.pick_evictions(100)[1] == []
+    fits, picked = cache.pick_evictions(100, root=full_root)
+    assert fits
+    assert [a.target for a in picked] == on_full[:1]
+    fits, picked = cache.pick_evictions(100, root=other_root)
+    assert fits and picked == []
+
+    # nothing on the full root to evict
+    try:
+        cache.free_up_cache_space(100, keep=set(on_full), root=full_root)
+    except InsufficientSpaceError:
+        pass
+    else:
+        assert False, "copying into a full root should fail"
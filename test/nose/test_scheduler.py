@@ -0,0 +1,115 @@
+import os
+import socket
+import threading
+import time
+from jme.stagecache.cache import Cache
+from jme.stagecache.scheduler import Ticket
+
+def make_ticket(queue, count, host, size, priority=0, age=0,
+                state='waiting'):
+    ticket_file = os.path.join(queue.md_dir, "{}.{}.{}".format(
+        socket.gethostname(), os.getpid(), count))
+    return Ticket(ticket_file, host, size, priority, time.time() - age,
+                  state)
+
+def test_transfer_queue_order():
+    cache = Cache('test/.cache.tmp')
+    queue = cache.transfers
+    queue.slots = 2
+    queue.per_host = 1
+    queue.aging = 100
+
+    small = make_ticket(queue, 1, 'nas1', 10)
+    big = make_ticket(queue, 2, 'nas1', 1000)
+    other = make_ticket(queue, 3, 'nas2', 1000)
+    tickets = [small, big, other]
+
+    # smallest first, other hosts are not blocked
+    assert queue.may_start(small, tickets)
+    assert not queue.may_start(big, tickets)
+    assert queue.may_start(other, tickets)
+
+    # host limit
+    small.state = 'active'
+    assert not queue.may_start(big, tickets)
+
+    # total limit
+    small.state = 'waiting'
+    busy = [make_ticket(queue, 4, 'nas3', 1, state='active'),
+            make_ticket(queue, 5, 'nas4', 1, state='active')]
+    assert not queue.may_start(small, tickets + busy)
+
+    # priority and aging jump the queue
+    urgent = make_ticket(queue, 6, 'nas1', 1000, priority=5)
+    assert queue.may_start(urgent, tickets + [urgent])
+    old = make_ticket(queue, 7, 'nas1', 5000, age=200)
+    assert queue.may_start(old, tickets + [urgent, old])
+
+def test_transfer_slot():
+    cache = Cache('test/.cache.tmp')
+    queue = cache.transfers
+    queue.slots = 1
+    queue.bandwidth = 1000
+
+    with queue.slot('nas1', 10) as bwlimit:
+        assert bwlimit == 1000
+        assert len(queue.load_tickets()) == 1
+    assert len(queue.load_tickets()) == 0
+
+def test_stale_tickets():
+    cache = Cache('test/.cache.tmp')
+    queue = cache.transfers
+    queue.slots = 1
+    queue.timeout = 0.3
+    os.makedirs(queue.md_dir, exist_ok=True)
+
+    # a crashed process on another node
+    fresh = Ticket(os.path.join(queue.md_dir, 'other-node.123.1'), 'nas1',
+                   10, 0, time.time())
+    fresh.write(0o664)
+    old = Ticket(os.path.join(queue.md_dir, 'other-node.123.2'), 'nas1',
+                 10, 0, time.time())
+    old.write(0o664)
+    os.utime(old.ticket_file, (time.time() - 60, time.time() - 60))
+    assert [t.ticket_file for t in queue.load_tickets()] == \
+            [fresh.ticket_file]
+    assert not os.path.exists(old.ticket_file)
+    os.remove(fresh.ticket_file)
+
+    # a long transfer keeps its ticket fresh
+    with queue.slot('nas1', 10):
+        time.sleep(0.5)
+        assert len(queue.load_tickets()) == 1
+    assert len(queue.load_tickets()) == 0
+
+def test_bandwidth_budget():
+    cache = Cache('test/.cache.tmp')
+    queue = cache.transfers
+    queue.slots = 4
+    queue.bandwidth = 1000
+    os.makedirs(queue.md_dir, exist_ok=True)
+
+    # another node's transfer has most of the budget
+    running = Ticket(os.path.join(queue.md_dir, 'other-node.123.1'), 'nas1',
+                     10, 0, time.time(), state='active', allocation=600)
+    running.write(0o664)
+    with queue.slot('nas1', 10) as bwlimit:
+        assert bwlimit == 400
+        assert sum(t.allocation for t in queue.load_tickets()) == 1000
+
+    # nothing left: wait until the running transfer is done
+    running.allocation = 1000
+    running.write(0o664)
+    allocations = []
+    def transfer():
+        with queue.slot('nas2', 10, sleep_interval=0.05) as bwlimit:
+            allocations.append(sum(t.allocation for t in queue.load_tickets()
+                                   if t.state == 'active'))
+            allocations.append(bwlimit)
+    thread = threading.Thread(target=transfer)
+    thread.start()
+    time.sleep(0.3)
+    assert allocations == []
+    os.remove(running.ticket_file)
+    thread.join()
+    assert allocations == [1000, 1000]
@@ -0,0 +1,54 @@
+import asyncio
+import os
+import shutil
+from jme.stagecache.cache import Cache
+from jme.stagecache.staging import iter_stage_many, stage_many
+
+def make_files(count):
+    file_dir = os.path.abspath('test/.test.files/staging')
+    os.makedirs(file_dir, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(file_dir, 'file.{}'.format(i))
+        with open(path, 'wt') as test_file:
+            test_file.write(str(i) * 100)
+        paths.append(path)
+    return paths
+
+def test_stage_many():
+    root = 'test/.cache.tmp/staging'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    cache = Cache(root)
+    paths = make_files(6)
+
+    cached_paths = asyncio.run(stage_many(paths, cache=cache,
+                                          max_probes=3, max_transfers=2))
+    assert set(cached_paths) == set(paths)
+    for path, cached_path in cached_paths.items():
+        with open(path) as original, open(cached_path) as copy:
+            assert original.read() == copy.read()
+    assert len(cache.metadata.list_assets()) == 6
+
+    # now they are all hits, and errors don't stop the others
+    async def collect():
+        return [r async for r in iter_stage_many(
+            paths[:2] + [(paths[2], 'no_such_type'), '/no/such/file'],
+            cache=root)]
+    results = asyncio.run(collect())
+    assert len(results) == 4
+    errors = [r for r in results if r.error is not None]
+    assert sorted(r.target_url for r in errors) == \
+            ['/no/such/file', paths[2]]
+    events = cache.access_log.log_file
+    with open(events) as log_handle:
+        outcomes = [line.split('\t')[3] for line in log_handle]
+    assert outcomes.count('miss') == 6
+    assert outcomes.count('hit') == 2
+
+    try:
+        asyncio.run(stage_many(['/no/such/file', ], cache=cache))
+    except Exception as exc:
+        assert 'Could not stage 1 of 1' in str(exc)
+    else:
+        assert False, "missing file not reported"
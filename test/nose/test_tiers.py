@@ -0,0 +1,69 @@
+import os
+from jme.stagecache.access_log import read_access_log
+from jme.stagecache.cache import Cache
+from jme.stagecache.target import get_target
+from jme.stagecache.text_metadata import TargetMetadata
+from helpers import make_cache
+
+def make_tier(root, size, next_tier=None):
+    if next_tier is None:
+        return make_cache(root, cache_size=size)
+    return make_cache(root, cache_size=size,
+                      cache_next_tier=os.path.abspath(next_tier))
+
+def test_tiers():
+    file_dir = os.path.abspath('test/.test.files/tiers')
+    os.makedirs(file_dir, exist_ok=True)
+    paths = []
+    for name in ['a', 'b']:
+        path = os.path.join(file_dir, name)
+        with open(path, 'wt') as test_file:
+            test_file.write(name * 1000)
+        paths.append(path)
+
+    slow = make_tier('test/.cache.tmp/slow', 10000)
+    fast = make_tier('test/.cache.tmp/fast', 1500, 'test/.cache.tmp/slow')
+    assert fast.get_next_tier().cache_root == slow.cache_root
+
+    # a miss fills both tiers
+    a = get_target(paths[0], fast.asset_types['file'])
+    cached_a = fast.add_target(a, cache_time='0')
+    assert os.path.exists(cached_a)
+    slow_a = TargetMetadata(slow, a.path_string, 'file')
+    assert os.path.exists(slow_a.cached_target)
+
+    # drop it from the slow tier, so it has to be demoted later
+    slow.remove_cached_file(slow_a)
+    assert not os.path.exists(slow_a.cached_target)
+
+    # the fast tier isn't locked while copying down
+    demote = fast.demote
+    locked_while_demoting = []
+    def check_demote(target_metadata, dry_run=False):
+        locked_while_demoting.append(
+            os.path.exists(fast.metadata.write_lock))
+        demote(target_metadata, dry_run=dry_run)
+    fast.demote = check_demote
+
+    # b doesn't fit with a, so a is evicted from fast and moved to slow
+    b = get_target(paths[1], fast.asset_types['file'])
+    fast.add_target(b, cache_time='0')
+    assert locked_while_demoting == [False]
+    assert not os.path.exists(cached_a)
+    assert os.path.exists(slow_a.cached_target)
+    assert set(a[0] for a in slow.metadata.list_assets()) == set(paths)
+
+    outcomes = [e['outcome'] \
+                for e in read_access_log(slow.access_log.log_file)]
+    assert outcomes == ['miss', 'miss', 'demote']
+
+def test_tier_loop():
+    make_tier('test/.cache.tmp/loop1', 1000, 'test/.cache.tmp/loop2')
+    make_tier('test/.cache.tmp/loop2', 1000, 'test/.cache.tmp/loop1')
+    cache = Cache('test/.cache.tmp/loop1')
+    try:
+        cache.get_next_tier().get_next_tier()
+    except Exception as exc:
+        assert 'loop' in str(exc)
+    else:
+        assert False, "tier loop not detected"
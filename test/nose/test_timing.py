@@ -0,0 +1,53 @@
+import time
+from jme.stagecache.cache import Cache
+from jme.stagecache.target import get_target
+from jme.stagecache.timing import add_span_hook, remove_span_hook, \
+                                  record_span, span, timed, SpanRecorder
+
+@timed('inner')
+def timed_function(value):
+    return value * 2
+
+def test_spans():
+    # nothing recorded (or broken) without hooks
+    with span('ignored') as ignored:
+        assert ignored is None
+
+    recorder = SpanRecorder()
+    add_span_hook(recorder)
+    try:
+        with span('outer', target='/a'):
+            assert timed_function(2) == 4
+            assert timed_function(3) == 6
+            start = time.time()
+            time.sleep(0.01)
+            assert record_span('wait', start) >= 0.01
+    finally:
+        remove_span_hook(recorder)
+
+    with span('after'):
+        pass
+
+    summary = recorder.summary()
+    assert list(summary) == ['outer', 'outer/inner', 'outer/wait']
+    assert summary['outer/inner']['count'] == 2
+    assert summary['outer/wait']['seconds'] >= 0.01
+    outer = [s for s in recorder.spans if s.name == 'outer'][0]
+    assert outer.attrs == {'target': '/a'}
+    assert 'inner' in recorder.format_summary()
+    assert len(recorder.to_dict()['spans']) == 4
+
+def test_cache_spans():
+    recorder = SpanRecorder()
+    add_span_hook(recorder)
+    try:
+        cache = Cache('test/.cache.tmp')
+        target = get_target('README.md', cache.asset_types['file'])
+        cache.add_target(target, cache_time='1', force=True, dry_run=True)
+    finally:
+        remove_span_hook(recorder)
+
+    summary = recorder.summary()
+    for path in ['add_target', 'add_target/target_lock_wait',
+                 'add_target/remote_stat']:
+        assert path in summary, path
@@ -0,0 +1,103 @@
+import gzip
+import os
+import struct
+import time
+from jme.stagecache.target import get_target
+from jme.stagecache.transform import derived_path, estimate_size, \
+                                     get_method, transformed_target_path, \
+                                     UNKNOWN_RATIO
+from helpers import make_cache
+
+TEXT = b"@read1\nACGTACGT\n+\nIIIIIIII\n" * 1000
+
+def make_source(name):
+    root = 'test/.cache.tmp/' + name
+    source_dir = os.path.abspath('test/.cache.tmp/{}_source'.format(name))
+    cache = make_cache(root, clean=[source_dir], cache_size=100000)
+    os.makedirs(source_dir)
+    source = os.path.join(source_dir, 'reads.fastq.gz')
+    # two members, like bgzip
+    with open(source, 'wb') as source_handle:
+        source_handle.write(gzip.compress(TEXT[:10000]))
+        source_handle.write(gzip.compress(TEXT[10000:]))
+    return cache, source
+
+def test_names():
+    assert get_method('decompress', '/a/b.fq.gz') == 'gunzip'
+    assert get_method('decompress', '/a/b.fq.zst') == 'unzstd'
+    assert get_method('gunzip', '/a/b.fq.zst') is None
+    assert get_method(None, '/a/b.fq.gz') is None
+    assert derived_path('decompress', '/a/b.fq.gz') == '/a/b.fq'
+    assert derived_path('gunzip', '/a/b.fq') == '/a/b.fq'
+    assert transformed_target_path('gunzip', '/a/b.fq.gz') == \
+            '/a/b.fq.gz.gunzip/b.fq'
+    assert transformed_target_path('gunzip', '/a/b.fq') == '/a/b.fq'
+
+def test_decompress():
+    cache, source = make_source('transform')
+    # only the last member's ISIZE is in the trailer
+    assert estimate_size(os, source, 'gunzip', os.path.getsize(source)) == \
+            len(TEXT) - 10000
+
+    target = get_target(source, cache.asset_types['decompress'])
+    asset_path = source + '.gunzip/reads.fastq'
+    assert target.path_string == asset_path
+    cached = cache.add_target(target)
+    assert cached == os.path.abspath(cache.cache_root) + asset_path
+    with open(cached, 'rb') as cached_handle:
+        assert cached_handle.read() == TEXT
+    assert int(os.path.getmtime(cached)) == int(os.path.getmtime(source))
+    assert cache.inspect_cache()['files'][asset_path]['size'] == len(TEXT)
+    assert sorted(os.listdir(os.path.dirname(cached))) == \
+            ['.stagecache.reads.fastq', 'reads.fastq']
+
+    # a hit doesn't decompress again
+    cached_inode = os.stat(cached).st_ino
+    cache.add_target(get_target(source, cache.asset_types['decompress']))
+    assert os.stat(cached).st_ino == cached_inode
+
+    # a changed source does
+    with open(source, 'wb') as source_handle:
+        source_handle.write(gzip.compress(b"new\n"))
+    later = time.time() + 10
+    os.utime(source, (later, later))
+    cache.add_target(get_target(source, cache.asset_types['decompress']))
+    with open(cached, 'rb') as cached_handle:
+        assert cached_handle.read() == b"new\n"
+
+def test_plain_and_compressed():
+    cache, source = make_source('transform_collide')
+    plain = source[:-3]
+    with open(plain, 'wb') as plain_handle:
+        plain_handle.write(b"plain\n")
+
+    cached_plain = cache.add_target(get_target(plain,
+                                               cache.asset_types['file']))
+    cached_gz = cache.add_target(get_target(source,
+                                            cache.asset_types['decompress']))
+    assert cached_plain != cached_gz
+    with open(cached_plain, 'rb') as cached_handle:
+        assert cached_handle.read() == b"plain\n"
+    with open(cached_gz, 'rb') as cached_handle:
+        assert cached_handle.read() == TEXT
+    assert sorted(a[1] for a in cache.metadata.list_assets()) == \
+            ['decompress', 'file']
+
+def test_isize_wraparound():
+    root = 'test/.cache.tmp/isize'
+    make_cache(root)
+    trailer = os.path.join(root, 'trailer.gz')
+
+    def estimate(isize, compressed_size):
+        with open(trailer, 'wb') as trailer_handle:
+            trailer_handle.write(b'\0' * 14 + struct.pack('<I', isize))
+        return estimate_size(os, trailer, 'gunzip', compressed_size)
+
+    # 4.8GB from 1.2GB, ISIZE wrapped once
+    assert estimate(4800000000 % 2 ** 32, 1200000000) == 4800000000
+    # 8GiB from 2GiB, ISIZE wrapped to a plausible looking 0
+    assert estimate(0, 2 ** 31) == 2 ** 31 * UNKNOWN_RATIO
+    # small files are exact
+    assert estimate(1000, 100) == 1000
+    # an empty last member (bgzip)
+    assert estimate(0, 10 ** 7) == 10 ** 7 * UNKNOWN_RATIO
@@ -0,0 +1,78 @@
+import os
+import shutil
+import time
+from jme.stagecache.target import get_target, walk_tree
+from jme.stagecache.text_metadata import TargetMetadata
+from helpers import make_cache
+
+def write(path, text, mtime=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wt') as out_handle:
+        out_handle.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def make_tree(name):
+    root = 'test/.cache.tmp/' + name
+    source = os.path.abspath('test/.cache.tmp/{}_source'.format(name))
+    cache = make_cache(root, clean=[source], cache_size=10000)
+    write(source + '/hash.k2d', 'hash\n', 1000000000)
+    write(source + '/taxo.k2d', 'taxonomy\n', 1000000000)
+    write(source + '/library/bacteria/lib.fna', '>seq\nACGT\n', 1000000000)
+    write(source + '/library/viral/lib.fna', '>virus\nAC\n', 1000000000)
+    return cache, source
+
+def test_walk_tree():
+    cache, source = make_tree('tree_walk')
+    files, dirs = walk_tree(os, source, threads=2)
+    assert sorted(files) == [source + '/hash.k2d',
+                             source + '/library/bacteria/lib.fna',
+                             source + '/library/viral/lib.fna',
+                             source + '/taxo.k2d']
+    assert files[source + '/taxo.k2d'] == {'mtime': 1000000000, 'size': 9}
+    assert sorted(dirs) == [source, source + '/library',
+                            source + '/library/bacteria',
+                            source + '/library/viral']
+
+def test_tree_asset():
+    cache, source = make_tree('tree_asset')
+    target = get_target(source, cache.asset_types['dir'])
+    assert target.get_size() == 5 + 9 + 10 + 10
+    cached = cache.add_target(target)
+    assert cached == os.path.abspath(cache.cache_root) + source
+    with open(cached + '/library/viral/lib.fna') as cached_handle:
+        assert cached_handle.read() == '>virus\nAC\n'
+    assert cache.inspect_cache()['files'][source]['size'] == 34
+    target_metadata = TargetMetadata(cache, source, 'dir')
+    assert cache.verify_asset(target_metadata) == ('ok', [])
+
+    # change one file, add one, and remove one
+    unchanged = cached + '/taxo.k2d'
+    unchanged_inode = os.stat(unchanged).st_ino
+    write(source + '/hash.k2d', 'new hash\n')
+    write(source + '/library/fungi/lib.fna', '>fungus\n', 1000000000)
+    shutil.rmtree(source + '/library/viral')
+    later = time.time() + 10
+    os.utime(source + '/library', (later, later))
+    cache.add_target(get_target(source, cache.asset_types['dir']))
+    with open(cached + '/hash.k2d') as cached_handle:
+        assert cached_handle.read() == 'new hash\n'
+    assert os.path.exists(cached + '/library/fungi/lib.fna')
+    assert not os.path.exists(cached + '/library/viral')
+    # untouched files are not copied again
+    assert os.stat(unchanged).st_ino == unchanged_inode
+
+    # eviction removes the whole tree
+    cache.remove_cached_files([target_metadata, ])
+    assert not os.path.exists(cached)
+
+def test_tree_trailing_slash():
+    cache, source = make_tree('tree_slash')
+    cached = cache.add_target(get_target(source + '/',
+                                         cache.asset_types['dir']))
+    assert cached == os.path.abspath(cache.cache_root) + source
+    assert sorted(walk_tree(os, cached)[0]) == [
+        cached + '/hash.k2d', cached + '/library/bacteria/lib.fna',
+        cached + '/library/viral/lib.fna', cached + '/taxo.k2d']
+    target_metadata = TargetMetadata(cache, source, 'dir')
+    assert cache.verify_asset(target_metadata) == ('ok', [])
@@ -0,0 +1,47 @@
+import os
+import time
+from jme.stagecache.text_metadata import TargetMetadata
+from helpers import make_cache
+
+def add_assets(cache, count, lock_date):
+    for i in range(count):
+        metadata = TargetMetadata(cache, '/data/{}.{}'.format(lock_date, i),
+                                  'file')
+        open(metadata.cached_target, 'wt').close()
+        cache.metadata.add_cached_file(metadata, 100, lock_date)
+
+def test_watermarks():
+    cache = make_cache('test/.cache.tmp/watermark', cache_size=1000,
+                       cache_high_watermark='85%', cache_low_watermark=0.5)
+    assert cache.get_watermarks() == (0.85, 0.5)
+
+    # 800 of 1000 bytes used is under the high mark
+    now = int(time.time())
+    add_assets(cache, 6, now - 100)
+    add_assets(cache, 2, now + 1000)
+    assert cache.trim_to_watermark() == 0
+
+    # at 900, expired files go until we're at 500
+    add_assets(cache, 1, now - 50)
+    assert cache.trim_to_watermark(dry_run=True) == 400
+    assert cache.inspect_cache()['used'] == 900
+    assert cache.trim_to_watermark() == 400
+    assert cache.inspect_cache()['used'] == 500
+
+    # force trims under the high mark
+    add_assets(cache, 1, now - 10)
+    assert cache.trim_to_watermark() == 0
+    assert cache.trim_to_watermark(force=True) == 100
+    assert cache.inspect_cache()['used'] == 500
+
+def test_trimmer_thread():
+    cache = make_cache('test/.cache.tmp/watermark', cache_size=1000,
+                       cache_high_watermark=0.5)
+    add_assets(cache, 8, int(time.time()) - 100)
+    stop = cache.start_trimmer(interval=0.05)
+    for _ in range(100):
+        if cache.inspect_cache()['used'] <= 500:
+            break
+        time.sleep(0.05)
+    stop.set()
+    assert cache.inspect_cache()['used'] == 500
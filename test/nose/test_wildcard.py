@@ -0,0 +1,52 @@
+import os
+import shutil
+from jme.stagecache.main import cache_wildcard
+from jme.stagecache.wildcard import split_pattern, match_pattern, \
+                                    pattern_to_glob
+from helpers import make_cache
+
+def make_sources(name):
+    source = os.path.abspath('test/.cache.tmp/{}_source'.format(name))
+    if os.path.exists(source):
+        shutil.rmtree(source)
+    for sample in ['s1', 's2', '.hidden']:
+        os.makedirs(os.path.join(source, sample, 'subdir'))
+        for file_name in ['reads.fq', 'notes.txt']:
+            with open(os.path.join(source, sample, file_name), 'wt') as out:
+                out.write(sample + "\n")
+    return source
+
+def test_split_pattern():
+    assert pattern_to_glob('/data/{sample}/reads.{dir}.fq') == \
+            '/data/*/reads.*.fq'
+    assert split_pattern('/data/{sample}/reads.fq') == \
+            ('/data', ['*', 'reads.fq'])
+    assert split_pattern('/data/run_?/x/*.tsv') == \
+            ('/data', ['run_?', 'x', '*.tsv'])
+    assert split_pattern('/data/file.fq') == ('/data', ['file.fq'])
+
+def test_match_pattern():
+    source = make_sources('wildcard_match')
+    assert match_pattern(os, source + '/{sample}/reads.fq') == \
+            [source + '/s1/reads.fq', source + '/s2/reads.fq']
+    assert match_pattern(os, source + '/s1/*') == \
+            [source + '/s1/notes.txt', source + '/s1/reads.fq']
+    assert match_pattern(os, source + '/s1/*', skip_dirs=False) == \
+            [source + '/s1/notes.txt', source + '/s1/reads.fq',
+             source + '/s1/subdir']
+    assert match_pattern(os, source + '/.*/reads.fq') == \
+            [source + '/.hidden/reads.fq']
+    assert match_pattern(os, source + '/nope/*') == []
+
+def test_cache_wildcard():
+    source = make_sources('wildcard_stage')
+    root = 'test/.cache.tmp/wildcard_stage'
+    make_cache(root, cache_size=1000)
+
+    cached_root = cache_wildcard(source + '/{sample}/reads.fq', cache=root,
+                                 threads=2)
+    assert cached_root == os.path.abspath(root) + source
+    for sample in ['s1', 's2']:
+        with open(os.path.join(cached_root, sample, 'reads.fq')) as cached:
+            assert cached.read() == sample + "\n"
+    assert not os.path.exists(os.path.join(cached_root, 's1', 'notes.txt'))